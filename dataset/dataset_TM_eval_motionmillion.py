@@ -7,6 +7,7 @@ import codecs as cs
 from tqdm import tqdm
 
 import utils.paramUtil as paramUtil
+from dataset.eval_bundle import EvalBundle, eval_bundle_dir
 from torch.utils.data._utils.collate import default_collate
 
 
@@ -17,7 +18,7 @@ def collate_fn(batch):
 
 '''For use of training text-2-motion generative model'''
 class Text2MotionDataset(data.Dataset):
-    def __init__(self, dataset_name, is_test, w_vectorizer, feat_bias = 5, max_text_len = 20, unit_length = 4, split="val"):
+    def __init__(self, dataset_name, is_test, w_vectorizer, feat_bias = 5, max_text_len = 20, unit_length = 4, split="val", bundle_dir = None):
         
         self.max_length = 20
         self.pointer = 0
@@ -69,6 +70,8 @@ class Text2MotionDataset(data.Dataset):
             kinematic_chain = paramUtil.t2m_kinematic_chain
             self.meta_dir = pjoin(self.data_root, 'mean_std', "vector_272")
             split_file = pjoin(self.data_root, 'split', 'version1', 't2m_60_300', split+".txt")
+            if bundle_dir is None:
+                bundle_dir = eval_bundle_dir(self.data_root, 'vector_272', pjoin('version1', 't2m_60_300'), split)
 
         mean = np.load(pjoin(self.meta_dir, 'mean.npy'))
         std = np.load(pjoin(self.meta_dir, 'std.npy'))
@@ -78,12 +81,28 @@ class Text2MotionDataset(data.Dataset):
         data_dict = {}
         id_list = []
         self.id_list = []
-        with cs.open(split_file, 'r') as f:
-            for line in f.readlines():
-                id_list.append(line.strip())
-
         new_name_list = []
         length_list = []
+        if EvalBundle.exists(bundle_dir):
+            # the split prebuilt by eval_build_bundle.py, motions stay in the mapped file
+            bundle = EvalBundle(bundle_dir)
+            bundle.check_source(self.motion_dir, self.text_dir, split_file)
+            for i, name in enumerate(bundle.names):
+                length = int(bundle.lengths[i])
+                captions = bundle.get_captions(i)
+                if length < min_motion_len or length > 200 or len(captions) == 0:
+                    continue
+                self.id_list.append(name)
+                data_dict[name] = {'motion': bundle.motion(i),
+                                   'length': length,
+                                   'text': [{'caption': caption} for caption in captions]}
+                new_name_list.append(name)
+                length_list.append(length)
+        else:
+            with cs.open(split_file, 'r') as f:
+                for line in f.readlines():
+                    id_list.append(line.strip())
+
         for name in tqdm(id_list):
             try:
                 motion = np.load(pjoin(self.motion_dir, name + '.npy'))
@@ -171,9 +190,9 @@ class Text2MotionDataset(data.Dataset):
 
 def DATALoader(dataset_name, is_test,
                 batch_size, w_vectorizer,
-                num_workers = 8, unit_length = 4, split="val") : 
+                num_workers = 8, unit_length = 4, split="val", bundle_dir = None) : 
     
-    val_dataset = Text2MotionDataset(dataset_name, is_test, w_vectorizer, unit_length=unit_length, split=split)
+    val_dataset = Text2MotionDataset(dataset_name, is_test, w_vectorizer, unit_length=unit_length, split=split, bundle_dir=bundle_dir)
     val_loader = torch.utils.data.DataLoader( val_dataset, 
                                               batch_size,
                                               shuffle = True,
@@ -8,7 +8,8 @@ from tqdm import tqdm
 import utils.paramUtil as paramUtil
 import clip
 import os
-import pickle
+from dataset.text_feat_store import TextFeatureStore
+from dataset.motion_token_store import MotionTokenStore
 
 def collate_tensors(batch):
     dims = batch[0].dim()
@@ -43,7 +44,7 @@ def collate_fn(batch):
 
 
 class Text2MotionDataset_motionmillion(data.Dataset):
-    def __init__(self, dataset_name, split, clip_model, text_encode, text_sum_way, comp_device, motion_type, text_type, version, feat_bias = 5, unit_length = 4, codebook_size = 1024, tokenizer_name=None, debug=False):
+    def __init__(self, dataset_name, split, clip_model, text_encode, text_sum_way, comp_device, motion_type, text_type, version, feat_bias = 5, unit_length = 4, codebook_size = 1024, tokenizer_name=None, debug=False, text_feat_dir=None):
         
         self.pointer = 0
         self.dataset_name = dataset_name
@@ -94,8 +95,8 @@ class Text2MotionDataset_motionmillion(data.Dataset):
             kinematic_chain = paramUtil.t2m_kinematic_chain
             split_file = pjoin(self.data_root, 'split', self.version, f'{split}.txt')
         
-        with open(os.path.join(self.data_root, "all_data.pkl"), "rb") as f:
-            all_data = pickle.load(f)        
+        # codes and captions are read lazily from the memory-mapped store of train_t2m_get_codes.py
+        self.token_store = MotionTokenStore(pjoin(self.data_root, f'{tokenizer_name}_store'))
         id_list = []
         with cs.open(split_file, 'r') as f:
             for line in f.readlines():
@@ -104,53 +105,41 @@ class Text2MotionDataset_motionmillion(data.Dataset):
         # if debug:
         #     id_list = id_list[:1000]
 
-        new_name_list = []
-        data_dict = {}
-        for name in tqdm(id_list):
-            code_data_ref = all_data["code_data"][name]
-            text_data_ref = all_data["text_data"][name]
-            
-            if len(text_data_ref) == 0:
-                continue
-                
-            text_data = []
-            for line in text_data_ref:
-                text_dict = {}
-                caption = line.strip()
-                if caption == '':
-                    continue
-                    
-                text_dict['caption'] = caption
-                text_data.append(text_dict)
-            
-            data_dict[name] = {
-                'm_token_list': code_data_ref,
-                'text': text_data
-            }
-            new_name_list.append(name)
-
-        self.data_dict = data_dict
-        self.name_list = new_name_list
-        print(len(self.data_dict))
+        # motions without any non-empty caption are skipped
+        self.nb_codes = self.token_store.nb_codes()
+        self.nb_captions = self.token_store.nb_captions()
+        doc_ids = self.token_store.doc_ids(id_list)
+        self.doc_ids = doc_ids[self.nb_captions[doc_ids] > 0]
+        print(len(self.doc_ids))
     
         self.text_encode = text_encode
         self.text_sum_way = text_sum_way
         self.comp_device = comp_device
         self.clip_model = clip_model
 
+        # precomputed text features: no encoder in the dataset, samples are built on the cpu
+        # so that they can come from DataLoader workers
+        self.text_feat_store = None
+        if text_feat_dir is not None:
+            self.text_feat_store = TextFeatureStore(text_feat_dir)
+            if self.text_feat_store.text_encode != text_encode:
+                raise ValueError(f'Text feature store {text_feat_dir} was encoded with {self.text_feat_store.text_encode}, not {text_encode}')
+            self.comp_device = torch.device('cpu')
+
     def __len__(self):
-        return len(self.data_dict)
+        return len(self.doc_ids)
 
     def __getitem__(self, item):
-        data = self.data_dict[self.name_list[item]]
-        m_token_list, text_list = data['m_token_list'], data['text']
+        doc = self.doc_ids[item]
         
-        m_tokens = random.choice(m_token_list)
-        m_tokens = torch.tensor(m_tokens).to(self.comp_device)
-        text_data = random.choice(text_list)
-        caption= text_data['caption']
-
-        if self.text_encode == 'clip':
+        m_tokens = self.token_store.get_codes(doc, random.randrange(self.nb_codes[doc]))
+        m_tokens = torch.from_numpy(m_tokens.astype(np.int64)).to(self.comp_device)
+        caption = self.token_store.get_caption(doc, random.randrange(self.nb_captions[doc]))
+
+        if self.text_feat_store is not None:
+            feat_clip_text = self.text_feat_store.get(caption).unsqueeze(0)
+            y_mask = torch.ones((feat_clip_text.shape[0], feat_clip_text.shape[1]))
+        elif self.text_encode == 'clip':
             text = clip.tokenize(caption, truncate=True).to(self.comp_device)
             feat_clip_text = self.clip_model.encode_text(text).float()
             feat_clip_text = feat_clip_text.unsqueeze(1)
@@ -209,9 +198,9 @@ class Text2MotionDataset_motionmillion(data.Dataset):
 
 def DATALoader(dataset_name,
                 batch_size, codebook_size, tokenizer_name, split, clip_model, text_encode, text_sum_way, comp_device, motion_type=None, text_type=None, version=None, unit_length=4,
-                num_workers = 0, debug=False) : 
+                num_workers = 0, debug=False, text_feat_dir=None) : 
 
-    train_loader = torch.utils.data.DataLoader(Text2MotionDataset_motionmillion(dataset_name, clip_model = clip_model, text_encode = text_encode, text_sum_way = text_sum_way, comp_device = comp_device, split = split, codebook_size = codebook_size, tokenizer_name = tokenizer_name, unit_length=unit_length, debug=debug, motion_type=motion_type, text_type=text_type, version=version),
+    train_loader = torch.utils.data.DataLoader(Text2MotionDataset_motionmillion(dataset_name, clip_model = clip_model, text_encode = text_encode, text_sum_way = text_sum_way, comp_device = comp_device, split = split, codebook_size = codebook_size, tokenizer_name = tokenizer_name, unit_length=unit_length, debug=debug, motion_type=motion_type, text_type=text_type, version=version, text_feat_dir=text_feat_dir),
                                               batch_size,
                                               shuffle=True,
                                               num_workers=num_workers,
@@ -4,11 +4,80 @@ import numpy as np
 from os.path import join as pjoin
 import random
 import codecs as cs
+import os
+import json
 from tqdm import tqdm
+from models.lit_llama.indexed_dataset import (MMapIndexedDataset, MMapIndexedDatasetBuilder,
+                                              data_file_path, index_file_path)
+from dataset.eval_bundle import EvalBundle, eval_bundle_dir
+
+
+class MotionFiles(data.Dataset):
+    def __init__(self, motion_dir, name_list):
+        self.motion_dir = motion_dir
+        self.name_list = name_list
+
+    def __len__(self):
+        return len(self.name_list)
+
+    def __getitem__(self, item):
+        return np.load(pjoin(self.motion_dir, self.name_list[item] + '.npy')).astype(np.float32)
+
+
+def pack_motions(motion_dir, name_list, out_dir, split_file, shard_mb=4096, num_workers=8):
+    """Concatenate the float32 motions of `name_list`, in order, into `MMapIndexedDataset` shards.
+
+    `meta.json` keeps the feature dim, the shard prefixes and the `motion_dir` and `split_file`
+    the motions come from, the per-motion lengths and offsets are in the shard indexes.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    loader = torch.utils.data.DataLoader(MotionFiles(motion_dir, name_list), batch_size=None, num_workers=num_workers)
+    shards, builder, shard_bytes, dim = [], None, 0, None
+    for motion in tqdm(loader):
+        motion = motion.numpy()
+        dim = motion.shape[1]
+        if builder is None or shard_bytes + motion.nbytes > (shard_mb << 20):
+            if builder is not None:
+                builder.finalize(index_file_path(pjoin(out_dir, shards[-1])))
+            shards.append(f'shard_{len(shards):05d}')
+            builder = MMapIndexedDatasetBuilder(data_file_path(pjoin(out_dir, shards[-1])), dtype=np.float32)
+            shard_bytes = 0
+        builder.add_item(motion.reshape(-1))
+        shard_bytes += motion.nbytes
+    builder.finalize(index_file_path(pjoin(out_dir, shards[-1])))
+    with open(pjoin(out_dir, 'meta.json'), 'w') as f:
+        json.dump({'dim': dim, 'nb_motions': len(name_list), 'shards': shards, 'motion_dir': motion_dir, 'split_file': split_file}, f, indent=4)
+
+
+class PackedMotions:
+    """Motions packed by `pack_motions`, `window` reads a slice of frames straight from the mapped shard."""
+    def __init__(self, packed_dir):
+        with open(pjoin(packed_dir, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.dim = self.meta['dim']
+        self.shards = [MMapIndexedDataset(pjoin(packed_dir, shard), skip_warmup=True) for shard in self.meta['shards']]
+        self.shard_ids = np.concatenate([np.full(len(shard), i, dtype=np.int32) for i, shard in enumerate(self.shards)])
+        self.item_ids = np.concatenate([np.arange(len(shard), dtype=np.int32) for shard in self.shards])
+        self.lengths = np.concatenate([shard.sizes // self.dim for shard in self.shards])
+        assert len(self.lengths) == self.meta['nb_motions']
+
+    def check_source(self, motion_dir, split_file):
+        # items are only looked up by position, they must be the motions of this split file
+        source = {'motion_dir': motion_dir, 'split_file': split_file}
+        for key, path in source.items():
+            if key not in self.meta or os.path.normpath(self.meta[key]) != os.path.normpath(path):
+                raise ValueError(f"The motions were packed from {key} {self.meta.get(key)}, not {path}, pack them again with train_tokenizer_pack_motions.py")
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def window(self, item, start, size):
+        shard = self.shards[self.shard_ids[item]]
+        return shard.get(int(self.item_ids[item]), offset=start * self.dim, length=size * self.dim).reshape(size, self.dim)
 
 
 class VQMotionDatasetEval(data.Dataset):
-    def __init__(self, dataset_name,  motion_type, text_type, version, split, debug, window_size = 64, unit_length = 4):
+    def __init__(self, dataset_name,  motion_type, text_type, version, split, debug, window_size = 64, unit_length = 4, bundle_dir = None):
         self.window_size = window_size
         self.unit_length = unit_length
         self.dataset_name = dataset_name
@@ -48,6 +117,8 @@ class VQMotionDatasetEval(data.Dataset):
             mean = np.load(pjoin(self.data_root, 'mean_std', self.motion_type, 'mean.npy'))
             std = np.load(pjoin(self.data_root, 'mean_std', self.motion_type, 'std.npy'))
             split_file = pjoin(self.data_root, 'split', self.version, split + '.txt')
+            if bundle_dir is None:
+                bundle_dir = eval_bundle_dir(self.data_root, self.motion_type, self.version, split)
             
         else:
             raise KeyError('Dataset Does not Exists')
@@ -58,21 +129,31 @@ class VQMotionDatasetEval(data.Dataset):
         self.data = []
         self.lengths = []
         self.id_list = []
-        
-        with cs.open(split_file, 'r') as f:
-            for line in f.readlines():
-                id_list.append(line.strip())
 
-        if debug:
-            id_list = id_list[:1000]
+        if EvalBundle.exists(bundle_dir):
+            # the split prebuilt by eval_build_bundle.py, motions stay in the mapped file
+            bundle = EvalBundle(bundle_dir)
+            bundle.check_source(self.motion_dir, self.text_dir, split_file)
+            nb_motions = min(len(bundle), 1000) if debug else len(bundle)
+            for i in np.nonzero(bundle.lengths[:nb_motions] >= self.window_size)[0]:
+                self.id_list.append(bundle.names[i])
+                self.lengths.append(int(bundle.lengths[i]) - self.window_size)
+                self.data.append(bundle.motion(i))
+        else:
+            with cs.open(split_file, 'r') as f:
+                for line in f.readlines():
+                    id_list.append(line.strip())
+
+            if debug:
+                id_list = id_list[:1000]
             
-        for name in tqdm(id_list):
-            motion = np.load(pjoin(self.motion_dir, name + '.npy'))
-            if motion.shape[0] < self.window_size:
-                continue
-            self.id_list.append(name)
-            self.lengths.append(motion.shape[0] - self.window_size)
-            self.data.append(motion)
+            for name in tqdm(id_list):
+                motion = np.load(pjoin(self.motion_dir, name + '.npy'))
+                if motion.shape[0] < self.window_size:
+                    continue
+                self.id_list.append(name)
+                self.lengths.append(motion.shape[0] - self.window_size)
+                self.data.append(motion)
         self.mean = mean
         self.std = std
         print("Total number of motions {}".format(len(self.id_list)))
@@ -114,7 +195,7 @@ class VQMotionDatasetEval(data.Dataset):
         return motion, m_length, name
     
 class VQMotionDataset(data.Dataset):
-    def __init__(self, dataset_name,  motion_type, text_type, version, split, debug, window_size = 64, unit_length = 4):
+    def __init__(self, dataset_name,  motion_type, text_type, version, split, debug, window_size = 64, unit_length = 4, packed_dir = None):
         self.window_size = window_size
         self.unit_length = unit_length
         self.dataset_name = dataset_name
@@ -158,6 +239,8 @@ class VQMotionDataset(data.Dataset):
         with cs.open(split_file, 'r') as f:
             for line in f.readlines():
                 id_list.append(line.strip())
+        self.split_file = split_file
+        nb_split_motions = len(id_list)
 
         if debug:
             id_list = id_list[:1000]
@@ -168,6 +251,13 @@ class VQMotionDataset(data.Dataset):
         self.std = std
         print("Total number of motions {}".format(len(self.id_list)))
 
+        # motions packed by train_tokenizer_pack_motions.py from the same split file, in the same order
+        self.packed = None
+        if packed_dir is not None:
+            self.packed = PackedMotions(packed_dir)
+            self.packed.check_source(self.motion_dir, split_file)
+            assert len(self.packed) == nb_split_motions, f'{len(self.packed)} packed motions for the {nb_split_motions} of {split_file}'
+
     def inv_transform(self, data):
         return data * self.std + self.mean
     
@@ -178,10 +268,14 @@ class VQMotionDataset(data.Dataset):
         return len(self.id_list)
 
     def __getitem__(self, item):
-        name = self.id_list[item]
-        motion = np.load(pjoin(self.motion_dir, name + '.npy'))
-        idx = random.randint(0, len(motion) - self.window_size)
-        motion = motion[idx:idx+self.window_size]
+        if self.packed is not None:
+            idx = random.randint(0, self.packed.lengths[item] - self.window_size)
+            motion = self.packed.window(item, idx, self.window_size)
+        else:
+            name = self.id_list[item]
+            motion = np.load(pjoin(self.motion_dir, name + '.npy'))
+            idx = random.randint(0, len(motion) - self.window_size)
+            motion = motion[idx:idx+self.window_size]
         "Z Normalization"
         motion = (motion - self.mean) / self.std
         motion = motion.astype(np.float32)
@@ -198,9 +292,10 @@ def DATALoader(dataset_name,
                 debug,
                num_workers = 64, #8,
                window_size = 64,
-               unit_length = 4):
+               unit_length = 4,
+               packed_dir = None):
     print("num_workers: ", num_workers)
-    trainSet = VQMotionDataset(dataset_name, motion_type, text_type, version, split, debug, window_size=window_size, unit_length=unit_length)
+    trainSet = VQMotionDataset(dataset_name, motion_type, text_type, version, split, debug, window_size=window_size, unit_length=unit_length, packed_dir=packed_dir)
     train_loader = torch.utils.data.DataLoader(trainSet,
                                               batch_size=batch_size,
                                               shuffle=True,
@@ -223,9 +318,10 @@ def DATALoaderEvalVQ(dataset_name,
                 debug,
                num_workers = 64, #8,
                window_size = 64,
-               unit_length = 4):
+               unit_length = 4,
+               bundle_dir = None):
     print("num_workers: ", num_workers)
-    trainSet = VQMotionDatasetEval(dataset_name, motion_type, text_type, version, split, debug, window_size=window_size, unit_length=unit_length)
+    trainSet = VQMotionDatasetEval(dataset_name, motion_type, text_type, version, split, debug, window_size=window_size, unit_length=unit_length, bundle_dir=bundle_dir)
     train_loader = torch.utils.data.DataLoader(trainSet,
                                               batch_size=batch_size,
                                               shuffle=True,
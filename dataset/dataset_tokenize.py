@@ -92,6 +92,34 @@ class VQMotionDataset(data.Dataset):
 
         return motion, name
 
+class MotionCodeDataset(data.Dataset):
+    """Whole motions of `name_list` with their caption lines, for code extraction.
+
+    Motions are cropped from the first frame to a multiple of unit_length, so the extracted
+    codes do not depend on a random offset and an interrupted extraction can be resumed.
+    """
+    def __init__(self, motion_dir, text_dir, name_list, mean, std, unit_length = 4):
+        self.motion_dir = motion_dir
+        self.text_dir = text_dir
+        self.name_list = name_list
+        self.mean = mean
+        self.std = std
+        self.unit_length = unit_length
+
+    def __len__(self):
+        return len(self.name_list)
+
+    def __getitem__(self, item):
+        name = self.name_list[item]
+        motion = np.load(pjoin(self.motion_dir, name + '.npy'))
+        m_length = (len(motion) // self.unit_length) * self.unit_length
+        motion = (motion[:m_length] - self.mean) / self.std
+
+        with cs.open(pjoin(self.text_dir, name + '.txt'), 'r') as f:
+            text_data = f.readlines()
+
+        return torch.from_numpy(motion).float(), name, text_data
+
 def DATALoader(dataset_name,
                 batch_size = 1,
                 num_workers = 8, unit_length = 4, motion_type=None, text_type=None, version=None) : 
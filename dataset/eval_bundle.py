@@ -0,0 +1,110 @@
+import os
+import json
+import codecs as cs
+import numpy as np
+import torch
+from torch.utils import data
+from os.path import join as pjoin
+from tqdm import tqdm
+from models.lit_llama.indexed_dataset import (MMapIndexedDataset, MMapIndexedDatasetBuilder,
+                                              data_file_path, index_file_path)
+
+
+def eval_bundle_dir(data_root, motion_type, version, split):
+    # default location of the bundle of split/<version>/<split>.txt
+    return pjoin(data_root, 'eval_bundle', motion_type, version, split)
+
+
+class SplitFiles(data.Dataset):
+    """Motion and caption lines of every motion of a split, None for a motion that cannot be read."""
+    def __init__(self, motion_dir, text_dir, name_list):
+        self.motion_dir = motion_dir
+        self.text_dir = text_dir
+        self.name_list = name_list
+
+    def __len__(self):
+        return len(self.name_list)
+
+    def __getitem__(self, item):
+        name = self.name_list[item]
+        try:
+            motion = np.load(pjoin(self.motion_dir, name + '.npy')).astype(np.float32)
+        except Exception as e:
+            print(e)
+            return None
+        captions = []
+        if os.path.exists(pjoin(self.text_dir, name + '.txt')):
+            with cs.open(pjoin(self.text_dir, name + '.txt')) as f:
+                captions = [line.strip() for line in f.readlines()]
+        return motion, captions
+
+
+def build_eval_bundle(out_dir, motion_dir, text_dir, split_file, num_workers=8):
+    """Write every readable motion of `split_file`, in split order, into one evaluation bundle.
+
+    `motions` is a float32 `MMapIndexedDataset` with one item per motion, `captions` holds the
+    utf-8 caption lines with one document per motion, `names.txt` the motion names. The
+    datasets apply their own length and caption filters on the bundle index.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    with cs.open(split_file, 'r') as f:
+        name_list = [line.strip() for line in f.readlines()]
+
+    loader = torch.utils.data.DataLoader(SplitFiles(motion_dir, text_dir, name_list), batch_size=None, num_workers=num_workers)
+    motions = MMapIndexedDatasetBuilder(data_file_path(pjoin(out_dir, 'motions')), dtype=np.float32)
+    captions = MMapIndexedDatasetBuilder(data_file_path(pjoin(out_dir, 'captions')), dtype=np.uint8)
+    names, dim = [], None
+    for name, item in zip(name_list, tqdm(loader)):
+        if item is None:
+            continue
+        motion, lines = item
+        motion = motion.numpy()
+        dim = motion.shape[1]
+        motions.add_item(motion.reshape(-1))
+        for line in lines:
+            captions.add_item(np.frombuffer(line.encode('utf-8'), dtype=np.uint8))
+        captions.end_document()
+        names.append(name)
+    motions.finalize(index_file_path(pjoin(out_dir, 'motions')))
+    captions.finalize(index_file_path(pjoin(out_dir, 'captions')))
+
+    with open(pjoin(out_dir, 'names.txt'), 'w') as f:
+        f.write(''.join(name + '\n' for name in names))
+    # written last, a bundle without meta.json is incomplete
+    with open(pjoin(out_dir, 'meta.json'), 'w') as f:
+        json.dump({'dim': dim, 'nb_motions': len(names), 'motion_dir': motion_dir, 'text_dir': text_dir, 'split_file': split_file}, f, indent=4)
+    return len(names)
+
+
+class EvalBundle:
+    """Reader of a bundle written by `build_eval_bundle`, motions are views of the mapped file."""
+    def __init__(self, root):
+        with open(pjoin(root, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.dim = self.meta['dim']
+        self.motions = MMapIndexedDataset(pjoin(root, 'motions'), skip_warmup=True)
+        self.captions = MMapIndexedDataset(pjoin(root, 'captions'), skip_warmup=True)
+        with open(pjoin(root, 'names.txt'), 'r') as f:
+            self.names = [line.strip() for line in f]
+        self.lengths = self.motions.sizes // self.dim
+        assert len(self.names) == len(self.lengths) == len(self.captions.doc_idx) - 1 == self.meta['nb_motions']
+
+    @staticmethod
+    def exists(root):
+        return root is not None and os.path.exists(pjoin(root, 'meta.json'))
+
+    def check_source(self, motion_dir, text_dir, split_file):
+        source = {'motion_dir': motion_dir, 'text_dir': text_dir, 'split_file': split_file}
+        for key, path in source.items():
+            if os.path.normpath(self.meta[key]) != os.path.normpath(path):
+                raise ValueError(f"The evaluation bundle was built from {key} {self.meta[key]}, not {path}")
+
+    def __len__(self):
+        return len(self.names)
+
+    def motion(self, i):
+        return self.motions[i].reshape(-1, self.dim)
+
+    def get_captions(self, i):
+        start, end = self.captions.doc_idx[i], self.captions.doc_idx[i + 1]
+        return [self.captions[int(j)].tobytes().decode('utf-8') for j in range(start, end)]
@@ -0,0 +1,94 @@
+import os
+import numpy as np
+from os.path import join as pjoin
+from models.lit_llama.indexed_dataset import (MMapIndexedDataset, MMapIndexedDatasetBuilder,
+                                              data_file_path, index_file_path)
+
+
+def codes_dtype(nb_code):
+    # FSQ-65536 codes fit in uint16, the end and pad tokens are never stored
+    return np.uint16 if nb_code <= 65536 else np.int32
+
+
+class MotionTokenStoreBuilder:
+    """Writes the motion codes and captions of a dataset as two `MMapIndexedDataset`.
+
+    One document per motion: `codes` holds its code sequences, `captions` its utf-8
+    encoded captions, and `names.txt` lists the motion names in document order.
+    """
+    def __init__(self, root, nb_code):
+        os.makedirs(root, exist_ok=True)
+        self.root = root
+        self.codes = MMapIndexedDatasetBuilder(data_file_path(pjoin(root, 'codes')), dtype=codes_dtype(nb_code))
+        self.captions = MMapIndexedDatasetBuilder(data_file_path(pjoin(root, 'captions')), dtype=np.uint8)
+        self.names = open(pjoin(root, 'names.txt'), 'w')
+
+    def add_motion(self, name, code_data, text_data):
+        # code_data: (nb_sequences, seq_len) codes, text_data: raw caption lines
+        for codes in np.asarray(code_data).reshape(-1, np.shape(code_data)[-1]):
+            self.codes.add_item(codes.astype(self.codes.dtype))
+        for line in text_data:
+            caption = line.strip()
+            if caption == '':
+                continue
+            self.captions.add_item(np.frombuffer(caption.encode('utf-8'), dtype=np.uint8))
+        self.codes.end_document()
+        self.captions.end_document()
+        self.names.write(name + '\n')
+
+    def merge_store_(self, another_root):
+        # append a store written by another builder, e.g. one extraction shard
+        self.codes.merge_file_(pjoin(another_root, 'codes'))
+        self.captions.merge_file_(pjoin(another_root, 'captions'))
+        with open(pjoin(another_root, 'names.txt'), 'r') as f:
+            self.names.write(f.read())
+
+    def finalize(self):
+        self.codes.finalize(index_file_path(pjoin(self.root, 'codes')))
+        self.captions.finalize(index_file_path(pjoin(self.root, 'captions')))
+        self.names.close()
+
+
+class MotionTokenStore:
+    """Lazy reader of a store written by `MotionTokenStoreBuilder`.
+
+    Only the index arrays are memory mapped, code sequences and captions are read on
+    access, so forked DataLoader workers share the pages instead of copying the data.
+    """
+    def __init__(self, root):
+        self.root = root
+        self.codes = MMapIndexedDataset(pjoin(root, 'codes'), skip_warmup=True)
+        self.captions = MMapIndexedDataset(pjoin(root, 'captions'), skip_warmup=True)
+        assert len(self.codes.doc_idx) == len(self.captions.doc_idx)
+
+    @staticmethod
+    def exists(root):
+        return (MMapIndexedDataset.exists(pjoin(root, 'codes')) and MMapIndexedDataset.exists(pjoin(root, 'captions'))
+                and os.path.exists(pjoin(root, 'names.txt')))
+
+    def __len__(self):
+        return len(self.codes.doc_idx) - 1
+
+    def doc_ids(self, names):
+        # the name table is only read here, it is not kept by the store
+        with open(pjoin(self.root, 'names.txt'), 'r') as f:
+            name_to_doc = {line.strip(): i for i, line in enumerate(f)}
+        assert len(name_to_doc) == len(self)
+        return np.array([name_to_doc[name] for name in names], dtype=np.int64)
+
+    def nb_codes(self):
+        # number of code sequences of every motion
+        return np.diff(self.codes.doc_idx)
+
+    def nb_captions(self):
+        return np.diff(self.captions.doc_idx)
+
+    def get_codes(self, doc, i):
+        return self.codes[int(self.codes.doc_idx[doc] + i)]
+
+    def get_caption(self, doc, i):
+        return self.captions[int(self.captions.doc_idx[doc] + i)].tobytes().decode('utf-8')
+
+    def iter_captions(self):
+        for i in range(len(self.captions)):
+            yield self.captions[i].tobytes().decode('utf-8')
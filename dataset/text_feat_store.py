@@ -0,0 +1,165 @@
+import os
+import json
+import hashlib
+import numpy as np
+import torch
+from os.path import join as pjoin
+
+
+# on disk bf16 is kept as its raw 16 bits, numpy has no bfloat16
+FEAT_DTYPES = {
+    'fp16': (np.float16, torch.float16),
+    'bf16': (np.int16, torch.bfloat16),
+}
+
+
+def caption_key(caption):
+    """64-bit key of a caption, the stripped text is hashed so it matches what the datasets read."""
+    digest = hashlib.blake2b(caption.strip().encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+
+class TextFeatureStoreWriter:
+    """Appends per-token text features to fixed dtype shards `<prefix>_<k>.bin`.
+
+    Every caption is a (length, dim) block of rows; `close` writes `<prefix>.index.npz`
+    with the caption keys and their (shard, row offset, length). Several writers (one per
+    process) are combined into the store index by `merge_text_feat_index`.
+    """
+    def __init__(self, out_dir, prefix, dim, dtype='bf16', shard_mb=1024):
+        self.out_dir = out_dir
+        self.prefix = prefix
+        self.dim = dim
+        self.np_dtype, self.torch_dtype = FEAT_DTYPES[dtype]
+        self.shard_rows = max(1, (shard_mb << 20) // (dim * np.dtype(self.np_dtype).itemsize))
+
+        self.shards = []
+        self.keys, self.shard_ids, self.offsets, self.lengths = [], [], [], []
+        self._file = None
+        self._rows = 0
+        os.makedirs(out_dir, exist_ok=True)
+
+    def _next_shard(self):
+        if self._file is not None:
+            self._file.close()
+        name = f'{self.prefix}_{len(self.shards):05d}.bin'
+        self.shards.append(name)
+        self._file = open(pjoin(self.out_dir, name), 'wb')
+        self._rows = 0
+
+    def add(self, caption, feat):
+        # feat: (length, dim), any float dtype and device
+        assert feat.dim() == 2 and feat.shape[1] == self.dim, feat.shape
+        if self._file is None or (self._rows > 0 and self._rows + feat.shape[0] > self.shard_rows):
+            self._next_shard()
+
+        feat = feat.detach().to(device='cpu', dtype=self.torch_dtype).contiguous()
+        if self.torch_dtype == torch.bfloat16:
+            feat = feat.view(torch.int16)
+        self._file.write(feat.numpy().tobytes(order='C'))
+
+        self.keys.append(caption_key(caption))
+        self.shard_ids.append(len(self.shards) - 1)
+        self.offsets.append(self._rows)
+        self.lengths.append(feat.shape[0])
+        self._rows += feat.shape[0]
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        np.savez(pjoin(self.out_dir, f'{self.prefix}.index.npz'),
+                 keys=np.array(self.keys, dtype=np.uint64),
+                 shard_ids=np.array(self.shard_ids, dtype=np.int32),
+                 offsets=np.array(self.offsets, dtype=np.int64),
+                 lengths=np.array(self.lengths, dtype=np.int32),
+                 shards=np.array(self.shards))
+
+
+def merge_text_feat_index(out_dir, prefixes, dim, dtype, text_encode):
+    """Combine the per-writer indexes into the sorted `index.npz` + `meta.json` of a store."""
+    shards = []
+    keys, shard_ids, offsets, lengths = [], [], [], []
+    for prefix in prefixes:
+        part = np.load(pjoin(out_dir, f'{prefix}.index.npz'))
+        keys.append(part['keys'])
+        shard_ids.append(part['shard_ids'] + len(shards))
+        offsets.append(part['offsets'])
+        lengths.append(part['lengths'])
+        shards.extend(part['shards'].tolist())
+
+    keys = np.concatenate(keys)
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    if len(keys) > 1 and (keys[1:] == keys[:-1]).any():
+        raise ValueError('Duplicated caption keys in the text feature store, captions must be unique before encoding')
+
+    np.savez(pjoin(out_dir, 'index.npz'),
+             keys=keys,
+             shard_ids=np.concatenate(shard_ids)[order],
+             offsets=np.concatenate(offsets)[order],
+             lengths=np.concatenate(lengths)[order])
+    with open(pjoin(out_dir, 'meta.json'), 'w') as f:
+        json.dump({'dim': dim, 'dtype': dtype, 'text_encode': text_encode, 'shards': shards}, f, indent=4)
+
+
+class TextFeatureStore:
+    """Read-only view of a text feature store, `get(caption)` returns the (length, dim) features.
+
+    Shards are memory mapped lazily in each process, so the store can be handed to
+    DataLoader workers without copying any feature data.
+    """
+    def __init__(self, root):
+        self.root = root
+        with open(pjoin(root, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        self.dim = meta['dim']
+        self.dtype = meta['dtype']
+        self.text_encode = meta['text_encode']
+        self.shards = meta['shards']
+        self.np_dtype, self.torch_dtype = FEAT_DTYPES[self.dtype]
+
+        index = np.load(pjoin(root, 'index.npz'))
+        self.keys = index['keys']
+        self.shard_ids = index['shard_ids']
+        self.offsets = index['offsets']
+        self.lengths = index['lengths']
+        self._mmaps = {}
+
+    @staticmethod
+    def exists(root):
+        return os.path.exists(pjoin(root, 'meta.json')) and os.path.exists(pjoin(root, 'index.npz'))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_mmaps'] = {}
+        return state
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _find(self, caption):
+        key = np.uint64(caption_key(caption))
+        i = np.searchsorted(self.keys, key)
+        if i == len(self.keys) or self.keys[i] != key:
+            return None
+        return i
+
+    def __contains__(self, caption):
+        return self._find(caption) is not None
+
+    def _shard(self, shard_id):
+        if shard_id not in self._mmaps:
+            mmap = np.memmap(pjoin(self.root, self.shards[shard_id]), dtype=self.np_dtype, mode='r')
+            self._mmaps[shard_id] = mmap.reshape(-1, self.dim)
+        return self._mmaps[shard_id]
+
+    def get(self, caption):
+        i = self._find(caption)
+        if i is None:
+            raise KeyError(f'Caption not in the text feature store {self.root}: {caption}')
+        offset, length = self.offsets[i], self.lengths[i]
+        feat = torch.from_numpy(np.array(self._shard(int(self.shard_ids[i]))[offset:offset + length]))
+        if self.torch_dtype == torch.bfloat16:
+            feat = feat.view(torch.bfloat16)
+        return feat
@@ -0,0 +1,24 @@
+from os.path import join as pjoin
+
+import options.option_transformer as option_trans
+from dataset.eval_bundle import EvalBundle, build_eval_bundle, eval_bundle_dir
+
+
+##### ---- Exp dirs ---- #####
+args = option_trans.get_args_parser()
+
+# the text-to-motion evaluation reads --motion_type vector_272 --version version1/t2m_60_300,
+# the tokenizer evaluation the --motion_type and --version it is trained with
+if args.dataname != 'motionmillion':
+    raise ValueError(f'Evaluation bundles are only built for motionmillion, not {args.dataname}')
+data_root = './dataset/MotionMillion'
+split_file = pjoin(data_root, 'split', args.version, args.split + '.txt')
+if args.eval_bundle_dir is None:
+    args.eval_bundle_dir = eval_bundle_dir(data_root, args.motion_type, args.version, args.split)
+
+if EvalBundle.exists(args.eval_bundle_dir):
+    print(f"The evaluation split has been bundled in {args.eval_bundle_dir} before!")
+else:
+    nb_motions = build_eval_bundle(args.eval_bundle_dir, pjoin(data_root, 'motion_data', args.motion_type), pjoin(data_root, args.text_type),
+                                   split_file, num_workers=args.num_workers)
+    print(f"{nb_motions} motions of {split_file} bundled into {args.eval_bundle_dir}")
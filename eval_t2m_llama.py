@@ -17,6 +17,7 @@ import warnings
 
 from models.lit_llama.model_hf import LLaMAHF, LLaMAHFConfig
 from transformers import T5EncoderModel, T5Tokenizer
+from accelerate import Accelerator
 from utils.quaternion import *
 
 warnings.filterwarnings('ignore')
@@ -35,9 +36,12 @@ logger.info(json.dumps(vars(args), indent=4, sort_keys=True))
 
 from utils.word_vectorizer import WordVectorizer
 w_vectorizer = WordVectorizer('./glove', 'our_vab')
-val_loader, val_mean, val_std = dataset_TM_eval_motionmillion.DATALoader(args.dataname, True, 32, w_vectorizer, split=args.split)
+val_loader, val_mean, val_std = dataset_TM_eval_motionmillion.DATALoader(args.dataname, True, 32, w_vectorizer, split=args.split, bundle_dir=args.eval_bundle_dir)
 
-comp_device = torch.device('cuda')
+# every process generates and embeds its own slice of the split (accelerate launch, also with --cpu / gloo)
+accelerator = Accelerator()
+comp_device = accelerator.device
+val_loader = accelerator.prepare(val_loader)
 
 eval_wrapper = EvaluatorModelWrapper272RPR(args, comp_device)
 
@@ -112,18 +116,24 @@ config.vocab_size = args.nb_code + 2
 config.clip_dim = args.clip_dim
 
 config.tie_weights = args.tie_weights
+if args.factorized_head is not None:
+    # one embedding table and one output head per FSQ level instead of nb_code + 2 rows
+    assert args.quantizer == 'FSQ', 'the factorized head needs FSQ codes'
+    config.factorized_head = args.factorized_head
+    config.fsq_levels = net.vqvae.quantizer._levels.tolist()
 print(config)
-trans_encoder = LLaMAHF(config) 
-
-ckpt = torch.load(args.resume_trans, map_location='cpu')
-
-# filter name
-ckpt = {k.replace('module.', ''): v for k, v in ckpt['trans'].items()}
-trans_encoder.load_state_dict(ckpt, strict=True)
-trans_encoder.eval()
-trans_encoder.to(comp_device)
+# built without initialisation and read lazily, an exported bf16 or GPTQ checkpoint is used as is
+trans_encoder = LLaMAHF.from_checkpoint(config, args.resume_trans, comp_device)
 print('Load transformer model successfully!')
 
+draft = None
+if args.resume_draft is not None:
+    # speculative decoding, the samples still follow the main model
+    draft = LLaMAHF.draft_from_checkpoint(args.draft_llama, args.resume_draft, config).to(comp_device)
+    # fails at load time rather than mid-run
+    trans_encoder.check_draft(draft)
+    print(f'Load draft model successfully!, from {args.resume_draft}')
+
 
 fid = []
 div = []
@@ -136,7 +146,7 @@ repeat_time = 1
 
         
 for i in range(repeat_time):
-    best_fid, best_iter, best_div, best_top1, best_top2, best_top3, best_matching, writer, logger = eval_trans.evaluation_transformer_motionmillion(args.out_dir, val_loader, net, trans_encoder, logger, writer, 0, best_fid=1000, best_iter=0, best_div=100, best_top1=0, best_top2=0, best_top3=0, best_matching=100, clip_model=clip_model, eval_wrapper=eval_wrapper, comp_device=comp_device, text_encode=args.text_encode, text_sum_way=args.text_sum_way, accelerator=None, draw=False, save=False, savegif=False)
+    best_fid, best_iter, best_div, best_top1, best_top2, best_top3, best_matching, writer, logger = eval_trans.evaluation_transformer_motionmillion(args.out_dir, val_loader, net, trans_encoder, logger, writer, 0, best_fid=1000, best_iter=0, best_div=100, best_top1=0, best_top2=0, best_top3=0, best_matching=100, clip_model=clip_model, eval_wrapper=eval_wrapper, comp_device=comp_device, text_encode=args.text_encode, text_sum_way=args.text_sum_way, accelerator=accelerator, draw=False, save=False, savegif=False, draft=draft, nb_draft_tokens=args.nb_draft_tokens)
     fid.append(best_fid)
     div.append(best_div)
     top1.append(best_top1)
@@ -144,24 +154,26 @@ for i in range(repeat_time):
     top3.append(best_top3)
     matching.append(best_matching)
 
-top1 = [t.item() for t in top1]
-top2 = [t.item() for t in top2]
-top3 = [t.item() for t in top3]
-matching = [m.item() for m in matching]
-
-print('final result:')
-print('fid: ', sum(fid)/repeat_time)
-print('div: ', sum(div)/repeat_time)
-print('top1: ', sum(top1)/repeat_time)
-print('top2: ', sum(top2)/repeat_time)
-print('top3: ', sum(top3)/repeat_time)
-print('matching: ', sum(matching)/repeat_time)
-
-fid = np.array(fid)
-div = np.array(div)
-top1 = np.array(top1)
-top2 = np.array(top2)
-top3 = np.array(top3)
-matching = np.array(matching)
-msg_final = f"FID. {np.mean(fid):.3f}, conf. {np.std(fid)*1.96/np.sqrt(repeat_time):.3f}, Diversity. {np.mean(div):.3f}, conf. {np.std(div)*1.96/np.sqrt(repeat_time):.3f}, TOP1. {np.mean(top1):.3f}, conf. {np.std(top1)*1.96/np.sqrt(repeat_time):.3f}, TOP2. {np.mean(top2):.3f}, conf. {np.std(top2)*1.96/np.sqrt(repeat_time):.3f}, TOP3. {np.mean(top3):.3f}, conf. {np.std(top3)*1.96/np.sqrt(repeat_time):.3f}, Matching. {np.mean(matching):.3f}, conf. {np.std(matching)*1.96/np.sqrt(repeat_time):.3f}"
-logger.info(msg_final)
\ No newline at end of file
+# the metrics are only complete on the main process
+if accelerator.is_main_process:
+    top1 = [t.item() for t in top1]
+    top2 = [t.item() for t in top2]
+    top3 = [t.item() for t in top3]
+    matching = [m.item() for m in matching]
+
+    print('final result:')
+    print('fid: ', sum(fid)/repeat_time)
+    print('div: ', sum(div)/repeat_time)
+    print('top1: ', sum(top1)/repeat_time)
+    print('top2: ', sum(top2)/repeat_time)
+    print('top3: ', sum(top3)/repeat_time)
+    print('matching: ', sum(matching)/repeat_time)
+
+    fid = np.array(fid)
+    div = np.array(div)
+    top1 = np.array(top1)
+    top2 = np.array(top2)
+    top3 = np.array(top3)
+    matching = np.array(matching)
+    msg_final = f"FID. {np.mean(fid):.3f}, conf. {np.std(fid)*1.96/np.sqrt(repeat_time):.3f}, Diversity. {np.mean(div):.3f}, conf. {np.std(div)*1.96/np.sqrt(repeat_time):.3f}, TOP1. {np.mean(top1):.3f}, conf. {np.std(top1)*1.96/np.sqrt(repeat_time):.3f}, TOP2. {np.mean(top2):.3f}, conf. {np.std(top2)*1.96/np.sqrt(repeat_time):.3f}, TOP3. {np.mean(top3):.3f}, conf. {np.std(top3)*1.96/np.sqrt(repeat_time):.3f}, Matching. {np.mean(matching):.3f}, conf. {np.std(matching)*1.96/np.sqrt(repeat_time):.3f}"
+    logger.info(msg_final)
\ No newline at end of file
@@ -0,0 +1,30 @@
+import os
+import torch
+
+import options.option_transformer as option_trans
+from models.lit_llama.utils import lazy_load, incremental_save
+
+
+if __name__ == '__main__':
+
+    args = option_trans.get_args_parser()
+    args.out_dir = os.path.join(args.out_dir, f'{args.exp_name}')
+    os.makedirs(args.out_dir, exist_ok = True)
+
+    # only the weights of the training checkpoint are read, one tensor at a time
+    ckpt = lazy_load(args.resume_trans)
+    out_path = os.path.join(args.out_dir, os.path.splitext(os.path.basename(args.resume_trans))[0] + '_bf16.pth')
+
+    with incremental_save(out_path) as saver:
+        state_dict = {}
+        for name, tensor in ckpt['trans'].items():
+            tensor = tensor._load_tensor()
+            # GPTQ scales and zeros stay float32, bf16 would change the dequantized weights
+            if tensor.is_floating_point() and not name.endswith(('.scales', '.zeros')):
+                tensor = tensor.to(torch.bfloat16)
+            state_dict[name.replace('module.', '')] = saver.store_early(tensor)
+        export = {'trans': state_dict, 'dtype': 'bfloat16'}
+        if 'quantization' in ckpt:
+            export['quantization'] = ckpt['quantization']
+        saver.save(export)
+    print(f'{len(state_dict)} bf16 weights of {args.resume_trans} exported to {out_path}, load them with LLaMAHF.from_checkpoint')
@@ -14,56 +14,16 @@ from visualize.smplx2joints import process, save_mesh, process_smplx_data
 import imageio
 import sys
 from utils.face_z_align_util import rotation_6d_to_matrix, matrix_to_axis_angle
+from utils.motion_process import recover_from_local_rotation, recover_from_local_rotation_batch
 from transformers import pipeline
 import re
 from tqdm import tqdm
 import moviepy.editor as mp
 import sys
-def rotations_matrix_to_smplx85(rotations_matrix, translation):
-    nfrm, njoint, _, _ = rotations_matrix.shape
-    axis_angle = matrix_to_axis_angle(torch.from_numpy(rotations_matrix)).numpy().reshape(nfrm, -1)
-    smplx_85 = np.concatenate([axis_angle, np.zeros((nfrm, 6)), translation, np.zeros((nfrm, 10))], axis=-1)
-    return smplx_85
-
-
 def inv_transform(data, mean, std):
     return data * std + mean
 
 
-def accumulate_rotations(relative_rotations):
-    # initialize the total rotation as the first relative rotation
-    R_total = [relative_rotations[0]]
-    # iterate over all relative rotations and accumulate them
-    for R_rel in relative_rotations[1:]:
-        R_total.append(np.matmul(R_rel, R_total[-1]))
-    
-    return np.array(R_total)
-
-
-# add hip height to translation when recoverring from rotation
-def recover_from_local_rotation(final_x, njoint):
-    nfrm, _ = final_x.shape
-    rotations_matrix = rotation_6d_to_matrix(torch.from_numpy(final_x[:,8+6*njoint:8+12*njoint]).reshape(nfrm, -1, 6)).numpy()
-    global_heading_diff_rot = final_x[:,2:8]
-    velocities_root_xy_no_heading = final_x[:,:2]
-    positions_no_heading = final_x[:, 8:8+3*njoint].reshape(nfrm, -1, 3)
-    height = positions_no_heading[:, 0, 1]
-
-    global_heading_rot = accumulate_rotations(rotation_6d_to_matrix(torch.from_numpy(global_heading_diff_rot)).numpy())
-    inv_global_heading_rot = np.transpose(global_heading_rot, (0, 2, 1))
-
-    rotations_matrix[:,0,...] = np.matmul(inv_global_heading_rot, rotations_matrix[:,0,...])
-
-    velocities_root_xyz_no_heading = np.zeros((velocities_root_xy_no_heading.shape[0], 3))
-    velocities_root_xyz_no_heading[:, 0] = velocities_root_xy_no_heading[:, 0]
-    velocities_root_xyz_no_heading[:, 2] = velocities_root_xy_no_heading[:, 1]
-    velocities_root_xyz_no_heading[1:, :] = np.matmul(inv_global_heading_rot[:-1], velocities_root_xyz_no_heading[1:, :,None]).squeeze(-1)
-    root_translation = np.cumsum(velocities_root_xyz_no_heading, axis=0)
-    root_translation[:, 1] = height
-    smplx_85 = rotations_matrix_to_smplx85(rotations_matrix, root_translation)
-    return smplx_85
-
-
 def smplx85_2_smplx322(smplx_no_shape_data):
     result = np.concatenate((smplx_no_shape_data[:,:66], np.zeros((smplx_no_shape_data.shape[0], 90)), np.zeros((smplx_no_shape_data.shape[0], 3)), np.zeros((smplx_no_shape_data.shape[0], 50)), np.zeros((smplx_no_shape_data.shape[0], 100)), smplx_no_shape_data[:,72:72+3], smplx_no_shape_data[:,75:]), axis=-1)
     return result
@@ -195,21 +155,31 @@ if __name__ == '__main__':
     config.clip_dim = args.clip_dim
 
     config.tie_weights = args.tie_weights
+    if args.factorized_head is not None:
+        # one embedding table and one output head per FSQ level instead of nb_code + 2 rows
+        assert args.quantizer == 'FSQ', 'the factorized head needs FSQ codes'
+        config.factorized_head = args.factorized_head
+        config.fsq_levels = net.vqvae.quantizer._levels.tolist()
     print(config)
-    trans_encoder = LLaMAHF(config)
-    
-    ckpt = torch.load(args.resume_trans, map_location='cpu')
-    ckpt = {k.replace('module.', ''): v for k, v in ckpt['trans'].items()}
-    trans_encoder.load_state_dict(ckpt, strict=True)
-    trans_encoder.eval()
-    trans_encoder.to(comp_device)
+    # built without initialisation and read lazily, an exported bf16 or GPTQ checkpoint is used as is
+    trans_encoder = LLaMAHF.from_checkpoint(config, args.resume_trans, comp_device)
     print(f'Load transformer model successfully!, from {args.resume_trans}')
 
+    draft = None
+    if args.resume_draft is not None:
+        # speculative decoding, the samples still follow the main model
+        draft = LLaMAHF.draft_from_checkpoint(args.draft_llama, args.resume_draft, config).to(comp_device)
+        # fails at load time rather than mid-run
+        trans_encoder.check_draft(draft)
+        print(f'Load draft model successfully!, from {args.resume_draft}')
+
     basic_root = os.path.join(args.out_dir, args.exp_name)
     os.makedirs(basic_root, exist_ok=True)
         
     input_text_list = open(args.infer_batch_prompt, 'r').readlines()
     
+    # collect (output_root, flag, text) for every caption first, so that they can be generated in batches
+    jobs = []
     for ori_input_text in tqdm(input_text_list):
         sub_dir_list = os.listdir(basic_root)
         sub_dir_list_prefix = [-1]
@@ -221,67 +191,82 @@ if __name__ == '__main__':
         if args.use_rewrite_model:
             try:
                 rewrite_text = call_llama_rewrite(pipe, ori_input_text)
-                input_text_list = [rewrite_text, ori_input_text]
+                text_list = [rewrite_text, ori_input_text]
                 print(f"Rewrite text is: {rewrite_text}")
             except Exception as e:
                 print(f"Error: {e}")
                 rewrite_text = ori_input_text
-                input_text_list = [ori_input_text]
+                text_list = [ori_input_text]
         else:
-            input_text_list = [ori_input_text]
+            text_list = [ori_input_text]
         
         flag = 0
-        for input_text in input_text_list:
+        for input_text in text_list:
             flag = 1-flag
-            
+            jobs.append((output_root, flag, input_text))
+
+    mean = np.load('dataset/MotionMillion/mean_std/vector_272/mean.npy')
+    std = np.load('dataset/MotionMillion/mean_std/vector_272/std.npy')
+
+    for start in tqdm(range(0, len(jobs), args.batch_size)):
+        batch_jobs = jobs[start:start + args.batch_size]
+        clip_text = [input_text.strip() for _, _, input_text in batch_jobs]
+        # load clip model
+        if args.text_encode == 'clip':
+            text = clip.tokenize(clip_text, truncate=True).to(comp_device)
+            feat_clip_text = clip_model.encode_text(text).float() # (bs, 512)
+            feat_clip_text = feat_clip_text.unsqueeze(1)
+            y_mask = torch.ones((feat_clip_text.shape[0], feat_clip_text.shape[1])).to(comp_device)
+            assert args.text_sum_way is None
+        elif args.text_encode == 'flan-t5-xxl':
+            tokenizer, text_encoder = clip_model
+            cap_inputs = tokenizer(clip_text, padding=True, truncation=True, return_tensors="pt")
+            y_mask = cap_inputs.attention_mask.to(device=comp_device)
+            feat_clip_text = text_encoder(
+                input_ids=cap_inputs.input_ids.to(comp_device), 
+                attention_mask=cap_inputs.attention_mask.to(comp_device), output_hidden_states=False
+            ).last_hidden_state
+        elif args.text_encode == 'flan-t5-xl':
+            tokenizer, text_encoder = clip_model
+            cap_inputs = tokenizer(clip_text, padding=True, truncation=True, return_tensors="pt")
+            y_mask = cap_inputs.attention_mask.to(device=comp_device)
+            feat_clip_text = text_encoder(
+                input_ids=cap_inputs.input_ids.to(comp_device), 
+                attention_mask=cap_inputs.attention_mask.to(comp_device), output_hidden_states=False
+            ).last_hidden_state #(bs, word_nb, 2048)
+        else: 
+            raise NotImplementedError
+
+        if feat_clip_text.shape[1] > 150:
+            feat_clip_text = feat_clip_text[:, :150, :]
+            y_mask = y_mask[:, :150]
+
+        if args.text_sum_way == 'cls':
+            feat_clip_text = feat_clip_text[:, 0, :]
+        elif args.text_sum_way == 'mean':
+            feat_clip_text = (feat_clip_text * y_mask.unsqueeze(-1)).sum(dim=1) / y_mask.sum(dim=1, keepdim=True)
+        elif args.text_sum_way == 'sum':
+            feat_clip_text = (feat_clip_text * y_mask.unsqueeze(-1)).sum(dim=1)
+
+        index_motion_batch, nb_tokens = trans_encoder.sample_batch(feat_clip_text, y_mask, if_categorial=False, draft=draft, nb_draft_tokens=args.nb_draft_tokens)
+
+        print(f"Memory used: {torch.cuda.max_memory_reserved() / 1e9:.02f} GB", file=sys.stderr)
+
+        # a prompt that ends right away decodes the single code 1, as in LLaMAHF.sample
+        if index_motion_batch.shape[1] == 0:
+            index_motion_batch = torch.zeros((index_motion_batch.shape[0], 1), dtype=torch.long, device=comp_device)
+        index_motion_batch[nb_tokens == 0, 0] = 1
+        code_lengths = nb_tokens.clamp(min=1)
+
+        pred_pose_batch, frame_lengths, _ = net.forward_decoder_batch(index_motion_batch, code_lengths)
+        pred_pose_batch = inv_transform(pred_pose_batch.detach().cpu().numpy(), mean, std)
+        smplx_85_batch = recover_from_local_rotation_batch(torch.from_numpy(pred_pose_batch), 22, frame_lengths.cpu()).numpy()
+
+        for (output_root, flag, input_text), index_motion, code_length, pred_pose, smplx_85, frame_length in zip(batch_jobs, index_motion_batch, code_lengths.tolist(), pred_pose_batch, smplx_85_batch, frame_lengths.tolist()):
             clip_text = input_text.strip()
-            # load clip model
-            if args.text_encode == 'clip':
-                text = clip.tokenize(clip_text, truncate=True).to(comp_device)
-                feat_clip_text = clip_model.encode_text(text).float() # (bs, 512)
-                feat_clip_text = feat_clip_text.unsqueeze(1)
-                y_mask = torch.ones((feat_clip_text.shape[0], feat_clip_text.shape[1])).to(comp_device)
-                assert args.text_sum_way is None
-            elif args.text_encode == 'flan-t5-xxl':
-                tokenizer, text_encoder = clip_model
-                cap_inputs = tokenizer(clip_text, padding=True, truncation=True, return_tensors="pt")
-                y_mask = cap_inputs.attention_mask.to(device=comp_device)
-                feat_clip_text = text_encoder(
-                    input_ids=cap_inputs.input_ids.to(comp_device), 
-                    attention_mask=cap_inputs.attention_mask.to(comp_device), output_hidden_states=False
-                ).last_hidden_state
-            elif args.text_encode == 'flan-t5-xl':
-                tokenizer, text_encoder = clip_model
-                cap_inputs = tokenizer(clip_text, padding=True, truncation=True, return_tensors="pt")
-                y_mask = cap_inputs.attention_mask.to(device=comp_device)
-                feat_clip_text = text_encoder(
-                    input_ids=cap_inputs.input_ids.to(comp_device), 
-                    attention_mask=cap_inputs.attention_mask.to(comp_device), output_hidden_states=False
-                ).last_hidden_state #(bs, word_nb, 2048)
-            else: 
-                raise NotImplementedError
-
-            if feat_clip_text.shape[1] > 150:
-                feat_clip_text = feat_clip_text[:, :150, :]
-                y_mask = y_mask[:, :150]
+            print(index_motion[None, :code_length])
 
-            if args.text_sum_way == 'cls':
-                feat_clip_text = feat_clip_text[:, 0, :]
-            elif args.text_sum_way == 'mean':
-                feat_clip_text = (feat_clip_text * y_mask.unsqueeze(-1)).sum(dim=1) / y_mask.sum(dim=1, keepdim=True)
-            elif args.text_sum_way == 'sum':
-                feat_clip_text = (feat_clip_text * y_mask.unsqueeze(-1)).sum(dim=1)
-
-            index_motion = trans_encoder.sample(feat_clip_text, y_mask, if_categorial=False)
-            print(index_motion)
-
-            print(f"Memory used: {torch.cuda.max_memory_reserved() / 1e9:.02f} GB", file=sys.stderr)
-            pred_pose = net.forward_decoder(index_motion)
-
-            mean = np.load('dataset/MotionMillion/mean_std/vector_272/mean.npy')
-            std = np.load('dataset/MotionMillion/mean_std/vector_272/std.npy')
-
-            pred_pose = inv_transform(pred_pose.detach().cpu().numpy(), mean, std)
+            pred_pose = pred_pose[None, :frame_length]
             
             np.save(f'{output_root}/{flag}_predict.npy', pred_pose[0])
             with open(f'{output_root}/{flag}_text.txt', 'w') as f:
@@ -290,17 +275,8 @@ if __name__ == '__main__':
             print('save pose!')
             short_name = clip_text[:50].strip() + '...' if len(clip_text) > 50 else clip_text
             
-            positions_with_heading = recover_from_local_rotation(pred_pose.squeeze(), 22)
+            positions_with_heading = smplx_85[:frame_length]
             output_path = os.path.join(output_root, f'{flag}_{short_name}.gif')
             visualize_smplx_85(positions_with_heading, title=short_name, output_path=output_path, fps=args.fps)
             
             print("Inference done!")
-
-
-
-
-
-
-    
-
-    
@@ -13,19 +13,12 @@ from visualize.smplx2joints import process_smplx_data
 
 import imageio
 from utils.face_z_align_util import rotation_6d_to_matrix, matrix_to_axis_angle
+from utils.motion_process import recover_from_local_rotation
 from transformers import pipeline
 import re
 import moviepy.editor as mp
 import sys
 
-def rotations_matrix_to_smplx85(rotations_matrix, translation):
-    
-    nfrm, njoint, _, _ = rotations_matrix.shape
-    axis_angle = matrix_to_axis_angle(torch.from_numpy(rotations_matrix)).numpy().reshape(nfrm, -1)
-    
-    smplx_85 = np.concatenate([axis_angle, np.zeros((nfrm, 6)), translation, np.zeros((nfrm, 10))], axis=-1)
-    return smplx_85
-
 def inv_transform(data, mean, std):
     return data * std + mean
 
@@ -69,77 +62,6 @@ def recover_from_ric(data, joints_num):
     return positions
 
 
-def accumulate_rotations(relative_rotations):
-    R_total = [relative_rotations[0]]
-    
-    for R_rel in relative_rotations[1:]:
-        R_total.append(np.matmul(R_rel, R_total[-1]))
-    
-    return np.array(R_total)
-
-def recover_from_local_position(final_x, njoint):
-    # take positions_no_heading: local position on xz ori, no heading
-    # velocities_root_xy_no_heading: to recover translation
-    # global_heading_diff_rot: to recover root rotation
-    
-    nfrm, _ = final_x.shape
-    positions_no_heading = final_x[:,8:8+3*njoint].reshape(nfrm, -1, 3) # frames, njoints * 3
-    velocities_root_xy_no_heading = final_x[:,:2] # frames, 2
-    global_heading_diff_rot = final_x[:,2:8] # frames, 6
-
-    # recover global heading
-    global_heading_rot = accumulate_rotations(rotation_6d_to_matrix(torch.from_numpy(global_heading_diff_rot)).numpy())
-    inv_global_heading_rot = np.transpose(global_heading_rot, (0, 2, 1))
-    # add global heading to position
-    positions_with_heading = np.matmul(np.repeat(inv_global_heading_rot[:, None,:, :], njoint, axis=1), positions_no_heading[...,None]).squeeze(-1)
-
-    # recover root translation
-    # add heading to velocities_root_xy_no_heading
-
-    velocities_root_xyz_no_heading = np.zeros((velocities_root_xy_no_heading.shape[0], 3))
-    velocities_root_xyz_no_heading[:, 0] = velocities_root_xy_no_heading[:, 0]
-    velocities_root_xyz_no_heading[:, 2] = velocities_root_xy_no_heading[:, 1]
-    velocities_root_xyz_no_heading[1:, :] = np.matmul(inv_global_heading_rot[:-1], velocities_root_xyz_no_heading[1:, :,None]).squeeze(-1)
-
-    root_translation = np.cumsum(velocities_root_xyz_no_heading, axis=0)
-
-
-    # add root translation
-    positions_with_heading[:, :, 0] += root_translation[:, 0:1]
-    positions_with_heading[:, :, 2] += root_translation[:, 2:]
-
-    return positions_with_heading
-
-# add hip height to translation when recoverring from rotation
-def recover_from_local_rotation(final_x, njoint):
-    # take rotations_matrix: 
-
-    nfrm, _ = final_x.shape
-    
-    rotations_matrix = rotation_6d_to_matrix(torch.from_numpy(final_x[:,8+6*njoint:8+12*njoint]).reshape(nfrm, -1, 6)).numpy()
-    global_heading_diff_rot = final_x[:,2:8]
-    velocities_root_xy_no_heading = final_x[:,:2]
-    positions_no_heading = final_x[:, 8:8+3*njoint].reshape(nfrm, -1, 3)
-    height = positions_no_heading[:, 0, 1]
-
-    global_heading_rot = accumulate_rotations(rotation_6d_to_matrix(torch.from_numpy(global_heading_diff_rot)).numpy())
-    inv_global_heading_rot = np.transpose(global_heading_rot, (0, 2, 1))
-    # recover root rotation
-
-    rotations_matrix[:,0,...] = np.matmul(inv_global_heading_rot, rotations_matrix[:,0,...])
-
-    velocities_root_xyz_no_heading = np.zeros((velocities_root_xy_no_heading.shape[0], 3))
-    velocities_root_xyz_no_heading[:, 0] = velocities_root_xy_no_heading[:, 0]
-    velocities_root_xyz_no_heading[:, 2] = velocities_root_xy_no_heading[:, 1]
-    velocities_root_xyz_no_heading[1:, :] = np.matmul(inv_global_heading_rot[:-1], velocities_root_xyz_no_heading[1:, :,None]).squeeze(-1)
-    
-    root_translation = np.cumsum(velocities_root_xyz_no_heading, axis=0)
-    root_translation[:, 1] = height
-    
-    smplx_85 = rotations_matrix_to_smplx85(rotations_matrix, root_translation)
-    return smplx_85
-
-
 def smplx85_2_smplx322(smplx_no_shape_data):
     result = np.concatenate((smplx_no_shape_data[:,:66], np.zeros((smplx_no_shape_data.shape[0], 90)), np.zeros((smplx_no_shape_data.shape[0], 3)), np.zeros((smplx_no_shape_data.shape[0], 50)), np.zeros((smplx_no_shape_data.shape[0], 100)), smplx_no_shape_data[:,72:72+3], smplx_no_shape_data[:,75:]), axis=-1)
     
@@ -273,16 +195,24 @@ if __name__ == '__main__':
     config.clip_dim = args.clip_dim
 
     config.tie_weights = args.tie_weights
+    if args.factorized_head is not None:
+        # one embedding table and one output head per FSQ level instead of nb_code + 2 rows
+        assert args.quantizer == 'FSQ', 'the factorized head needs FSQ codes'
+        config.factorized_head = args.factorized_head
+        config.fsq_levels = net.vqvae.quantizer._levels.tolist()
     print(config)
-    trans_encoder = LLaMAHF(config)
-    
-    ckpt = torch.load(args.resume_trans, map_location='cpu')
-    ckpt = {k.replace('module.', ''): v for k, v in ckpt['trans'].items()}
-    trans_encoder.load_state_dict(ckpt, strict=True)
-    trans_encoder.eval()
-    trans_encoder.to(comp_device)
+    # built without initialisation and read lazily, an exported bf16 or GPTQ checkpoint is used as is
+    trans_encoder = LLaMAHF.from_checkpoint(config, args.resume_trans, comp_device)
     print('Load transformer model successfully!')
 
+    draft = None
+    if args.resume_draft is not None:
+        # speculative decoding, the samples still follow the main model
+        draft = LLaMAHF.draft_from_checkpoint(args.draft_llama, args.resume_draft, config).to(comp_device)
+        # fails at load time rather than mid-run
+        trans_encoder.check_draft(draft)
+        print(f'Load draft model successfully!, from {args.resume_draft}')
+
     basic_root = os.path.join(args.out_dir, args.exp_name)
     os.makedirs(basic_root, exist_ok=True)
     
@@ -346,7 +276,7 @@ if __name__ == '__main__':
             elif args.text_sum_way == 'sum':
                 feat_clip_text = (feat_clip_text * y_mask.unsqueeze(-1)).sum(dim=1)
 
-            index_motion = trans_encoder.sample(feat_clip_text, y_mask, if_categorial=False)
+            index_motion = trans_encoder.sample(feat_clip_text, y_mask, if_categorial=False, draft=draft, nb_draft_tokens=args.nb_draft_tokens)
             print(index_motion)
 
             print(f"Memory used: {torch.cuda.max_memory_reserved() / 1e9:.02f} GB", file=sys.stderr)
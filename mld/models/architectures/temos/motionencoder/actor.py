@@ -55,8 +55,9 @@ class ActorAgnosticEncoder(pl.LightningModule):
 
         device = features.device
 
+        # the mask follows the padded length of the batch, which can be shorter than max_len
         bs, nframes, nfeats = features.shape
-        mask = self.lengths_to_mask(lengths, self.max_len).to(device)
+        mask = self.lengths_to_mask(torch.as_tensor(lengths, device=device), nframes)
 
         x = features
         # Embed each human poses into latent vectors
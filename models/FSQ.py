@@ -62,7 +62,8 @@ class FSQ(Module):
         channel_first: bool = False,
         projection_has_bias: bool = True,
         return_indices = True,
-        force_quantization_f32 = True
+        force_quantization_f32 = True,
+        track_usage = False
     ):
         super().__init__()
         _levels = torch.tensor(levels, dtype=int32)
@@ -103,6 +104,11 @@ class FSQ(Module):
         self.allowed_dtypes = allowed_dtypes
         self.force_quantization_f32 = force_quantization_f32
 
+        # optional running histogram of the codes used in training steps, not part of the checkpoint
+        self.track_usage = track_usage
+        if track_usage:
+            self.register_buffer("code_usage", torch.zeros(self.codebook_size, dtype=torch.long), persistent = False)
+
     def bound(self, z, eps: float = 1e-3):
         """ Bound `z`, an array of shape (..., d). """
         half_l = (self._levels - 1) * (1 + eps) / 2
@@ -161,15 +167,28 @@ class FSQ(Module):
     
     @torch.no_grad()
     def compute_perplexity(self, code_idx) :
-        # Calculate new centres
-        code_onehot = torch.zeros(self.codebook_size, code_idx.shape[0], device=code_idx.device)  # nb_code, N * L
-        code_onehot.scatter_(0, code_idx.view(1, code_idx.shape[0]), 1)
-
-        code_count = code_onehot.sum(dim=-1)  # codebook_size
+        code_count = torch.bincount(code_idx, minlength=self.codebook_size)  # codebook_size
+        if self.track_usage and self.training:
+            self.code_usage += code_count
+        code_count = code_count.float()
         prob = code_count / torch.sum(code_count)  
         perplexity = torch.exp(-torch.sum(prob * torch.log(prob + 1e-7)))
         activate = torch.sum(code_count > 0).float() / self.codebook_size
         return perplexity, activate 
+
+    @torch.no_grad()
+    def usage(self, accelerator = None, reset = False):
+        """ Running code histogram summed over all processes, with its perplexity and activation. """
+        assert self.track_usage, 'FSQ was built without track_usage'
+        code_usage = self.code_usage.clone()
+        if exists(accelerator):
+            code_usage = accelerator.reduce(code_usage, reduction = "sum")
+        if reset:
+            self.code_usage.zero_()
+        prob = code_usage.float() / code_usage.sum().clamp(min = 1)
+        perplexity = torch.exp(-torch.sum(prob * torch.log(prob + 1e-7)))
+        activate = torch.sum(code_usage > 0).float() / self.codebook_size
+        return code_usage, perplexity.item(), activate.item()
     
     def dequantize(self, indices):
         codes = self._indices_to_codes(indices)
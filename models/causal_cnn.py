@@ -1,11 +1,26 @@
 import torch
 import torch.nn as nn
-from models.resnet import CausalResnet1D
+from models.resnet import CausalResnet1D, stream_left_context
 from models.modules import Patcher1D, UnPatcher1D
 
 
     
     
+def stream_step(module, x):
+    """Runs `module` on the next frames of a stream, its causal layers carry their left context.
+
+    Layers without a `step` are applied as is, they only look at the current frame
+    (activations, norms over channels, nearest upsampling, unpatching).
+    """
+    if hasattr(module, 'step'):
+        return module.step(x)
+    if isinstance(module, nn.Sequential):
+        for m in module:
+            x = stream_step(m, x)
+        return x
+    return module(x)
+
+
 class CausalConv1d(nn.Module):
     def __init__(self, in_channels, out_channels, kernel_size, stride=1, dilation=1):
         super(CausalConv1d, self).__init__()
@@ -18,11 +33,20 @@ class CausalConv1d(nn.Module):
             padding=0,  
             dilation=dilation
         )
+        # last `pad` input frames of a stream, see `step`
+        self.stream_cache = None
 
-    def forward(self, x):
+    def forward(self, x, stream=False):
         # x的尺寸为 (batch_size, channels, sequence_length)
-        x = nn.functional.pad(x, (self.pad, 0))
+        if stream:
+            assert self.conv.stride[0] == 1, 'only stride 1 convolutions can be streamed'
+            x = stream_left_context(self, x, self.pad)
+        else:
+            x = nn.functional.pad(x, (self.pad, 0))
         return self.conv(x)
+
+    def step(self, x):
+        return self.forward(x, stream=True)
     
 
 
@@ -48,8 +72,13 @@ class CausalAttention1D(nn.Module):
         self.k = CausalConv1d(in_channels, in_channels, kernel_size=1, stride=1)
         self.v = CausalConv1d(in_channels, in_channels, kernel_size=1, stride=1)
         self.proj_out = CausalConv1d(in_channels, in_channels, kernel_size=1, stride=1)
+        # keys and values of all the frames of a stream, see `step`
+        self.stream_cache = None
 
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
+    def step(self, x: torch.Tensor) -> torch.Tensor:
+        return self.forward(x, stream=True)
+
+    def forward(self, x: torch.Tensor, stream=False) -> torch.Tensor:
         h_ = x
         if self.norm == "LN":
             h_ = self.norm1(h_.transpose(-2, -1)).transpose(-2, -1)
@@ -72,11 +101,18 @@ class CausalAttention1D(nn.Module):
         k = k.permute(0, 2, 1)  # (b, t, c)
         v = v.permute(0, 2, 1)  # (b, t, c)
 
-        w_ = torch.bmm(q, k.permute(0, 2, 1))  # (b, t, t)
+        if stream:
+            # the new frames also attend to every earlier frame of the stream
+            if self.stream_cache is not None:
+                k = torch.cat([self.stream_cache[0], k], dim=1)
+                v = torch.cat([self.stream_cache[1], v], dim=1)
+            self.stream_cache = (k, v)
+
+        w_ = torch.bmm(q, k.permute(0, 2, 1))  # (b, t, t_k)
         w_ = w_ * (int(c) ** (-0.5))
 
-        # Apply causal mask
-        mask = torch.tril(torch.ones_like(w_))
+        # Apply causal mask, query i is frame t_k - t + i
+        mask = torch.tril(torch.ones_like(w_), diagonal=k.shape[1] - t)
         w_ = w_.masked_fill(mask == 0, float("-inf"))
         w_ = torch.nn.functional.softmax(w_, dim=2)
 
@@ -231,3 +267,18 @@ class CausalDecoder(nn.Module):
 
     def forward(self, x):
         return self.model(x)
+
+    def reset_stream(self):
+        assert not any(isinstance(m, nn.GroupNorm) for m in self.modules()), 'GroupNorm normalizes over time and cannot be streamed'
+        for m in self.modules():
+            if hasattr(m, 'stream_cache'):
+                m.stream_cache = None
+
+    def forward_stream(self, x):
+        """Decodes the next code features x (b, c, t) of a stream started by `reset_stream`.
+
+        Returns only the frames of the new codes; concatenated over the calls they equal `forward`
+        on the whole sequence. The convolution caches have a fixed size, only the attention
+        history (use_attn) grows with the stream.
+        """
+        return stream_step(self.model, x)
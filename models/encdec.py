@@ -1,4 +1,7 @@
+import torch
 import torch.nn as nn
+import math
+from fractions import Fraction
 from models.resnet import Resnet1D
 from models.modules import Patcher1D, UnPatcher1D
 # class Encoder(nn.Module):
@@ -173,4 +176,38 @@ class Decoder(nn.Module):
 
     def forward(self, x):
         return self.model(x)
+
+    def receptive_field(self):
+        """Number of codes on each side of its own code that an output frame depends on.
+
+        Every convolution adds dilation * (kernel_size - 1) // 2 frames at its rate, i.e. that
+        many frames over the upsampling done before it in codes; the other layers are per frame.
+        """
+        assert not any(isinstance(m, nn.GroupNorm) for m in self.model.modules()), 'GroupNorm normalizes over the whole sequence'
+        radius, scale = Fraction(0), 1
+        for m in self.model.modules():
+            if isinstance(m, nn.Conv1d):
+                radius += Fraction(m.dilation[0] * (m.kernel_size[0] - 1) // 2, scale)
+            elif isinstance(m, nn.Upsample):
+                scale *= int(m.scale_factor)
+        return math.ceil(radius)
+
+    def iter_chunks(self, x, chunk_size=64, context=None):
+        """Decodes x (b, c, T) window by window and yields the frames of consecutive code chunks.
+
+        Each chunk of `chunk_size` codes is decoded with `context` codes of overlap on both sides,
+        the receptive field by default, which makes the stitched frames equal to `forward`.
+        """
+        if context is None:
+            context = self.receptive_field()
+        T = x.shape[-1]
+        for start in range(0, T, chunk_size):
+            end = min(start + chunk_size, T)
+            lo, hi = max(0, start - context), min(T, end + context)
+            out = self.model(x[..., lo:hi])
+            frames_per_code = out.shape[-1] // (hi - lo)
+            yield out[..., (start - lo) * frames_per_code:(end - lo) * frames_per_code]
+
+    def forward_chunked(self, x, chunk_size=64, context=None):
+        return torch.cat(list(self.iter_chunks(x, chunk_size, context)), dim=-1)
     
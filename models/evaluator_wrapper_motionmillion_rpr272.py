@@ -1,11 +1,13 @@
 
+import os
+import hashlib
 import torch
 from os.path import join as pjoin
 import numpy as np
 
 class EvaluatorModelWrapper272RPR(object):
 
-    def __init__(self, args, device):
+    def __init__(self, args, device, ckpt_path='./checkpoints/evaluator/epoch=199.ckpt'):
 
         from mld.models.architectures.temos.textencoder.distillbert_actor import DistilbertActorAgnosticEncoder
         from mld.models.architectures.temos.motionencoder.actor import ActorAgnosticEncoder
@@ -16,7 +18,8 @@ class EvaluatorModelWrapper272RPR(object):
         self.motionencoder = ActorAgnosticEncoder(nfeats=272, vae = True, num_layers=4, max_len=300, latent_dim=512)
         self.device = device
                 
-        ckpt = torch.load('./checkpoints/evaluator/epoch=199.ckpt', map_location='cpu')
+        self.ckpt_path = ckpt_path
+        ckpt = torch.load(ckpt_path, map_location='cpu')
         
         # load textencoder
         textencoder_ckpt = {}
@@ -46,20 +49,114 @@ class EvaluatorModelWrapper272RPR(object):
         self.mean = np.load(pjoin(self.data_root, 'mean_std', 'vector_272', 'mean.npy'))
         self.std = np.load(pjoin(self.data_root, 'mean_std', 'vector_272', 'std.npy'))
 
+        # ground-truth embeddings of a validation split, see load_gt_cache
+        self.gt_cache_dir = getattr(args, 'eval_cache_dir', None) or pjoin(self.data_root, 'eval_cache')
+        self.gt_cache = None
+
     def normalize_motion(self, motions):
         with torch.no_grad():
             motions = (motions - torch.from_numpy(self.mean).to(self.device)) / torch.from_numpy(self.std).to(self.device)
         return motions
     
+    def crop_to_longest(self, motions, m_lens):
+        # the motion encoder only runs over the longest motion of the batch, not the dataset padding,
+        # its attention masks the frames past each length so the embeddings are unchanged
+        m_lens = torch.as_tensor(m_lens)
+        return motions[:, :int(m_lens.max())], m_lens
+
     def get_co_embeddings(self, texts, motions, m_lens):
         with torch.no_grad():
             et = self.textencoder(texts).loc
+            motions, m_lens = self.crop_to_longest(motions, m_lens)
             motions = self.normalize_motion(motions)
             em = self.motionencoder(motions.float(), m_lens).loc
         return et, em
 
     def get_motion_embeddings(self, motions, m_lens):
         with torch.no_grad():
+            motions, m_lens = self.crop_to_longest(motions, m_lens)
             motions = self.normalize_motion(motions)
-            em = self.motionencoder(motions, m_lens).loc
+            em = self.motionencoder(motions.float(), m_lens).loc
         return em
+
+    def gt_cache_key(self, dataset):
+        # the split is identified by its motions, lengths and captions, the evaluator by its checkpoint file
+        stat = os.stat(self.ckpt_path)
+        key = hashlib.blake2b(digest_size=8)
+        key.update(f'{os.path.abspath(self.ckpt_path)}:{stat.st_size}:{stat.st_mtime_ns}:{dataset.unit_length}\n'.encode('utf-8'))
+        for name in dataset.name_list[dataset.pointer:]:
+            data = dataset.data_dict[name]
+            key.update(f'{name}:{data["length"]}:'.encode('utf-8'))
+            key.update('\t'.join(text['caption'] for text in data['text']).encode('utf-8'))
+        return key.hexdigest()
+
+    @torch.no_grad()
+    def compute_gt_cache(self, dataset, batch_size=64):
+        """Embeds every motion of a `Text2MotionDataset` split and every one of its captions.
+
+        Each motion is embedded once, cropped from its first frame to a multiple of
+        unit_length, so the embeddings and the FID statistics do not depend on the random
+        crops of an evaluation round. Motions are batched in length order and padded to the
+        longest of their batch only.
+        """
+        names = sorted(dataset.name_list[dataset.pointer:], key=lambda name: dataset.data_dict[name]['length'])
+        motion_emb = []
+        for start in range(0, len(names), batch_size):
+            batch_names = names[start:start + batch_size]
+            lengths = [dataset.data_dict[name]['length'] // dataset.unit_length * dataset.unit_length for name in batch_names]
+            motions = np.zeros((len(batch_names), max(lengths), self.mean.shape[0]), dtype=np.float32)
+            for i, (name, length) in enumerate(zip(batch_names, lengths)):
+                motions[i, :length] = dataset.data_dict[name]['motion'][:length]
+            em = self.get_motion_embeddings(torch.from_numpy(motions).to(self.device), torch.tensor(lengths))
+            motion_emb.append(em.cpu())
+        motion_emb = torch.cat(motion_emb).numpy()
+
+        captions = sorted({text['caption'] for name in names for text in dataset.data_dict[name]['text']})
+        text_emb = []
+        for start in range(0, len(captions), batch_size):
+            text_emb.append(self.textencoder(captions[start:start + batch_size]).loc.cpu())
+        text_emb = torch.cat(text_emb).numpy()
+
+        return {'names': np.array(names), 'motion_emb': motion_emb,
+                'captions': np.array(captions), 'text_emb': text_emb,
+                'mu': np.mean(motion_emb, axis=0), 'cov': np.cov(motion_emb, rowvar=False)}
+
+    def load_gt_cache(self, dataset, accelerator=None):
+        """Loads the ground-truth embeddings and FID statistics of a split, computing them on first use.
+
+        They are saved in `gt_cache_dir` under a key of the split and of the evaluator checkpoint,
+        so later evaluation rounds, repeats and runs only embed the generated motions.
+        """
+        key = self.gt_cache_key(dataset)
+        if self.gt_cache is not None and self.gt_cache['key'] == key:
+            return self.gt_cache
+
+        path = pjoin(self.gt_cache_dir, f'gt_{key}.npz')
+        if not os.path.exists(path) and (accelerator is None or accelerator.is_main_process):
+            cache = self.compute_gt_cache(dataset)
+            os.makedirs(self.gt_cache_dir, exist_ok=True)
+            np.savez(pjoin(self.gt_cache_dir, f'gt_{key}.tmp.npz'), **cache)
+            os.replace(pjoin(self.gt_cache_dir, f'gt_{key}.tmp.npz'), path)
+        if accelerator is not None:
+            accelerator.wait_for_everyone()
+
+        cache = np.load(path)
+        self.gt_cache = {
+            'key': key,
+            'name_to_idx': {name: i for i, name in enumerate(cache['names'].tolist())},
+            'caption_to_idx': {caption: i for i, caption in enumerate(cache['captions'].tolist())},
+            'motion_emb': torch.from_numpy(cache['motion_emb']).to(self.device),
+            'text_emb': torch.from_numpy(cache['text_emb']).to(self.device),
+            'mu': cache['mu'],
+            'cov': cache['cov'],
+        }
+        return self.gt_cache
+
+    def get_gt_embeddings(self, names, captions):
+        # cached text and ground-truth motion embeddings of a validation batch
+        et = self.gt_cache['text_emb'][[self.gt_cache['caption_to_idx'][caption] for caption in captions]]
+        em = self.gt_cache['motion_emb'][[self.gt_cache['name_to_idx'][name] for name in names]]
+        return et, em
+
+    def get_gt_statistics(self):
+        return self.gt_cache['mu'], self.gt_cache['cov']
@@ -10,11 +10,14 @@ import torch
 import torch.nn as nn
 from torch.nn import functional as F
 from typing_extensions import Self
-from typing import Optional
+from typing import Optional, Union
 from transformers.modeling_utils import PreTrainedModel
 from torch.distributions import Categorical
+from torch.utils.checkpoint import checkpoint
 import torch.nn.functional as F
 import numpy as np
+from .utils import EmptyInitOnDevice, lazy_load
+from .quantization import replace_with_quantized_linear_
 
 @dataclass
 class LLaMAHFConfig:
@@ -23,6 +26,10 @@ class LLaMAHFConfig:
     n_layer: int = 32
     n_head: int = 32
     n_embd: int = 4096
+    # FSQ levels of the motion codes and 'causal' / 'joint' for the factorized token interface,
+    # see FactorizedEmbedding and FactorizedHead; None keeps the vocab_size-way wte and lm_head
+    fsq_levels: Optional[list] = None
+    factorized_head: Optional[str] = None
     @classmethod
     def from_name(cls, name: str) -> Self:
         return cls(**llama_configs[name])
@@ -51,10 +58,17 @@ class LLaMAHF(nn.Module):
         assert config.block_size is not None
         self.config = config
 
-        self.lm_head = nn.Linear(config.n_embd, config.vocab_size-1, bias=False)
+        if config.factorized_head is not None:
+            assert int(np.prod(config.fsq_levels)) + 2 == config.vocab_size, 'the factorized interface needs the nb_code + 2 FSQ vocabulary'
+            assert not config.tie_weights, 'the factorized head cannot be tied to the input embeddings'
+            self.lm_head = FactorizedHead(config.fsq_levels, config.n_embd, config.factorized_head)
+            wte = FactorizedEmbedding(config.fsq_levels, config.n_embd)
+        else:
+            self.lm_head = nn.Linear(config.n_embd, config.vocab_size-1, bias=False)
+            wte = nn.Embedding(config.vocab_size, config.n_embd)
         self.transformer = nn.ModuleDict(
             dict(
-                wte=nn.Embedding(config.vocab_size, config.n_embd),
+                wte=wte,
                 h=nn.ModuleList([Block(config) for _ in range(config.n_layer)]),
                 ln_f=RMSNorm(config.n_embd),
             )
@@ -99,46 +113,194 @@ class LLaMAHF(nn.Module):
         elif isinstance(module, nn.Embedding):
             torch.nn.init.normal_(module.weight, mean=0.0, std=0.02 / math.sqrt(2 * self.config.n_layer))
             
+    def reset_cache(self) -> None:
+        for block in self.transformer.h:
+            block.attn.kv_cache = None
+
     @torch.no_grad()
-    def sample(self, clip_feature, y_mask, if_categorial=False):
-        for k in range(51):
-            if k == 0:
-                x = []
-            else:
-                x = xs
-            logits = self.forward_sample(x, clip_feature, y_mask)
-            logits = logits[:, -1, :]
-            probs = F.softmax(logits, dim=-1)
-            if if_categorial:
-                dist = Categorical(probs)
-                idx = dist.sample()
-                if idx == self.config.vocab_size -2:
-                    break
-                idx = idx.unsqueeze(-1)
-            else:
-                _, idx = torch.topk(probs, k=1, dim=-1)
+    def sample(self, clip_feature, y_mask, if_categorial=False, draft=None, nb_draft_tokens=4):
+        xs, nb_tokens = self.sample_batch(clip_feature[:1], y_mask[:1], if_categorial, draft=draft, nb_draft_tokens=nb_draft_tokens)
+        nb_tokens = int(nb_tokens[0])
 
-                if idx[0] == self.config.vocab_size - 2:
-                    break
+        if nb_tokens == 0:
+            return torch.ones(1,1).to(clip_feature.device).long()
+        else:
+            return xs[:, :nb_tokens]
+
+    def prefill(self, clip_feature, y_mask):
+        """Fills the caches with the right padded text prefixes.
 
-            # append to the sequence and continue
-            if k == 0:
-                xs = idx
+        Returns the final hidden state of the last text position of each row, which predicts its first
+        token, and the text lengths, the position of that first token.
+        """
+        text_lengths = y_mask.sum(dim=1).long()
+        batch_idx = torch.arange(clip_feature.shape[0], device=clip_feature.device)
+        self.reset_cache()
+        x = self.llama_proj(clip_feature[:, :int(text_lengths.max()), :].to(self.llama_proj.weight.dtype))
+        return self.forward_cached(x, y_mask, 0)[batch_idx, text_lengths - 1], text_lengths
+
+    @torch.no_grad()
+    def sample_batch(self, clip_feature, y_mask, if_categorial=False, max_length=50, draft=None, nb_draft_tokens=4):
+        """Samples a padded batch of prompts together.
+
+        Returns the motion tokens (b, <=max_length) and the number of tokens each row produced before the
+        end token; rows that never emit it are cut at `max_length`. Entries past a row's length are undefined.
+        With a `draft` model the tokens are decoded by `sample_batch_speculative`.
+        """
+        if draft is not None:
+            # checks the draft before touching the caches
+            return self.sample_batch_speculative(draft, clip_feature, y_mask, if_categorial, max_length, nb_draft_tokens)
+
+        B = clip_feature.shape[0]
+        end_idx = self.config.vocab_size - 2
+        x, input_pos = self.prefill(clip_feature, y_mask)
+        # every row keeps its own positions, so its tokens overwrite the padding slots of its prefix
+
+        finished = torch.zeros(B, dtype=torch.bool, device=clip_feature.device)
+        nb_tokens = torch.full((B,), max_length, dtype=torch.long, device=clip_feature.device)
+        xs = []
+        for k in range(max_length):
+            if k > 0:
+                x = self.forward_cached(self.transformer.wte(idx), y_mask, input_pos)[:, -1]
+                input_pos = input_pos + 1
+            idx = self.next_token(x, if_categorial)
+
+            is_end = idx[:, 0] == end_idx
+            nb_tokens = torch.where(is_end & ~finished, torch.full_like(nb_tokens, k), nb_tokens)
+            finished = finished | is_end
+            if finished.all():
+                break
+            xs.append(idx)
+        self.reset_cache()
+
+        if len(xs) == 0:
+            return torch.zeros((B, 0), dtype=torch.long, device=clip_feature.device), nb_tokens
+        return torch.cat(xs, dim=1), nb_tokens
+
+    def check_draft(self, draft) -> None:
+        """Raises if `sample_batch_speculative` cannot decode with `draft`."""
+        if draft.config.vocab_size != self.config.vocab_size or draft.config.factorized_head != self.config.factorized_head:
+            raise ValueError('the draft model must share the motion vocabulary and the token interface')
+
+    @torch.no_grad()
+    def sample_batch_speculative(self, draft, clip_feature, y_mask, if_categorial=False, max_length=50, nb_draft_tokens=4):
+        """`sample_batch` with a small `draft` LLaMAHF over the same vocabulary and text features.
+
+        Each step the draft proposes `nb_draft_tokens` tokens after the last accepted one and this model
+        scores all of them in one cached forward. Greedy decoding keeps the proposals up to the first one
+        this model would not have picked and adds its own pick; sampling accepts a proposal d with
+        probability min(1, p(d) / q(d)) and resamples the first rejected one from max(0, p - q). Either
+        way the tokens follow this model's distribution, the draft only changes how many forwards it takes.
+        Rows accept different numbers of tokens, their positions in the caches move independently and the
+        slots of rejected proposals are overwritten before any later position attends to them.
+        """
+        self.check_draft(draft)
+        B = clip_feature.shape[0]
+        device = clip_feature.device
+        end_idx = self.config.vocab_size - 2
+        batch_idx = torch.arange(B, device=device)
+
+        x, pos = self.prefill(clip_feature, y_mask)
+        draft.prefill(clip_feature, y_mask)
+        # `tok` is emitted but not yet seen by either model, it goes in at `pos`
+        tok = self.next_token(x, if_categorial)
+
+        out = torch.zeros((B, max_length + nb_draft_tokens + 1), dtype=torch.long, device=device)
+        out[:, 0] = tok[:, 0]
+        nb_out = torch.ones(B, dtype=torch.long, device=device)
+        finished = tok[:, 0] == end_idx
+        nb_tokens = torch.full((B,), max_length, dtype=torch.long, device=device).masked_fill(finished, 0)
+        while True:
+            active = ~finished & (nb_out < max_length)
+            # this model writes `tok` and the proposals at pos .. pos + nb_draft
+            nb_draft = min(nb_draft_tokens, self.config.block_size - 1 - int(pos.max()))
+            if not active.any() or nb_draft < 0:
+                break
+
+            x_draft = draft.forward_cached(draft.transformer.wte(tok), y_mask, pos)[:, -1]
+            drafts, q = [], []
+            for i in range(nb_draft):
+                if if_categorial:
+                    q.append(draft.token_probs(x_draft))
+                    d = Categorical(q[-1]).sample().unsqueeze(-1)
+                else:
+                    d = draft.next_token(x_draft)
+                drafts.append(d)
+                # the last proposal is only written to the draft cache, for when all of them are accepted
+                x_draft = draft.forward_cached(draft.transformer.wte(d), y_mask, pos + 1 + i)[:, -1]
+            drafts = torch.cat(drafts + [tok.new_zeros((B, 1))], dim=1)  # (b, nb_draft + 1)
+
+            x = self.forward_cached(self.transformer.wte(torch.cat((tok, drafts[:, :nb_draft]), dim=1)), y_mask, pos)
+            if if_categorial:
+                p = self.token_probs(x)  # (b, nb_draft + 1, vocab_size - 1)
+                # q of the position after the last proposal is 0, so its "residual" is p itself
+                q = torch.stack(q + [torch.zeros_like(p[:, 0])], dim=1)
+                p_d = p.gather(-1, drafts.unsqueeze(-1)).squeeze(-1)[:, :nb_draft]
+                q_d = q.gather(-1, drafts.unsqueeze(-1)).squeeze(-1)[:, :nb_draft]
+                accept = torch.rand_like(q_d) * q_d < p_d
+                nb_accept = accept.long().cumprod(dim=1).sum(dim=1)
+                residual = (p[batch_idx, nb_accept] - q[batch_idx, nb_accept]).clamp(min=0)
+                residual = torch.where(residual.sum(dim=-1, keepdim=True) > 0, residual, p[batch_idx, nb_accept])
+                tok = Categorical(residual).sample().unsqueeze(-1)
             else:
-                xs = torch.cat((xs, idx), dim=1)
-            
-            if k == 50:
-                return xs[:, :-1]
-        
-        if k == 0:
-            return torch.ones(1,1).to(clip_feature.device).long()
+                target = self.next_token(x.flatten(0, 1)).view(B, nb_draft + 1)
+                nb_accept = (target[:, :nb_draft] == drafts[:, :nb_draft]).long().cumprod(dim=1).sum(dim=1)
+                tok = target[batch_idx, nb_accept].unsqueeze(-1)
+
+            # the accepted proposals and this model's own token, appended to the active rows
+            new = drafts.scatter(1, nb_accept.unsqueeze(-1), tok)
+            offsets = torch.arange(nb_draft + 1, device=device)
+            valid = active.unsqueeze(-1) & (offsets <= nb_accept.unsqueeze(-1))
+            cols = nb_out.unsqueeze(-1) + offsets
+            out[batch_idx.unsqueeze(-1).expand_as(cols)[valid], cols[valid]] = new[valid]
+
+            is_end = valid & (new == end_idx)
+            first_end = torch.where(is_end, offsets, torch.full_like(offsets, nb_draft + 1)).min(dim=1).values
+            nb_tokens = torch.where(is_end.any(dim=1), nb_out + first_end, nb_tokens)
+            finished = finished | is_end.any(dim=1)
+            nb_out = torch.where(active, nb_out + nb_accept + 1, nb_out)
+            pos = torch.where(active, pos + nb_accept + 1, pos)
+        self.reset_cache()
+        draft.reset_cache()
+
+        # as in sample_batch, rows are cut at max_length and the end token is not returned
+        nb_tokens = torch.where(finished, nb_tokens, nb_out).clamp(max=max_length)
+        return out[:, :int(nb_tokens.max())], nb_tokens
+
+    def next_token(self, x: torch.Tensor, if_categorial=False) -> torch.Tensor:
+        """Picks the next token (b, 1) from the final hidden states (b, n_embd) of the last positions."""
+        if self.config.factorized_head is not None:
+            return self.lm_head.next_token(x, if_categorial).unsqueeze(-1)
+        probs = F.softmax(self.lm_head(x), dim=-1)
+        if if_categorial:
+            dist = Categorical(probs)
+            idx = dist.sample().unsqueeze(-1)
         else:
-            return xs
+            _, idx = torch.topk(probs, k=1, dim=-1)
+        return idx
+
+    def token_probs(self, x: torch.Tensor) -> torch.Tensor:
+        """Next token distribution (..., vocab_size - 1) of final hidden states, the one `next_token` samples."""
+        if self.config.factorized_head is not None:
+            return self.lm_head(x).exp()
+        return F.softmax(self.lm_head(x).float(), dim=-1)
+
+    def forward_cached(self, x: torch.Tensor, y_mask: torch.Tensor, input_pos) -> torch.Tensor:
+        """Runs only the new positions `x` (already embedded) against the per-layer key/value caches.
+
+        `input_pos` is the position of the first new token, an int shared by the batch or a (b,) tensor.
+        Returns the final hidden states of the new positions (b, t, n_embd).
+        """
+        for block in self.transformer.h:
+            x = block(x, y_mask, input_pos)
+        x = self.transformer.ln_f(x)
+
+        return x
 
     def forward_sample(self, idx: torch.Tensor, clip_feature: torch.Tensor, y_mask) -> torch.Tensor:
         text_length = clip_feature.shape[1]
         if len(idx) == 0:
-            x = self.llama_proj(clip_feature)[:, :int(y_mask[0].sum()), :]
+            x = self.llama_proj(clip_feature.to(self.llama_proj.weight.dtype))[:, :int(y_mask[0].sum()), :]
         else:
             _, t = idx.size()
             assert (
@@ -146,7 +308,7 @@ class LLaMAHF(nn.Module):
             ), f"Cannot forward sequence of length {t}, block size is only {self.config.block_size}"
             # forward the LLaMA model itself
             x = self.transformer.wte(idx)  # token embeddings of shape (b, t, n_embd)
-            x = torch.cat((self.llama_proj(clip_feature)[:, :int(y_mask[0].sum()), :],x), dim=1)
+            x = torch.cat((self.llama_proj(clip_feature.to(self.llama_proj.weight.dtype))[:, :int(y_mask[0].sum()), :],x), dim=1)
 
         for block in self.transformer.h:
             x = block(x, y_mask)
@@ -156,28 +318,39 @@ class LLaMAHF(nn.Module):
 
         return logits
 
-    def forward(self, idx: torch.Tensor, clip_feature: torch.Tensor, y_mask) -> torch.Tensor:
+    def embed(self, idx: torch.Tensor, clip_feature: torch.Tensor, y_mask) -> torch.Tensor:
+        """Input of the first block (b, t, n_embd): the projected text features where `y_mask` is set, then the token embeddings."""
         text_length = clip_feature.shape[1]
         if len(idx) == 0:
-            x = self.llama_proj(clip_feature)[:, :int(y_mask[0].sum()), :]
-        else:
-            _, t = idx.size()
-            assert (
-                t <= self.config.block_size
-            ), f"Cannot forward sequence of length {t}, block size is only {self.config.block_size}"
-            # forward the LLaMA model itself
-            x = self.transformer.wte(idx)  # token embeddings of shape (b, t, n_embd)
-
-            # replace text_length tokens with clip_feature
-            expanded_mask = y_mask.unsqueeze(-1).expand(-1, -1, x.shape[-1])
-            result = torch.where(expanded_mask == 1, self.llama_proj(clip_feature), x[:, :text_length, :])
-            result = torch.cat((result, x[:, text_length:, :]), dim=1)
-            x = result
-
+            return self.llama_proj(clip_feature.to(self.llama_proj.weight.dtype))[:, :int(y_mask[0].sum()), :]
+        _, t = idx.size()
+        assert (
+            t <= self.config.block_size
+        ), f"Cannot forward sequence of length {t}, block size is only {self.config.block_size}"
+        # forward the LLaMA model itself
+        x = self.transformer.wte(idx)  # token embeddings of shape (b, t, n_embd)
+
+        # replace text_length tokens with clip_feature
+        expanded_mask = y_mask.unsqueeze(-1).expand(-1, -1, x.shape[-1])
+        result = torch.where(expanded_mask == 1, self.llama_proj(clip_feature.to(self.llama_proj.weight.dtype)), x[:, :text_length, :])
+        return torch.cat((result, x[:, text_length:, :]), dim=1)
+
+    def forward(self, idx: torch.Tensor, clip_feature: torch.Tensor, y_mask, targets: Optional[torch.Tensor] = None, compute_pred: bool = False, loss_chunk_size: int = 1024):
+        """Returns the logits (b, t, vocab_size - 1).
+
+        With `targets` (b, t), aligned with the positions and set to `vocab_size - 1` where there is nothing to
+        predict, returns `chunked_cross_entropy` over the target positions instead, without building the logits.
+        """
+        x = self.embed(idx, clip_feature, y_mask)
         for block in self.transformer.h:
             x = block(x, y_mask)
         x = self.transformer.ln_f(x)
 
+        if targets is not None:
+            if self.config.factorized_head is not None:
+                return self.lm_head.loss(x, targets, self.config.vocab_size - 1, compute_pred)
+            return chunked_cross_entropy(x, self.lm_head.weight, targets, self.config.vocab_size - 1, loss_chunk_size, compute_pred)
+
         logits = self.lm_head(x)  # (b, t, vocab_size)
 
         return logits
@@ -461,6 +634,37 @@ class LLaMAHF(nn.Module):
     def from_name(cls, name: str) -> Self:
         return cls(LLaMAHFConfig.from_name(name))
 
+    @classmethod
+    def draft_from_checkpoint(cls, name: str, ckpt_path: str, target_config: LLaMAHFConfig) -> Self:
+        """A small model of size `name` for `sample_batch_speculative`, trained with the same vocabulary, text
+        features and token interface as the model of `target_config`."""
+        config = LLaMAHFConfig.from_name(name)
+        for key in ('block_size', 'vocab_size', 'clip_dim', 'tie_weights', 'fsq_levels', 'factorized_head'):
+            setattr(config, key, getattr(target_config, key))
+        return cls.from_checkpoint(config, ckpt_path)
+
+    @classmethod
+    def from_checkpoint(cls, config: LLaMAHFConfig, ckpt_path: str, device=None) -> Self:
+        """Builds the model on `device` without initialising it, then fills it tensor by tensor from `ckpt_path`.
+
+        `ckpt_path` is a training checkpoint, whose optimizer state is never read, or a weights-only one of
+        export_t2m_llama.py, which makes the model bf16. GPTQ checkpoints get their quantized linear layers.
+        """
+        ckpt = lazy_load(ckpt_path)
+        dtype = getattr(torch, ckpt['dtype']) if 'dtype' in ckpt else None
+        quantization = ckpt['quantization'] if 'quantization' in ckpt else None
+        # a GPTQ model is built on the CPU, whose uninitialised full precision linear layers are never
+        # touched, and only goes to `device` once they are swapped for the quantized ones
+        with EmptyInitOnDevice(device=torch.device('cpu') if quantization is not None else device, dtype=dtype):
+            model = cls(config)
+        if quantization is not None:
+            # outside the context, the scales and zeros keep their float32 buffers
+            replace_with_quantized_linear_(model, **quantization)
+            if device is not None:
+                model.to(device)
+        model.load_state_dict({k.replace('module.', ''): v for k, v in ckpt['trans'].items()}, strict=True)
+        return model.eval()
+
 
 class Block(nn.Module):
     def __init__(self, config: LLaMAHFConfig) -> None: # , use_qkNorm=False, use_moe=False) -> None:
@@ -479,8 +683,8 @@ class Block(nn.Module):
         #     self.mlp = MLP(config)
         self.mlp = MLP(config)
 
-    def forward(self, x: torch.Tensor, y_mask: torch.Tensor) -> torch.Tensor:
-        x = x + self.attn(self.rms_1(x), y_mask)
+    def forward(self, x: torch.Tensor, y_mask: torch.Tensor, input_pos: Optional[Union[int, torch.Tensor]] = None) -> torch.Tensor:
+        x = x + self.attn(self.rms_1(x), y_mask, input_pos)
         # if self.use_moe:
         #     x = x + self.smoe(self.rms_2(x))
         # else:
@@ -515,11 +719,11 @@ class CausalSelfAttention(nn.Module):
         v = v.view(B, T, self.n_head, head_size).transpose(1, 2)  # (B, nh, T, hs)
 
         if self.rope_cache is None:
-            # cache for future forward calls
+            # cache for future forward calls, always float32: bf16 positions collide past 256
             self.rope_cache = build_rope_cache(
                 seq_len=self.block_size,
                 n_elem=self.n_embd // self.n_head, 
-                dtype=x.dtype,
+                dtype=torch.float32,
                 device=x.device,
             )
 
@@ -550,7 +754,10 @@ class LengthCausalSelfAttention(nn.Module):
         self.n_embd = config.n_embd
         self.block_size = config.block_size
         self.rope_cache = None 
-    def forward(self, x: torch.Tensor, y_mask: torch.Tensor) -> torch.Tensor:
+        # (k, v) of all positions seen so far, only populated when decoding with `input_pos`
+        self.kv_cache = None
+
+    def forward(self, x: torch.Tensor, y_mask: torch.Tensor, input_pos: Optional[Union[int, torch.Tensor]] = None) -> torch.Tensor:
         B, T, C = x.size()  # batch size, sequence length, embedding dimensionality (n_embd)
 
         # calculate query, key, values for all heads in batch and move head forward to be the batch dim
@@ -562,26 +769,56 @@ class LengthCausalSelfAttention(nn.Module):
         v = v.view(B, T, self.n_head, head_size).transpose(1, 2)  # (B, nh, T, hs)
         
         if self.rope_cache is None:
-            # cache for future forward calls
+            # cache for future forward calls, always float32: bf16 positions collide past 256
             self.rope_cache = build_rope_cache(
                 seq_len=self.block_size,
                 n_elem=self.n_embd // self.n_head, 
-                dtype=x.dtype,
+                dtype=torch.float32,
                 device=x.device,
             )
-            
-        q = apply_rope(q, self.rope_cache)
-        k = apply_rope(k, self.rope_cache)
-
-        # create attention mask
-        attn_mask = torch.ones(T, T, dtype=torch.bool, device=x.device)
-        attn_mask = torch.tril(attn_mask)
-        attn_mask = attn_mask.unsqueeze(0).expand(B, -1, -1)
 
-        text_mask = y_mask.unsqueeze(2)*y_mask.unsqueeze(1)
-        text_mask = F.pad(text_mask, (0, T-y_mask.shape[1], 0, T-y_mask.shape[1]), mode='constant', value=0)
-        attn_mask = torch.logical_or(attn_mask, text_mask)
-        y = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask.unsqueeze(1), dropout_p=0.0, is_causal=False)
+        # absolute positions of the new tokens, shared by the batch or offset per row
+        if input_pos is None:
+            positions = torch.arange(T, device=x.device)
+        elif isinstance(input_pos, int):
+            positions = torch.arange(input_pos, input_pos + T, device=x.device)
+        else:
+            positions = input_pos.view(B, 1) + torch.arange(T, device=x.device)
+        rope_cache = self.rope_cache[positions]
+        q = apply_rope(q, rope_cache)
+        k = apply_rope(k, rope_cache)
+
+        if input_pos is not None:
+            if self.kv_cache is None:
+                cache_shape = (B, self.n_head, self.block_size, head_size)
+                self.kv_cache = (k.new_zeros(cache_shape), v.new_zeros(cache_shape))
+            cache_k, cache_v = self.kv_cache
+            if positions.dim() == 1:
+                cache_k[:, :, positions] = k
+                cache_v[:, :, positions] = v
+                # nothing after the new tokens has been written yet
+                k = cache_k[:, :, :input_pos + T]
+                v = cache_v[:, :, :input_pos + T]
+            else:
+                batch_idx = torch.arange(B, device=x.device).unsqueeze(1)
+                cache_k[batch_idx, :, positions] = k.transpose(1, 2)
+                cache_v[batch_idx, :, positions] = v.transpose(1, 2)
+                # rows end at different positions, the mask hides the unwritten slots
+                k, v = cache_k, cache_v
+
+        if input_pos is None or (isinstance(input_pos, int) and input_pos == 0):
+            # causal everywhere with the fused kernels, then redo the rows of the text prefix, whose
+            # bidirectional part only involves keys inside the prefix
+            y = F.scaled_dot_product_attention(q, k, v, attn_mask=None, dropout_p=0.0, is_causal=True)
+            P = min(y_mask.shape[1], T)
+            if P > 0:
+                prefix_mask = build_prefix_lm_mask(y_mask[:, :P], positions[:P], P)
+                y_prefix = F.scaled_dot_product_attention(q[:, :, :P], k[:, :, :P], v[:, :, :P], attn_mask=prefix_mask.unsqueeze(1), dropout_p=0.0, is_causal=False)
+                y = torch.cat((y_prefix, y[:, :, P:]), dim=2)
+        else:
+            # a few new queries against the cache, the dense mask is only (B, T, kv_len)
+            attn_mask = build_prefix_lm_mask(y_mask, positions, k.size(2))
+            y = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask.unsqueeze(1), dropout_p=0.0, is_causal=False)
 
         y = y.transpose(1, 2).contiguous().view(B, T, C)
 
@@ -609,6 +846,132 @@ class MLP(nn.Module):
         return x
 
 
+def codes_to_digits(idx: torch.Tensor, basis: torch.Tensor, levels: torch.Tensor) -> torch.Tensor:
+    # (...) FSQ code indices -> (..., nb_levels) per-level digits, as FSQ.indices_to_level_indices
+    return (idx.unsqueeze(-1) // basis) % levels
+
+
+def digits_to_codes(digits: torch.Tensor, basis: torch.Tensor) -> torch.Tensor:
+    return (digits * basis).sum(dim=-1)
+
+
+class FactorizedEmbedding(nn.Module):
+    """Input embedding of FSQ codes as the sum of one small embedding per level.
+
+    The end and pad tokens (nb_code, nb_code + 1) keep rows of their own.
+    """
+
+    def __init__(self, levels, n_embd: int) -> None:
+        super().__init__()
+        self.nb_code = int(np.prod(levels))
+        self.register_buffer("levels", torch.tensor(levels, dtype=torch.long), persistent=False)
+        self.register_buffer("basis", torch.cumprod(torch.tensor([1] + list(levels[:-1]), dtype=torch.long), dim=0), persistent=False)
+        self.level_embs = nn.ModuleList([nn.Embedding(level, n_embd) for level in levels])
+        self.special = nn.Embedding(2, n_embd)
+        # the sum of the level rows has the variance of a single nn.Embedding row
+        for emb in self.level_embs:
+            nn.init.normal_(emb.weight, std=1 / math.sqrt(len(levels)))
+
+    def forward(self, idx: torch.Tensor) -> torch.Tensor:
+        digits = codes_to_digits(idx.clamp(max=self.nb_code - 1), self.basis, self.levels)
+        x = sum(emb(digits[..., i]) for i, emb in enumerate(self.level_embs))
+        special = self.special((idx - self.nb_code).clamp(min=0))
+        return torch.where((idx >= self.nb_code).unsqueeze(-1), special, x)
+
+
+class FactorizedHead(nn.Module):
+    """Output head over FSQ codes: a stop logit for the end token and one softmax per level.
+
+    p(end) = sigmoid(stop), p(code) = (1 - p(end)) * prod_i p(d_i). With 'joint' the digits d_i of a
+    code are predicted independently from the hidden state, with 'causal' the digits already chosen
+    are added back to it through per-level embeddings, p(d_i | h, d_<i).
+    """
+
+    def __init__(self, levels, n_embd: int, factorization: str = 'causal') -> None:
+        super().__init__()
+        assert factorization in ('causal', 'joint'), factorization
+        self.factorization = factorization
+        self.nb_code = int(np.prod(levels))
+        self.register_buffer("levels", torch.tensor(levels, dtype=torch.long), persistent=False)
+        self.register_buffer("basis", torch.cumprod(torch.tensor([1] + list(levels[:-1]), dtype=torch.long), dim=0), persistent=False)
+        self.stop = nn.Linear(n_embd, 1, bias=False)
+        self.heads = nn.ModuleList([nn.Linear(n_embd, level, bias=False) for level in levels])
+        if factorization == 'causal':
+            self.digit_embs = nn.ModuleList([nn.Embedding(level, n_embd) for level in levels[:-1]])
+
+    def _next_level(self, h: torch.Tensor, i: int, digit: torch.Tensor) -> torch.Tensor:
+        if self.factorization == 'causal' and i < len(self.heads) - 1:
+            h = h + self.digit_embs[i](digit)
+        return h
+
+    def forward(self, hidden: torch.Tensor) -> torch.Tensor:
+        """Log-probabilities (..., nb_code + 1) of every code and of the end token.
+
+        'causal' expands the digit prefixes one level at a time, the last level heads see
+        nb_code / levels[-1] hidden states per position.
+        """
+        stop_logit = self.stop(hidden).float()
+        code_logp = F.logsigmoid(-stop_logit)
+        # one hidden state per digit prefix, a single one for 'joint'
+        h = hidden.unsqueeze(-2)
+        for i, head in enumerate(self.heads):
+            logp = F.log_softmax(head(h).float(), dim=-1)
+            # the first level varies fastest in the code index, the new digit goes outside the prefix
+            code_logp = (code_logp.unsqueeze(-2) + logp.transpose(-1, -2)).flatten(-2)
+            digit = torch.arange(logp.shape[-1], device=h.device).unsqueeze(-1)
+            h = self._next_level(h.unsqueeze(-3), i, digit).flatten(-3, -2)
+        return torch.cat([code_logp, F.logsigmoid(stop_logit)], dim=-1)
+
+    def next_token(self, hidden: torch.Tensor, if_categorial=False) -> torch.Tensor:
+        """(b, n_embd) -> (b,) codes, or nb_code for the end token.
+
+        Greedy decoding ends a row when p(end) beats the greedy code, the argmax of the
+        distribution for 'joint'; sampling draws the end token, then the digits level by level.
+        """
+        stop_logit = self.stop(hidden).squeeze(-1).float()
+        code_logp = F.logsigmoid(-stop_logit)
+        h, digits = hidden, []
+        for i, head in enumerate(self.heads):
+            logp = F.log_softmax(head(h).float(), dim=-1)
+            digit = Categorical(logits=logp).sample() if if_categorial else logp.argmax(dim=-1)
+            code_logp = code_logp + logp.gather(-1, digit.unsqueeze(-1)).squeeze(-1)
+            digits.append(digit)
+            h = self._next_level(h, i, digit)
+        if if_categorial:
+            is_end = torch.bernoulli(torch.sigmoid(stop_logit)).bool()
+        else:
+            is_end = F.logsigmoid(stop_logit) > code_logp
+        codes = digits_to_codes(torch.stack(digits, dim=-1), self.basis)
+        return torch.where(is_end, torch.full_like(codes, self.nb_code), codes)
+
+    def loss(self, hidden: torch.Tensor, targets: torch.Tensor, ignore_index: int, compute_pred: bool = False):
+        """Same contract as `chunked_cross_entropy`: the mean negative log-likelihood of the target tokens.
+
+        The stop logit is trained on every target position, the level heads only on the code targets,
+        teacher forced with the target digits for 'causal'.
+        """
+        valid = targets != ignore_index
+        hidden = hidden[valid]
+        targets = targets[valid].long()
+
+        is_end = targets == self.nb_code
+        stop_logit = self.stop(hidden).squeeze(-1).float()
+        loss = F.binary_cross_entropy_with_logits(stop_logit, is_end.float(), reduction='sum')
+
+        h = hidden[~is_end]
+        digits = codes_to_digits(targets[~is_end], self.basis, self.levels)
+        for i, head in enumerate(self.heads):
+            loss = loss + F.cross_entropy(head(h).float(), digits[:, i], reduction='sum')
+            h = self._next_level(h, i, digits[:, i])
+        loss = loss / targets.shape[0]
+
+        pred_index = None
+        if compute_pred:
+            with torch.no_grad():
+                pred_index = self.next_token(hidden)
+        return loss, pred_index, targets
+
+
 class RMSNorm(nn.Module):
     """Root Mean Square Layer Normalization.
 
@@ -632,6 +995,56 @@ class RMSNorm(nn.Module):
         return self.scale * x_normed
 
 
+def _cross_entropy_chunk(hidden: torch.Tensor, weight: torch.Tensor, targets: torch.Tensor, compute_pred: bool):
+    logits = F.linear(hidden, weight).float()
+    loss = F.cross_entropy(logits, targets, reduction='sum')
+    if not compute_pred:
+        return loss
+    with torch.no_grad():
+        pred_index = logits.argmax(dim=-1)
+    return loss, pred_index
+
+
+def chunked_cross_entropy(hidden: torch.Tensor, weight: torch.Tensor, targets: torch.Tensor, ignore_index: int, chunk_size: int = 1024, compute_pred: bool = False):
+    """Mean cross-entropy of `hidden @ weight.T` against `targets`, computed `chunk_size` positions at a time.
+
+    Only positions whose target is not `ignore_index` are projected, and the logits of every chunk are recomputed
+    in backward instead of being stored, so the (positions, vocab) logits never exist at once.
+    Returns the loss, the argmax predictions (only with `compute_pred`, else None) and the targets of those positions.
+    """
+    valid = targets != ignore_index
+    hidden = hidden[valid]
+    targets = targets[valid].long()
+
+    loss = hidden.new_zeros((), dtype=torch.float32)
+    pred_index = []
+    for start in range(0, targets.shape[0], chunk_size):
+        chunk_out = checkpoint(_cross_entropy_chunk, hidden[start:start + chunk_size], weight, targets[start:start + chunk_size], compute_pred, use_reentrant=False)
+        if compute_pred:
+            chunk_out, chunk_pred = chunk_out
+            pred_index.append(chunk_pred)
+        loss = loss + chunk_out
+    loss = loss / targets.shape[0]
+
+    return loss, torch.cat(pred_index) if compute_pred else None, targets
+
+
+def build_prefix_lm_mask(y_mask: torch.Tensor, positions: torch.Tensor, kv_len: int) -> torch.Tensor:
+    """Boolean attention mask (B, T, kv_len) for queries at `positions`, (T,) or (B, T).
+
+    Attention is causal, except that the text positions marked by `y_mask` see each other bidirectionally.
+    """
+    B = y_mask.shape[0]
+    if positions.dim() == 1:
+        positions = positions.unsqueeze(0).expand(B, -1)
+    key_pos = torch.arange(kv_len, device=y_mask.device)
+    attn_mask = key_pos <= positions.unsqueeze(-1)
+
+    text = F.pad(y_mask, (0, kv_len - y_mask.shape[1]), mode='constant', value=0) != 0
+    text_mask = text.gather(1, positions).unsqueeze(-1) & text.unsqueeze(1)
+    return torch.logical_or(attn_mask, text_mask)
+
+
 def build_rope_cache(seq_len: int, n_elem: int, dtype: torch.dtype, device: torch.device, base: int = 10000) -> torch.Tensor:
     """Enhanced Transformer with Rotary Position Embedding.
 
@@ -666,12 +1079,13 @@ def build_rope_cache(seq_len: int, n_elem: int, dtype: torch.dtype, device: torc
 def apply_rope(x: torch.Tensor, rope_cache: torch.Tensor) -> torch.Tensor:
     x = x.transpose(1, 2)
 
-    # truncate to support variable sizes
+    # truncate to support variable sizes, a 3d cache already holds per-row positions
     T = x.size(1)
-    rope_cache = rope_cache[:T]
+    if rope_cache.dim() == 2:
+        rope_cache = rope_cache[:T]
     
     # cast because `view_as_complex` does not support 16 bit tensors
     xc = torch.view_as_complex(x.float().reshape(*x.shape[:-1], -1, 2))
-    rope_cache = rope_cache.view(1, xc.size(1), 1, xc.size(3))
+    rope_cache = rope_cache.view(-1, xc.size(1), 1, xc.size(3))
     x_out = torch.view_as_real(xc * rope_cache).flatten(3)
     return x_out.transpose(1, 2).type_as(x)
@@ -64,7 +64,7 @@ if bnb is not None:
             setattr(self.weight, "SCB", SCB)
 
 
-# for correctness but with terrible perf
+# weight-only quantized linear layer, dequantizes its weight in plain PyTorch on every call so it runs on any device
 class ColBlockQuantizedLinear(torch.nn.Module):
     def __init__(self, in_features, out_features, bias: bool, *, bits, tile_cols):
         super().__init__()
@@ -89,25 +89,29 @@ class ColBlockQuantizedLinear(torch.nn.Module):
         for j in range(self.scales.size(1)):
             weight[:, j * self.tile_cols: (j + 1) * self.tile_cols] /= self.scales[: , j: j+1]
             weight[:, j * self.tile_cols: (j + 1) * self.tile_cols] += self.zeros[: , j: j+1]
-        weight = weight.clamp_(min=0, max=2 ** self.bits - 1).to(dtype=torch.uint8)
+        weight = weight.round_().clamp_(min=0, max=2 ** self.bits - 1).to(dtype=torch.uint8)
         self.quant_weight.zero_()
         for nr in range(self.entries_per_byte):
             self.quant_weight += weight[:, nr::self.entries_per_byte] << (nr * self.bits)
 
     def get_weight(self, dtype=torch.float):
-        weight = torch.empty((self.out_features, self.in_features),  device=self.quant_weight.device, dtype=dtype)
-        mask = (1<<self.bits) - 1
-        for nr in range(self.entries_per_byte):
-            weight[:, nr::self.entries_per_byte] = ((self.quant_weight >> (nr * self.bits)) & mask).float()
-        self.quant_weight.to(dtype)
-        for j in range(self.scales.size(1)):
-            weight[:, j * self.tile_cols: (j + 1) * self.tile_cols] -= self.zeros[: , j: j+1]
-            weight[:, j * self.tile_cols: (j + 1) * self.tile_cols] *= self.scales[: , j: j+1]
-        return weight
+        # byte k holds the columns k * entries_per_byte + nr at bit nr * bits
+        shifts = torch.arange(0, 8, self.bits, device=self.quant_weight.device, dtype=torch.uint8)
+        weight = (self.quant_weight.unsqueeze(-1) >> shifts) & ((1 << self.bits) - 1)
+        weight = weight.view(self.out_features, self.in_features).to(dtype)
+        scales, zeros = self.scales.to(dtype), self.zeros.to(dtype)
+        if self.in_features % self.tile_cols == 0:
+            weight = weight.view(self.out_features, -1, self.tile_cols)
+            return ((weight - zeros.unsqueeze(-1)) * scales.unsqueeze(-1)).view(self.out_features, self.in_features)
+        # the last tile is narrower
+        zeros = zeros.repeat_interleave(self.tile_cols, dim=1)[:, :self.in_features]
+        scales = scales.repeat_interleave(self.tile_cols, dim=1)[:, :self.in_features]
+        return (weight - zeros) * scales
 
     def forward(self, inp):
         weight = self.get_weight(dtype=inp.dtype)
-        return torch.nn.functional.linear(inp, weight, self.bias)
+        bias = self.bias.to(inp.dtype) if self.bias is not None else None
+        return torch.nn.functional.linear(inp, weight, bias)
 
 
 
@@ -245,8 +249,8 @@ class GPTQQuantizer:
                 if self.groupsize != -1:
                     if (i1 + i) % self.groupsize == 0:
                         scale, zero = self.find_params_weight(W[:, (i1 + i):(i1 + i + self.groupsize)])
-                        self.scales[:, (i1 + i) // self.groupsize] = scale
-                        self.zeros[:, (i1 + i) // self.groupsize] = zeros
+                        self.scales[:, (i1 + i) // self.groupsize] = scale[:, 0]
+                        self.zeros[:, (i1 + i) // self.groupsize] = zero[:, 0]
 
                 q = self.quantize_weight(
                     w.unsqueeze(1), scale, zero, self.maxq
@@ -279,3 +283,16 @@ class GPTQQuantizer:
         q_module.pack_weight(weight)
         q_module.bias = self.linear_module.bias
         return q_module, error
+
+
+def replace_with_quantized_linear_(model, modules, bits, groupsize):
+    """Swap the `torch.nn.Linear` submodules named in `modules` for empty `ColBlockQuantizedLinear`,
+    ready for `load_state_dict` of a checkpoint written by GPTQ with the same `bits` and `groupsize`."""
+    for name in modules:
+        linear = model.get_submodule(name)
+        assert isinstance(linear, torch.nn.Linear), f'{name} is not a linear layer'
+        q_module = ColBlockQuantizedLinear(linear.in_features, linear.out_features, linear.bias is not None,
+                                           bits=bits, tile_cols=groupsize).to(linear.weight.device)
+        parent, _, attr = name.rpartition('.')
+        setattr(model.get_submodule(parent), attr, q_module)
+    return model
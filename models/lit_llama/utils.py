@@ -8,10 +8,6 @@ from io import BytesIO
 
 import torch
 import torch.utils._device
-from lightning.fabric.strategies import DeepSpeedStrategy, FSDPStrategy
-from torch.distributed.fsdp import FullStateDictConfig
-from torch.distributed.fsdp import FullyShardedDataParallel as FSDP
-from torch.distributed.fsdp import StateDictType
 from torch.serialization import normalize_storage_type
 
 def save_model_checkpoint(fabric, model, file_path):
@@ -19,6 +15,12 @@ def save_model_checkpoint(fabric, model, file_path):
     
     This will be upstreamed to Fabric soon.
     """
+    # lightning is only needed here, the loading utilities below work without it
+    from lightning.fabric.strategies import DeepSpeedStrategy, FSDPStrategy
+    from torch.distributed.fsdp import FullStateDictConfig
+    from torch.distributed.fsdp import FullyShardedDataParallel as FSDP
+    from torch.distributed.fsdp import StateDictType
+
     file_path = Path(file_path)
 
     if isinstance(fabric.strategy, DeepSpeedStrategy):
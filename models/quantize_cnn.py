@@ -3,6 +3,51 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+
+# codes whose distances to the latents are held at once by nearest_code
+CODE_BLOCK_SIZE = 4096
+
+
+@torch.no_grad()
+def nearest_code(x, codebook, block_size=CODE_BLOCK_SIZE, squares_first=False):
+    # index of the closest code of every row of x (N * L, w), the (N * L, nb_code) distance matrix is
+    # never built: each codebook block keeps a running min, ties go to the lowest index like torch.min.
+    # squares_first sums the distance as x^2 + k^2 - 2xk like `Quantizer` did, instead of x^2 - 2xk + k^2,
+    # so that every quantizer keeps the exact float rounding and the indices it had with the full matrix
+    x_sq = torch.sum(x ** 2, dim=-1, keepdim=True)
+    min_distance, code_idx = None, None
+    for start in range(0, codebook.shape[0], block_size):
+        if squares_first:
+            block = codebook[start:start + block_size]
+            distance = x_sq + torch.sum(block ** 2, dim=1) - 2 * torch.matmul(x, block.t())  # (N * L, block)
+        else:
+            k_w = codebook[start:start + block_size].t()
+            distance = x_sq - 2 * torch.matmul(x, k_w) + torch.sum(k_w ** 2, dim=0, keepdim=True)  # (N * L, block)
+        block_distance, block_idx = torch.min(distance, dim=-1)
+        if code_idx is None:
+            min_distance, code_idx = block_distance, block_idx
+        else:
+            closer = block_distance < min_distance
+            min_distance = torch.where(closer, block_distance, min_distance)
+            code_idx = torch.where(closer, block_idx + start, code_idx)
+    return code_idx
+
+
+def count_codes(code_idx, nb_code):
+    # usage of every code, without the (nb_code, N * L) one-hot matrix
+    return torch.bincount(code_idx.view(-1), minlength=nb_code).float()
+
+
+def sum_codes(x, code_idx, nb_code):
+    # sum of the latents assigned to every code (nb_code, w)
+    return torch.zeros(nb_code, x.shape[-1], device=x.device).index_add_(0, code_idx.view(-1), x.float())
+
+
+def perplexity_from_count(code_count):
+    prob = code_count / torch.sum(code_count)
+    return torch.exp(-torch.sum(prob * torch.log(prob + 1e-7)))
+
+
 class QuantizeEMAReset(nn.Module):
     def __init__(self, nb_code, code_dim, args):
         super().__init__()
@@ -39,24 +84,16 @@ class QuantizeEMAReset(nn.Module):
         
     @torch.no_grad()
     def compute_perplexity(self, code_idx) :
-        # Calculate new centres
-        code_onehot = torch.zeros(self.nb_code, code_idx.shape[0], device=code_idx.device)  # nb_code, N * L
-        code_onehot.scatter_(0, code_idx.view(1, code_idx.shape[0]), 1)
-
-        code_count = code_onehot.sum(dim=-1)  # nb_code
-        prob = code_count / torch.sum(code_count)  
-        perplexity = torch.exp(-torch.sum(prob * torch.log(prob + 1e-7)))
+        code_count = count_codes(code_idx, self.nb_code)  # nb_code
+        perplexity = perplexity_from_count(code_count)
         activate = torch.sum(code_count > 0).float() / self.nb_code
         return perplexity, activate 
     
     @torch.no_grad()
     def update_codebook(self, x, code_idx):
         
-        code_onehot = torch.zeros(self.nb_code, x.shape[0], device=x.device)  # nb_code, N * L
-        code_onehot.scatter_(0, code_idx.view(1, x.shape[0]), 1)
-
-        code_sum = torch.matmul(code_onehot, x)  # nb_code, w
-        code_count = code_onehot.sum(dim=-1)  # nb_code
+        code_sum = sum_codes(x, code_idx, self.nb_code)  # nb_code, w
+        code_count = count_codes(code_idx, self.nb_code)  # nb_code
 
         out = self._tile(x)
         code_rand = out[:self.nb_code]
@@ -69,8 +106,7 @@ class QuantizeEMAReset(nn.Module):
         code_update = self.code_sum.view(self.nb_code, self.code_dim) / self.code_count.view(self.nb_code, 1)
 
         self.codebook = usage * code_update + (1 - usage) * code_rand
-        prob = code_count / torch.sum(code_count)  
-        perplexity = torch.exp(-torch.sum(prob * torch.log(prob + 1e-7)))
+        perplexity = perplexity_from_count(code_count)
 
         active = torch.sum(usage) / self.nb_code
 
@@ -84,11 +120,7 @@ class QuantizeEMAReset(nn.Module):
 
     def quantize(self, x):
         # Calculate latent code x_l
-        k_w = self.codebook.t()
-        distance = torch.sum(x ** 2, dim=-1, keepdim=True) - 2 * torch.matmul(x, k_w) + torch.sum(k_w ** 2, dim=0,
-                                                                                            keepdim=True)  # (N * L, b)
-        _, code_idx = torch.min(distance, dim=-1)
-        return code_idx
+        return nearest_code(x, self.codebook)
 
     def dequantize(self, code_idx):
         x = F.embedding(code_idx, self.codebook)
@@ -146,12 +178,8 @@ class Quantizer(nn.Module):
         assert z.shape[-1] == self.e_dim
         z_flattened = z.contiguous().view(-1, self.e_dim)
 
-        # B x V
-        d = torch.sum(z_flattened ** 2, dim=1, keepdim=True) + \
-            torch.sum(self.embedding.weight**2, dim=1) - 2 * \
-            torch.matmul(z_flattened, self.embedding.weight.t())
         # B x 1
-        min_encoding_indices = torch.argmin(d, dim=1)
+        min_encoding_indices = nearest_code(z_flattened, self.embedding.weight, squares_first=True)
         z_q = self.embedding(min_encoding_indices).view(z.shape)
 
         # compute loss for embedding
@@ -162,8 +190,7 @@ class Quantizer(nn.Module):
         z_q = z + (z_q - z).detach()
         z_q = z_q.view(N, T, -1).permute(0, 2, 1).contiguous()   #(N, DIM, T)
 
-        min_encodings = F.one_hot(min_encoding_indices, self.n_e).type(z.dtype)
-        e_mean = torch.mean(min_encodings, dim=0)
+        e_mean = count_codes(min_encoding_indices, self.n_e) / min_encoding_indices.numel()
         perplexity = torch.exp(-torch.sum(e_mean*torch.log(e_mean + 1e-10)))
         return z_q, loss, perplexity
 
@@ -171,12 +198,8 @@ class Quantizer(nn.Module):
 
         assert z.shape[-1] == self.e_dim
 
-        # B x V
-        d = torch.sum(z ** 2, dim=1, keepdim=True) + \
-            torch.sum(self.embedding.weight ** 2, dim=1) - 2 * \
-            torch.matmul(z, self.embedding.weight.t())
         # B x 1
-        min_encoding_indices = torch.argmin(d, dim=1)
+        min_encoding_indices = nearest_code(z, self.embedding.weight, squares_first=True)
         return min_encoding_indices
 
     def dequantize(self, indices):
@@ -225,21 +248,13 @@ class QuantizeReset(nn.Module):
         
     @torch.no_grad()
     def compute_perplexity(self, code_idx) : 
-        # Calculate new centres
-        code_onehot = torch.zeros(self.nb_code, code_idx.shape[0], device=code_idx.device)  # nb_code, N * L
-        code_onehot.scatter_(0, code_idx.view(1, code_idx.shape[0]), 1)
-
-        code_count = code_onehot.sum(dim=-1)  # nb_code
-        prob = code_count / torch.sum(code_count)  
-        perplexity = torch.exp(-torch.sum(prob * torch.log(prob + 1e-7)))
+        code_count = count_codes(code_idx, self.nb_code)  # nb_code
+        perplexity = perplexity_from_count(code_count)
         return perplexity
     
     def update_codebook(self, x, code_idx):
         
-        code_onehot = torch.zeros(self.nb_code, x.shape[0], device=x.device)  # nb_code, N * L
-        code_onehot.scatter_(0, code_idx.view(1, x.shape[0]), 1)
-
-        code_count = code_onehot.sum(dim=-1)  # nb_code
+        code_count = count_codes(code_idx, self.nb_code)  # nb_code
 
         out = self._tile(x)
         code_rand = out[:self.nb_code]
@@ -249,8 +264,7 @@ class QuantizeReset(nn.Module):
         usage = (self.code_count.view(self.nb_code, 1) >= 1.0).float()
 
         self.codebook.data = usage * self.codebook.data + (1 - usage) * code_rand
-        prob = code_count / torch.sum(code_count)  
-        perplexity = torch.exp(-torch.sum(prob * torch.log(prob + 1e-7)))
+        perplexity = perplexity_from_count(code_count)
 
             
         return perplexity
@@ -263,11 +277,7 @@ class QuantizeReset(nn.Module):
 
     def quantize(self, x):
         # Calculate latent code x_l
-        k_w = self.codebook.t()
-        distance = torch.sum(x ** 2, dim=-1, keepdim=True) - 2 * torch.matmul(x, k_w) + torch.sum(k_w ** 2, dim=0,
-                                                                                            keepdim=True)  # (N * L, b)
-        _, code_idx = torch.min(distance, dim=-1)
-        return code_idx
+        return nearest_code(x, self.codebook)
 
     def dequantize(self, code_idx):
         x = F.embedding(code_idx, self.codebook)
@@ -336,23 +346,15 @@ class QuantizeEMA(nn.Module):
         
     @torch.no_grad()
     def compute_perplexity(self, code_idx) : 
-        # Calculate new centres
-        code_onehot = torch.zeros(self.nb_code, code_idx.shape[0], device=code_idx.device)  # nb_code, N * L
-        code_onehot.scatter_(0, code_idx.view(1, code_idx.shape[0]), 1)
-
-        code_count = code_onehot.sum(dim=-1)  # nb_code
-        prob = code_count / torch.sum(code_count)  
-        perplexity = torch.exp(-torch.sum(prob * torch.log(prob + 1e-7)))
+        code_count = count_codes(code_idx, self.nb_code)  # nb_code
+        perplexity = perplexity_from_count(code_count)
         return perplexity
     
     @torch.no_grad()
     def update_codebook(self, x, code_idx):
         
-        code_onehot = torch.zeros(self.nb_code, x.shape[0], device=x.device)  # nb_code, N * L
-        code_onehot.scatter_(0, code_idx.view(1, x.shape[0]), 1)
-
-        code_sum = torch.matmul(code_onehot, x)  # nb_code, w
-        code_count = code_onehot.sum(dim=-1)  # nb_code
+        code_sum = sum_codes(x, code_idx, self.nb_code)  # nb_code, w
+        code_count = count_codes(code_idx, self.nb_code)  # nb_code
 
         # Update centres
         self.code_sum = self.mu * self.code_sum + (1. - self.mu) * code_sum  # w, nb_code
@@ -361,8 +363,7 @@ class QuantizeEMA(nn.Module):
         code_update = self.code_sum.view(self.nb_code, self.code_dim) / self.code_count.view(self.nb_code, 1)
 
         self.codebook = code_update
-        prob = code_count / torch.sum(code_count)  
-        perplexity = torch.exp(-torch.sum(prob * torch.log(prob + 1e-7)))
+        perplexity = perplexity_from_count(code_count)
             
         return perplexity
 
@@ -374,11 +375,7 @@ class QuantizeEMA(nn.Module):
 
     def quantize(self, x):
         # Calculate latent code x_l
-        k_w = self.codebook.t()
-        distance = torch.sum(x ** 2, dim=-1, keepdim=True) - 2 * torch.matmul(x, k_w) + torch.sum(k_w ** 2, dim=0,
-                                                                                            keepdim=True)  # (N * L, b)
-        _, code_idx = torch.min(distance, dim=-1)
-        return code_idx
+        return nearest_code(x, self.codebook)
 
     def dequantize(self, code_idx):
         x = F.embedding(code_idx, self.codebook)
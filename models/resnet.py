@@ -2,6 +2,16 @@ import torch.nn as nn
 import torch
 # from timm.layers.mlp import SwiGLU
 
+
+def stream_left_context(module, x, pad):
+    """Prepends the cached last `pad` frames of the stream to `x` (b, c, t) and caches the new ones."""
+    if module.stream_cache is None:
+        module.stream_cache = x.new_zeros(x.shape[0], x.shape[1], pad)
+    x = torch.cat([module.stream_cache, x], dim=-1)
+    module.stream_cache = x[..., x.shape[-1] - pad:]
+    return x
+
+
 class nonlinearity(nn.Module):
     def __init__(self):
         super().__init__()
@@ -119,8 +129,13 @@ class CausalResConv1DBlock(nn.Module):
         # 调整卷积层，设置 padding=0
         self.conv1 = nn.Conv1d(n_in, n_state, kernel_size=3, stride=1, padding=0, dilation=dilation)
         self.conv2 = nn.Conv1d(n_state, n_in, kernel_size=1, stride=1, padding=0)
+        # last `left_padding` conv1 inputs of a stream, see `step`
+        self.stream_cache = None
 
-    def forward(self, x):
+    def step(self, x):
+        return self.forward(x, stream=True)
+
+    def forward(self, x, stream=False):
         x_orig = x
         if self.norm == "LN":
             x = self.norm1(x.transpose(-2, -1)).transpose(-2, -1)
@@ -130,7 +145,10 @@ class CausalResConv1DBlock(nn.Module):
             x = self.activation1(x)
 
         # 手动对输入进行左侧填充，实现因果卷积
-        x = nn.functional.pad(x, (self.left_padding, 0))
+        if stream:
+            x = stream_left_context(self, x, self.left_padding)
+        else:
+            x = nn.functional.pad(x, (self.left_padding, 0))
 
         x = self.conv1(x)
 
@@ -164,4 +182,9 @@ class CausalResnet1D(nn.Module):
         self.model = nn.Sequential(*blocks)
 
     def forward(self, x):
-        return self.model(x)
\ No newline at end of file
+        return self.model(x)
+
+    def step(self, x):
+        for block in self.model:
+            x = block.step(x)
+        return x
\ No newline at end of file
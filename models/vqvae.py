@@ -1,4 +1,6 @@
+import torch
 import torch.nn as nn
+from contextlib import contextmanager
 from models.encdec import Encoder, Decoder
 from models.quantize_cnn import QuantizeEMAReset, Quantizer, QuantizeEMA, QuantizeReset
 from models.LFQ import LFQ
@@ -6,6 +8,27 @@ from models.FSQ import FSQ
 from models.causal_cnn import CausalEncoder, CausalDecoder
 
 
+@contextmanager
+def mask_padded_frames(module, lengths, T):
+    """Zeros the frames past `lengths` (bs,) at the input of every convolution of `module` that pads in time.
+
+    `lengths` counts frames of a T long input; every layer scales time uniformly, so the valid
+    length of a feature map of t frames is lengths * t // T. Inside the context each padded row
+    is computed as if its sequence had been run on its own.
+    """
+    assert not any(isinstance(m, nn.GroupNorm) for m in module.modules()), 'GroupNorm mixes padded frames into the valid ones'
+    def mask_padding(m, inputs):
+        t = inputs[0].shape[-1]
+        mask = torch.arange(t, device=lengths.device)[None] < (lengths * t // T)[:, None]
+        return (inputs[0] * mask[:, None].to(inputs[0].dtype),) + inputs[1:]
+    hooks = [m.register_forward_pre_hook(mask_padding) for m in module.modules() if isinstance(m, nn.Conv1d) and m.padding[0] > 0]
+    try:
+        yield
+    finally:
+        for hook in hooks:
+            hook.remove()
+
+
 class VQVAE_251(nn.Module):
     def __init__(self,
                  args,
@@ -69,7 +92,7 @@ class VQVAE_251(nn.Module):
                 levels = [8, 8, 8, 5, 5, 5]
             else:
                 raise ValueError('Unsupported number of codebooks')
-            self.quantizer = FSQ(levels=levels, dim=code_dim)
+            self.quantizer = FSQ(levels=levels, dim=code_dim, track_usage=getattr(args, 'track_usage', False))
 
     def preprocess(self, x):
         # (bs, T, Jx3) -> (bs, Jx3, T)
@@ -124,15 +147,78 @@ class VQVAE_251(nn.Module):
         return x_out, loss, perplexity, activate, indices
 
 
-    def forward_decoder(self, x):
+    def forward_decoder(self, x, chunk_size=None):
         x_d = self.quantizer.dequantize(x)
         x_d = x_d.view(1, -1, self.code_dim).permute(0, 2, 1).contiguous()
         
-        # decoder
-        x_decoder = self.decoder(x_d)
+        # decoder, optionally in overlapping windows of chunk_size codes to bound the activation memory
+        if chunk_size is not None:
+            assert isinstance(self.decoder, Decoder), 'chunked decoding is for the non-causal decoder, stream the causal one'
+            x_decoder = self.decoder.forward_chunked(x_d, chunk_size)
+        else:
+            x_decoder = self.decoder(x_d)
+        x_out = self.postprocess(x_decoder)
+        return x_out
+
+    def reset_decoder_stream(self):
+        assert isinstance(self.decoder, CausalDecoder), 'streaming decoding needs the causal tokenizer (--causal)'
+        self.decoder.reset_stream()
+
+    def forward_decoder_stream(self, x):
+        """Decodes the next codes (bs, t) of a stream started by `reset_decoder_stream`, returns their new frames."""
+        x_d = self.quantizer.dequantize(x)
+        x_d = x_d.view(x.shape[0], -1, self.code_dim).permute(0, 2, 1).contiguous()
+        x_decoder = self.decoder.forward_stream(x_d)
         x_out = self.postprocess(x_decoder)
         return x_out
 
+    def forward_decoder_batch(self, x, lengths):
+        """Decodes right padded code sequences (bs, T) with their `lengths` (bs,) in one pass.
+
+        Every convolution that looks ahead gets zeros past the end of a sequence, as when that
+        sequence is decoded alone, so each row matches `forward_decoder` on its own codes.
+        Returns the motions (bs, T_out, C), the frame counts (bs,) and the frame mask (bs, T_out).
+        """
+        bs, T = x.shape
+        code_mask = torch.arange(T, device=x.device)[None] < lengths[:, None]
+        x_d = self.quantizer.dequantize(x.masked_fill(~code_mask, 0))
+        x_d = x_d.view(bs, T, self.code_dim).permute(0, 2, 1).contiguous()
+        with mask_padded_frames(self.decoder, lengths, T):
+            x_decoder = self.decoder(x_d)
+        x_out = self.postprocess(x_decoder)
+
+        frame_lengths = lengths * x_out.shape[1] // T
+        frame_mask = torch.arange(x_out.shape[1], device=x.device)[None] < frame_lengths[:, None]
+        return x_out, frame_lengths, frame_mask
+
+    def forward_batch(self, x, lengths):
+        """Reconstructs right padded motions (bs, T, C) with their frame `lengths` (bs,) in one pass.
+
+        Lengths must be multiples of the temporal downsampling rate (the datasets crop to
+        unit_length), each row then matches `forward` on its motion alone.
+        Returns the motions (bs, T, C), the frame mask (bs, T), the codes (bs, T_code) and the code mask (bs, T_code).
+        """
+        x_in = self.preprocess(x)
+        T = x_in.shape[-1]
+        with mask_padded_frames(self.encoder, lengths, T):
+            x_encoder = self.encoder(x_in)
+
+        if self.quant in ["LFQ", "BSQ", "FSQ"]:
+            x_quantized, _, _, _, _, indices = self.quantizer(x_encoder)
+        else:
+            x_quantized, _, _, _, indices = self.quantizer(x_encoder)
+        indices = indices.view(x.shape[0], -1)
+
+        T_code = x_quantized.shape[-1]
+        code_lengths = lengths * T_code // T
+        with mask_padded_frames(self.decoder, code_lengths, T_code):
+            x_decoder = self.decoder(x_quantized)
+        x_out = self.postprocess(x_decoder)
+
+        frame_mask = torch.arange(x_out.shape[1], device=x.device)[None] < (lengths * x_out.shape[1] // T)[:, None]
+        code_mask = torch.arange(T_code, device=x.device)[None] < code_lengths[:, None]
+        return x_out, frame_mask, indices, code_mask
+
 
 
 class HumanVQVAE(nn.Module):
@@ -171,7 +257,19 @@ class HumanVQVAE(nn.Module):
         
         return x_out, loss, perplexity, activate, indices
 
-    def forward_decoder(self, x):
-        x_out = self.vqvae.forward_decoder(x)
+    def forward_decoder(self, x, chunk_size=None):
+        x_out = self.vqvae.forward_decoder(x, chunk_size)
         return x_out
+
+    def forward_decoder_batch(self, x, lengths):
+        return self.vqvae.forward_decoder_batch(x, lengths)
+
+    def forward_batch(self, x, lengths):
+        return self.vqvae.forward_batch(x, lengths)
+
+    def reset_decoder_stream(self):
+        self.vqvae.reset_decoder_stream()
+
+    def forward_decoder_stream(self, x):
+        return self.vqvae.forward_decoder_stream(x)
         
\ No newline at end of file
@@ -58,11 +58,16 @@ def get_args_parser():
     parser.add_argument("--ff-rate", type=int, default=4, help="feedforward size")
     parser.add_argument("--drop-out-rate", type=float, default=0.1, help="dropout ratio in the pos encoding")
     parser.add_argument("--tie-weights", action='store_true', help="tie the weights of the lm head and the transformer")
+    parser.add_argument("--factorized_head", type=str, default=None, choices=['causal', 'joint'], help="FSQ only: per-level input embeddings and output heads plus a stop head instead of the nb_code + 2 way ones")
     
 
     ## text encoder 
     parser.add_argument("--text_encode", type=str, default='clip', choices = ['clip', 'flan-t5-xxl', 'flan-t5-xl'], help="eps for optimal transport")
     parser.add_argument("--text_sum_way", type=str, default=None, choices = ['cls', 'mean', 'sum'], help="eps for optimal transport")
+    parser.add_argument('--text_feat_dir', type=str, default=None, help='precomputed text feature store (train_t2m_get_text_feats.py), the text encoder is not loaded for training; motionmillion only')
+    parser.add_argument('--text_feat_dtype', type=str, default='bf16', choices=['fp16', 'bf16'], help='dtype of the precomputed text features')
+    parser.add_argument('--codes_shard_size', type=int, default=10000, help='number of motions per code extraction shard')
+    parser.add_argument('--text_feat_shard_mb', type=int, default=1024, help='size of one text feature shard in MB')
     ## quantizer
     parser.add_argument("--quantizer", type=str, default='ema_reset', choices = ['ema', 'orig', 'ema_reset', 'reset', 'FSQ'], help="eps for optimal transport")
     parser.add_argument('--quantbeta', type=float, default=1.0, help='dataset directory')
@@ -96,6 +101,12 @@ def get_args_parser():
 
     # llama args
     parser.add_argument('--pretrained_llama', type=str, default='7B', choices=['44M', '111M', '343M', '775M', '1B', '3B', '5B', '7B', '13B', '30B', '65B'], help='pretrained llama model')
+    parser.add_argument('--draft_llama', type=str, default=None, choices=['44M', '111M', '343M', '775M', '1B', '3B', '5B', '7B', '13B', '30B', '65B'], help='size of the draft model of speculative decoding, trained with the same options as the main one')
+    parser.add_argument('--resume_draft', type=str, default=None, help='draft model pth, sampling is speculative when given')
+    parser.add_argument('--nb_draft_tokens', type=int, default=4, help='tokens proposed by the draft model per verification forward')
+    parser.add_argument('--quant_bits', type=int, default=8, choices=[4, 8], help='weight bits of the GPTQ checkpoint written by quantize_t2m_llama.py')
+    parser.add_argument('--quant_groupsize', type=int, default=-1, help='input columns sharing one GPTQ scale and zero, -1 for one per output row')
+    parser.add_argument('--quant_nb_captions', type=int, default=256, help='number of training captions the GPTQ calibration runs on')
 
     ## motionx
     parser.add_argument('--motion_type', type=str, default='vector_263', help='motion type')
@@ -105,6 +116,11 @@ def get_args_parser():
 
     ## loss type
     parser.add_argument('--loss_type', type=str, default='ce', help='loss type')
+    parser.add_argument('--loss_chunk_size', type=int, default=1024, help='number of target positions per lm_head + cross-entropy chunk')
+
+    ## evaluation
+    parser.add_argument('--eval_cache_dir', type=str, default=None, help='where the evaluator ground-truth embeddings of a split are cached, defaults to <dataset>/eval_cache')
+    parser.add_argument('--eval_bundle_dir', type=str, default=None, help='evaluation split prebuilt by eval_build_bundle.py, defaults to <dataset>/eval_bundle/<motion_type>/<version>/<split>')
 
     # other
     parser.add_argument('--mixed_precision', type=str, default='no', choices=['no', 'fp16', 'bf16'], help='mixed precision')
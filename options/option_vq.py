@@ -57,6 +57,7 @@ def get_args_parser():
     parser.add_argument('--eval-iter', default=3000, type=int, help='evaluation frequency')
     parser.add_argument('--save-iter', default=10000, type=int, help='save frequency')
     parser.add_argument('--save-latest', default=1000, type=int, help='whether save the latest model')
+    parser.add_argument('--track-usage', action='store_true', help='keep a running FSQ code histogram, logged at print-iter and dumped with the checkpoints')
     parser.add_argument('--seed', default=123, type=int, help='seed for initializing training.')
     
     parser.add_argument('--vis-gt', action='store_true', help='whether visualize GT motions')
@@ -71,6 +72,8 @@ def get_args_parser():
     parser.add_argument('--text_type', type=str, default='texts', help='text type')
     parser.add_argument('--version', type=str, default='version1', help='version')
     parser.add_argument('--num-workers', type=int, default=40, help='number of workers')
+    parser.add_argument('--packed-dir', type=str, default=None, help='motions packed by train_tokenizer_pack_motions.py, read instead of the .npy files')
+    parser.add_argument('--pack-shard-mb', type=int, default=4096, help='size of one packed motion shard in MB')
     
     # visualization
     parser.add_argument('--savegif', type=bool, default=False, help='save gif')
@@ -76,13 +76,14 @@ def mirror_rot_trans(lrot, trans, names, parents):
 
 def accumulate_rotations(relative_rotations):
     """Accumulate relative rotations to get overall rotation"""
-    # Initial rotation is rotation matrix
-    R_total = [relative_rotations[0]]
-    # Iterate through all relative rotations, accumulating them step by step
-    for R_rel in relative_rotations[1:]:
-        R_total.append(np.matmul(R_rel, R_total[-1]))
-    
-    return np.array(R_total)
+    # R_t = R_rel_t @ R_{t-1} as a prefix product: log2(nfrm) batched matmuls instead of one per frame,
+    # the same scan as accumulate_rotations_scan in the top level utils/motion_process.py
+    R_total = np.asarray(relative_rotations)
+    step = 1
+    while step < len(R_total):
+        R_total = np.concatenate([R_total[:step], np.matmul(R_total[step:], R_total[:-step])], axis=0)
+        step *= 2
+    return R_total
 
 def rotations_matrix_to_smplx85(rotations_matrix, translation):
     
@@ -0,0 +1,169 @@
+import os
+import json
+import torch
+import clip
+
+import options.option_transformer as option_trans
+import models.vqvae as vqvae
+import utils.utils_model as utils_model
+from models.lit_llama.model_hf import LLaMAHF, LLaMAHFConfig
+from models.lit_llama.quantization import GPTQQuantizer
+from transformers import T5EncoderModel, T5Tokenizer
+from dataset import dataset_TM_train_motionmillion
+from dataset.text_feat_store import TextFeatureStore
+from tqdm import tqdm
+
+
+# quantized in this order inside every block, each one is calibrated on the outputs of the already quantized ones
+BLOCK_LINEARS = ['attn.c_attn', 'attn.c_proj', 'mlp.c_fc1', 'mlp.c_fc2', 'mlp.c_proj']
+
+
+@torch.no_grad()
+def collect_calibration_batches(train_loader, nb_captions, device):
+    # (idx, feat_clip_text, y_mask) of the first nb_captions training samples, cut to the longest sequence of each batch
+    batches, nb = [], 0
+    for clip_text, m_tokens, m_tokens_len, feat_clip_text, y_mask, text_tokens_len in train_loader:
+        if len(y_mask.shape) == 1:
+            y_mask = y_mask.unsqueeze(1)
+            feat_clip_text = feat_clip_text.unsqueeze(1)
+        seq = int((text_tokens_len.view(-1) + m_tokens_len.view(-1)).max()) + 1
+        batches.append((m_tokens[:, :seq].to(device), feat_clip_text.to(device=device, dtype=torch.float), y_mask.to(device)))
+        nb += len(clip_text)
+        if nb >= nb_captions:
+            break
+    return batches
+
+
+@torch.no_grad()
+def llama_blockwise_quantization(trans_encoder, batches, device, bits, groupsize):
+    """GPTQ of the linear layers of every block and of the lm_head, in place, one block on `device` at a time.
+
+    The text projection, the embeddings and a tied or factorized head stay in full precision.
+    Returns the names of the quantized modules.
+    """
+    for module in (trans_encoder.transformer.wte, trans_encoder.llama_proj):
+        module.to(device)
+    inps = [trans_encoder.embed(idx, feat_clip_text, y_mask) for idx, feat_clip_text, y_mask in batches]
+    y_masks = [y_mask for _, _, y_mask in batches]
+
+    quantized = []
+    for i, block in enumerate(tqdm(trans_encoder.transformer.h)):
+        block.to(device)
+        for name in BLOCK_LINEARS:
+            module = block.get_submodule(name)
+            quantizer = GPTQQuantizer(module, bits=bits, groupsize=groupsize, actorder=(groupsize == -1))
+            handle = module.register_forward_hook(quantizer.collect_input_stats)
+            for x, y_mask in zip(inps, y_masks):
+                block(x, y_mask)
+            handle.remove()
+            q_module, error = quantizer.quantize()
+            parent, _, attr = name.rpartition('.')
+            setattr(block.get_submodule(parent), attr, q_module)
+            quantized.append(f'transformer.h.{i}.{name}')
+            del quantizer
+        inps = [block(x, y_mask) for x, y_mask in zip(inps, y_masks)]
+        block.cpu()
+
+    if isinstance(trans_encoder.lm_head, torch.nn.Linear) and not trans_encoder.config.tie_weights:
+        trans_encoder.transformer.ln_f.to(device)
+        quantizer = GPTQQuantizer(trans_encoder.lm_head.to(device), bits=bits, groupsize=groupsize, actorder=(groupsize == -1))
+        # the stats only need the head input, the (b, t, vocab_size - 1) logits are never built
+        for x in inps:
+            quantizer.collect_input_stats(None, (trans_encoder.transformer.ln_f(x),), None)
+        trans_encoder.lm_head, error = quantizer.quantize()
+        quantized.append('lm_head')
+    return quantized
+
+
+if __name__ == '__main__':
+
+    ##### ---- Exp dirs ---- #####
+    args = option_trans.get_args_parser()
+    torch.manual_seed(args.seed)
+    args.out_dir = os.path.join(args.out_dir, f'{args.exp_name}')
+    os.makedirs(args.out_dir, exist_ok = True)
+
+    comp_device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    ##### ---- Logger ---- #####
+    logger = utils_model.get_logger(args.out_dir)
+    logger.info(json.dumps(vars(args), indent=4, sort_keys=True))
+
+    ##### ---- Text encoder ---- #####
+    if args.text_feat_dir is not None:
+        clip_model = None
+        args.clip_dim = TextFeatureStore(args.text_feat_dir).dim
+        logger.info(f'Text features are read from {args.text_feat_dir}')
+    elif args.text_encode == 'clip':
+        clip_model, clip_preprocess = clip.load("ViT-B/32", device=comp_device, jit=False)
+        clip.model.convert_weights(clip_model)
+        clip_model.eval()
+        for p in clip_model.parameters():
+            p.requires_grad = False
+    elif args.text_encode == 'flan-t5-xl':
+        tokenizer = T5Tokenizer.from_pretrained('checkpoints/models--google--flan-t5-xl/snapshots/7d6315df2c2fb742f0f5b556879d730926ca9001', local_files_only=True)
+        text_encoder = T5EncoderModel.from_pretrained('checkpoints/models--google--flan-t5-xl/snapshots/7d6315df2c2fb742f0f5b556879d730926ca9001', local_files_only=True).to(device=comp_device)
+        clip_model = (tokenizer, text_encoder)
+        clip_model[1].eval()
+        for p in clip_model[1].parameters():
+            p.requires_grad = False
+        args.clip_dim = 2048
+        logger.info(f'Flan-t5-xl loaded')
+    elif args.text_encode == 'flan-t5-xxl':
+        tokenizer = T5Tokenizer.from_pretrained('checkpoints/models--google--flan-t5-xxl/snapshots/ae7c9136adc7555eeccc78cdd960dfd60fb346ce', local_files_only=True)
+        text_encoder = T5EncoderModel.from_pretrained('checkpoints/models--google--flan-t5-xxl/snapshots/ae7c9136adc7555eeccc78cdd960dfd60fb346ce', local_files_only=True).to(device=comp_device)
+        clip_model = (tokenizer, text_encoder)
+        clip_model[1].eval()
+        for p in clip_model[1].parameters():
+            p.requires_grad = False
+        args.clip_dim = 4096
+        logger.info(f'Flan-t5-xxl loaded')
+    else:
+        raise ValueError(f'Unknown text encoder: {args.text_encode}')
+
+    ##### ---- Network ---- #####
+    # only the quantizer settings of the VQVAE are read, its weights are not needed
+    net = vqvae.HumanVQVAE(args, ## use args to define different parameters in different quantizers
+                        args.nb_code,
+                        args.code_dim,
+                        args.output_emb_width,
+                        args.down_t,
+                        args.stride_t,
+                        args.width,
+                        args.depth,
+                        args.dilation_growth_rate,
+                        args.vq_act,
+                        args.vq_norm,
+                        args.kernel_size,
+                        args.use_patcher,
+                        args.patch_size,
+                        args.patch_method,
+                        args.use_attn)
+
+    args.nb_code = net.vqvae.quantizer.codebook_size
+    config = LLaMAHFConfig.from_name(args.pretrained_llama)
+    config.block_size = args.block_size
+    config.vocab_size = args.nb_code + 2
+    config.clip_dim = args.clip_dim
+
+    config.tie_weights = args.tie_weights
+    if args.factorized_head is not None:
+        assert args.quantizer == 'FSQ', 'the factorized head needs FSQ codes'
+        config.factorized_head = args.factorized_head
+        config.fsq_levels = net.vqvae.quantizer._levels.tolist()
+    print(config)
+    # stays on the cpu, the blocks are moved to comp_device one at a time
+    trans_encoder = LLaMAHF.from_checkpoint(config, args.resume_trans)
+    logger.info(f'Load transformer model successfully!, from {args.resume_trans}')
+
+    ##### ---- Calibration ---- #####
+    train_loader = dataset_TM_train_motionmillion.DATALoader(args.dataname, args.batch_size, args.nb_code, args.vq_name, args.train_split, clip_model, args.text_encode, args.text_sum_way, comp_device, motion_type=args.motion_type, text_type=args.text_type, version=args.version, unit_length=2**args.down_t, debug=args.debug, num_workers=args.num_workers, text_feat_dir=args.text_feat_dir)
+    batches = collect_calibration_batches(train_loader, args.quant_nb_captions, comp_device)
+    logger.info(f'Calibrating on {sum(len(idx) for idx, _, _ in batches)} captions')
+
+    ##### ---- GPTQ ---- #####
+    modules = llama_blockwise_quantization(trans_encoder, batches, comp_device, args.quant_bits, args.quant_groupsize)
+    quantization = {'bits': args.quant_bits, 'groupsize': args.quant_groupsize, 'modules': modules}
+    out_path = os.path.join(args.out_dir, f'net_int{args.quant_bits}.pth')
+    torch.save({'trans': trans_encoder.cpu().state_dict(), 'quantization': quantization}, out_path)
+    logger.info(f'{len(modules)} linear layers quantized to {args.quant_bits} bits, saved to {out_path}')
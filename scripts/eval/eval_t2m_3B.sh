@@ -1,4 +1,4 @@
-python eval_t2m_llama.py \
+accelerate launch --num_processes 8 eval_t2m_llama.py \
 --exp-name 3B_val_24w \
 --batch-size 16 \
 --num-layers 9 \
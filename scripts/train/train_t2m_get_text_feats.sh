@@ -0,0 +1,10 @@
+export NCCL_TIMEOUT=1200
+accelerate launch --num_processes 8 train_t2m_get_text_feats.py \
+--exp-name get_text_feats \
+--batch-size 256 \
+--vq-name VQVAE_codebook_65536_FSQ_all \
+--dataname motionmillion \
+--text_encode flan-t5-xl \
+--text_feat_dir ./dataset/MotionMillion/flan-t5-xl_feats \
+--text_feat_dtype bf16 \
+--out-dir results/output/T2M/600iterFSQ
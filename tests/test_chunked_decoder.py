@@ -0,0 +1,19 @@
+import pytest
+import torch
+
+from models.encdec import Decoder
+
+
+@pytest.mark.parametrize('down_t, depth, dilation_growth_rate, kernel_size', [(2, 2, 3, 3), (3, 3, 3, 3), (1, 2, 2, 5)])
+@pytest.mark.parametrize('chunk_size', [1, 4, 5, 16, 64])
+def test_forward_chunked_matches_forward(down_t, depth, dilation_growth_rate, kernel_size, chunk_size):
+    torch.manual_seed(0)
+    decoder = Decoder(input_emb_width=7, output_emb_width=8, down_t=down_t, width=16, depth=depth,
+                      dilation_growth_rate=dilation_growth_rate, kernel_size=kernel_size).double().eval()
+    # 23 codes, not a multiple of any chunk size but 1
+    x = torch.randn(2, 8, 23, dtype=torch.double)
+    with torch.no_grad():
+        full = decoder(x)
+        chunked = decoder.forward_chunked(x, chunk_size)
+    assert chunked.shape == full.shape
+    assert torch.allclose(chunked, full, rtol=0, atol=1e-10)
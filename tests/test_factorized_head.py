@@ -0,0 +1,44 @@
+import pytest
+import torch
+
+from models.lit_llama.model_hf import FactorizedHead
+
+LEVELS = [3, 4, 2]
+
+
+@pytest.mark.parametrize('factorization', ['causal', 'joint'])
+def test_forward_matches_teacher_forced_loss(factorization):
+    torch.manual_seed(0)
+    head = FactorizedHead(LEVELS, 16, factorization).double()
+    for p in head.parameters():
+        torch.nn.init.normal_(p)
+    hidden = torch.randn(2, 5, 16, dtype=torch.double)
+    with torch.no_grad():
+        logp = head(hidden)
+    assert logp.shape == (2, 5, head.nb_code + 1)
+    assert torch.allclose(logp.exp().sum(dim=-1), torch.ones(2, 5, dtype=torch.double))
+
+    # every token, the end token included, scored one position at a time by the training loss
+    flat = hidden.flatten(0, 1)
+    for token in range(head.nb_code + 1):
+        targets = torch.full((flat.shape[0],), token)
+        with torch.no_grad():
+            for row in range(flat.shape[0]):
+                loss, _, _ = head.loss(flat[row:row + 1], targets[row:row + 1], ignore_index=-1)
+                assert torch.allclose(-loss, logp.flatten(0, 1)[row, token])
+
+
+def test_greedy_causal_picks_the_greedy_digits():
+    torch.manual_seed(0)
+    head = FactorizedHead(LEVELS, 16, 'causal').double()
+    hidden = torch.randn(7, 16, dtype=torch.double)
+    with torch.no_grad():
+        codes = head.next_token(hidden)
+        logp = head(hidden)
+    # an emitted code has at least the probability of every code sharing all its digits but the last
+    for row, code in enumerate(codes.tolist()):
+        if code == head.nb_code:
+            continue
+        prefix = code % int(head.basis[-1])
+        siblings = prefix + head.basis[-1] * torch.arange(LEVELS[-1])
+        assert logp[row, code] >= logp[row, siblings].max()
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+import torch
+
+from utils.face_z_align_util import rotation_6d_to_matrix
+from utils.motion_process import (accumulate_rotations, accumulate_rotations_loop, accumulate_rotations_scan,
+                                  recover_from_local_position, recover_from_local_position_batch, recover_from_local_position_loop,
+                                  recover_from_local_rotation, recover_from_local_rotation_batch, recover_from_local_rotation_loop)
+
+NJOINT = 22
+
+
+def random_motion(rng, nfrm):
+    # de-normalized 272-dim features, float64 like the numpy reference
+    return rng.standard_normal((nfrm, 8 + 12 * NJOINT))
+
+
+@pytest.mark.parametrize('nfrm', [1, 2, 7, 64, 100])
+def test_accumulate_rotations_scan_matches_loop(nfrm):
+    rng = np.random.default_rng(nfrm)
+    relative = rotation_6d_to_matrix(torch.from_numpy(rng.standard_normal((nfrm, 6)))).numpy()
+    expected = accumulate_rotations_loop(relative)
+    np.testing.assert_allclose(accumulate_rotations(relative), expected, rtol=0, atol=1e-10)
+    batched = accumulate_rotations_scan(torch.from_numpy(np.stack([relative, relative[::-1].copy()])))
+    np.testing.assert_allclose(batched[0].numpy(), expected, rtol=0, atol=1e-10)
+    np.testing.assert_allclose(batched[1].numpy(), accumulate_rotations_loop(relative[::-1]), rtol=0, atol=1e-10)
+
+
+@pytest.mark.parametrize('nfrm', [1, 5, 60])
+def test_single_sequence_recovery_matches_loop(nfrm):
+    final_x = random_motion(np.random.default_rng(nfrm), nfrm)
+    np.testing.assert_allclose(recover_from_local_position(final_x, NJOINT), recover_from_local_position_loop(final_x, NJOINT), rtol=0, atol=1e-8)
+    np.testing.assert_allclose(recover_from_local_rotation(final_x, NJOINT), recover_from_local_rotation_loop(final_x, NJOINT), rtol=0, atol=1e-8)
+
+
+@pytest.mark.parametrize('recover_batch, recover_loop', [(recover_from_local_position_batch, recover_from_local_position_loop),
+                                                         (recover_from_local_rotation_batch, recover_from_local_rotation_loop)])
+def test_right_padded_batch_matches_loop(recover_batch, recover_loop):
+    rng = np.random.default_rng(0)
+    lengths = [40, 1, 17, 33]
+    # the padding is garbage, not zeros, it must not reach the valid frames
+    batch = random_motion(rng, len(lengths) * 40).reshape(len(lengths), 40, -1)
+    out = recover_batch(torch.from_numpy(batch), NJOINT, torch.tensor(lengths)).numpy()
+    for i, length in enumerate(lengths):
+        np.testing.assert_allclose(out[i, :length], recover_loop(batch[i, :length], NJOINT), rtol=0, atol=1e-8)
+        assert (out[i, length:] == 0).all()
@@ -0,0 +1,49 @@
+import pytest
+import torch
+import torch.nn.functional as F
+
+from models.lit_llama.model_hf import LLaMAHFConfig, LengthCausalSelfAttention, build_prefix_lm_mask, build_rope_cache, apply_rope
+
+
+def dense_prefix_lm_mask(y_mask, T):
+    # the B x T x T mask LengthCausalSelfAttention used to build
+    B = y_mask.shape[0]
+    attn_mask = torch.tril(torch.ones(T, T, dtype=torch.bool)).unsqueeze(0).expand(B, -1, -1)
+    text_mask = y_mask.unsqueeze(2) * y_mask.unsqueeze(1)
+    text_mask = F.pad(text_mask, (0, T - y_mask.shape[1], 0, T - y_mask.shape[1]), mode='constant', value=0)
+    return torch.logical_or(attn_mask, text_mask)
+
+
+def dense_attention(attn, x, y_mask):
+    B, T, C = x.size()
+    q, k, v = attn.c_attn(x).split(attn.n_embd, dim=2)
+    head_size = C // attn.n_head
+    k = k.view(B, T, attn.n_head, head_size).transpose(1, 2)
+    q = q.view(B, T, attn.n_head, head_size).transpose(1, 2)
+    v = v.view(B, T, attn.n_head, head_size).transpose(1, 2)
+    rope_cache = build_rope_cache(seq_len=attn.block_size, n_elem=head_size, dtype=torch.float32, device=x.device)
+    q = apply_rope(q, rope_cache)
+    k = apply_rope(k, rope_cache)
+    attn_mask = dense_prefix_lm_mask(y_mask, T)
+    y = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask.unsqueeze(1), dropout_p=0.0, is_causal=False)
+    return attn.c_proj(y.transpose(1, 2).contiguous().view(B, T, C))
+
+
+# right padded text prefixes of different lengths
+Y_MASK = torch.tensor([[1, 1, 1, 0, 0, 0],
+                       [1, 1, 1, 1, 1, 1],
+                       [1, 0, 0, 0, 0, 0]], dtype=torch.float)
+
+
+@pytest.mark.parametrize('T', [11, 6, 4])
+def test_fused_prefix_attention_matches_dense_mask(T):
+    torch.manual_seed(0)
+    attn = LengthCausalSelfAttention(LLaMAHFConfig(block_size=32, vocab_size=10, n_layer=1, n_head=2, n_embd=16))
+    x = torch.randn(Y_MASK.shape[0], T, 16)
+    with torch.no_grad():
+        assert torch.allclose(attn(x, Y_MASK), dense_attention(attn, x, Y_MASK), atol=1e-5)
+
+
+@pytest.mark.parametrize('T', [11, 6])
+def test_build_prefix_lm_mask_matches_dense_mask(T):
+    assert torch.equal(build_prefix_lm_mask(Y_MASK, torch.arange(T), T), dense_prefix_lm_mask(Y_MASK, T))
@@ -0,0 +1,52 @@
+import pytest
+import torch
+
+from models.lit_llama.quantization import ColBlockQuantizedLinear, GPTQQuantizer
+
+
+def grid_weight(weight, bits, tile_cols):
+    # per tile scales and zeros of GPTQ and the weight Q rounded onto their grid
+    quantizer = GPTQQuantizer(torch.nn.Linear(weight.shape[1], weight.shape[0], bias=False), bits=bits, groupsize=tile_cols)
+    scales, zeros, Q = [], [], torch.empty_like(weight)
+    for j in range(0, weight.shape[1], quantizer.tile_cols):
+        tile = weight[:, j:j + quantizer.tile_cols]
+        scale, zero = quantizer.find_params_weight(tile)
+        Q[:, j:j + quantizer.tile_cols] = GPTQQuantizer.quantize_weight(tile, scale, zero, quantizer.maxq)
+        scales.append(scale)
+        zeros.append(zero)
+    return torch.cat(scales, dim=1), torch.cat(zeros, dim=1), Q
+
+
+@pytest.mark.parametrize('bits', [4, 8])
+@pytest.mark.parametrize('tile_cols', [-1, 32, 48])
+def test_pack_then_get_weight_gives_back_Q(bits, tile_cols):
+    torch.manual_seed(0)
+    weight = torch.randn(64, 128)
+    scales, zeros, Q = grid_weight(weight, bits, tile_cols)
+
+    q_module = ColBlockQuantizedLinear(128, 64, False, bits=bits, tile_cols=tile_cols)
+    q_module.scales = scales
+    q_module.zeros = zeros
+    q_module.pack_weight(Q)
+    assert torch.equal(q_module.get_weight(), Q)
+
+
+@pytest.mark.parametrize('bits', [4, 8])
+@pytest.mark.parametrize('groupsize', [-1, 32])
+def test_gptq_weight_is_on_the_grid(bits, groupsize):
+    torch.manual_seed(0)
+    linear = torch.nn.Linear(128, 64, bias=False)
+    quantizer = GPTQQuantizer(linear, bits=bits, groupsize=groupsize, actorder=(groupsize == -1))
+    for _ in range(4):
+        quantizer.collect_input_stats(linear, (torch.randn(8, 16, 128),), None)
+    q_module, error = quantizer.quantize()
+
+    weight = q_module.get_weight()
+    scales = q_module.scales.repeat_interleave(q_module.tile_cols, dim=1)[:, :128]
+    zeros = q_module.zeros.repeat_interleave(q_module.tile_cols, dim=1)[:, :128]
+    q = torch.round(weight / scales + zeros)
+    assert q.min() >= 0 and q.max() <= 2 ** bits - 1
+    assert torch.equal((q - zeros) * scales, weight)
+
+    x = torch.randn(4, 128)
+    assert torch.allclose(q_module(x), torch.nn.functional.linear(x, weight))
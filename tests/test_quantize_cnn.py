@@ -0,0 +1,26 @@
+import pytest
+import torch
+
+from models.quantize_cnn import nearest_code
+
+
+def full_argmin(x, codebook, squares_first):
+    # the (N * L, nb_code) distances the quantizers used to build, in their own term order
+    if squares_first:
+        d = torch.sum(x ** 2, dim=1, keepdim=True) + torch.sum(codebook ** 2, dim=1) - 2 * torch.matmul(x, codebook.t())
+    else:
+        k_w = codebook.t()
+        d = torch.sum(x ** 2, dim=-1, keepdim=True) - 2 * torch.matmul(x, k_w) + torch.sum(k_w ** 2, dim=0, keepdim=True)
+    return torch.argmin(d, dim=-1)
+
+
+@pytest.mark.parametrize('squares_first', [False, True])
+@pytest.mark.parametrize('block_size', [7, 64, 4096])
+def test_nearest_code_matches_full_distance_matrix(squares_first, block_size):
+    torch.manual_seed(0)
+    x = torch.randn(300, 16)
+    codebook = torch.randn(200, 16)
+    # duplicated codes, the lowest index must win across blocks as well
+    codebook[150] = codebook[3]
+    x[:10] = codebook[3]
+    assert torch.equal(nearest_code(x, codebook, block_size, squares_first=squares_first), full_argmin(x, codebook, squares_first))
@@ -1,4 +1,5 @@
 import os
+import hashlib
 import torch
 import numpy as np
 
@@ -12,35 +13,80 @@ from dataset import dataset_tokenize
 from tqdm import tqdm
 from accelerate import Accelerator
 from tqdm import tqdm
-import pickle
-
-def merge_into_pickle(root_dir, split_file_path):
-
-    all_files = open(split_file_path, "r").readlines()
-
-    # create data dict
-    data_dict = {
-        "text_data": {},
-        "code_data": {},
-        "file_names": []
-    }
-
-    for files in tqdm(all_files):
-        name = files.strip()
-        data_dict["file_names"].append(name)
-        
-        text_file_path = os.path.join(root_dir, "texts", name + ".txt")
-        code_file_path = os.path.join(root_dir, "VQVAE_codebook_65536_FSQ_all", name + ".npy")
-        
-        text_data = open(text_file_path, "r").readlines()
-        data_dict["text_data"][name] = text_data # processed_text_data
-        
-        code_data = np.load(code_file_path)
-        data_dict["code_data"][name] = code_data
-
-    with open(os.path.join(root_dir, "all_data.pkl"), "wb") as f:
-        pickle.dump(data_dict, f)
-        
+from dataset.motion_token_store import MotionTokenStore, MotionTokenStoreBuilder
+
+def shard_source(shard_names, shard_size, resume_pth):
+    """What a shard was extracted from: its motions, the shard size and the tokenizer checkpoint."""
+    names_hash = hashlib.blake2b('\n'.join(shard_names).encode('utf-8'), digest_size=16).hexdigest()
+    stat = os.stat(resume_pth)
+    return {'nb_motions': len(shard_names), 'names_hash': names_hash, 'shard_size': shard_size,
+            'tokenizer': {'path': os.path.abspath(resume_pth), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}}
+
+
+def is_shard_done(shard_dir, source):
+    # a shard of another split, shard size or tokenizer is stale and extracted again
+    done_path = pjoin(shard_dir, 'done.json')
+    if not os.path.exists(done_path):
+        return False
+    with open(done_path, 'r') as f:
+        return json.load(f) == source
+
+
+def extract_shard(net, dataset, shard_dir, source, batch_size, nb_code, num_workers, device):
+    """Encode the motions of one shard into a packed token store with its code counts.
+
+    Motions are grouped by length, so every batch is encoded without padding and gives the
+    same codes as one motion at a time. At most one partial batch per length is kept in memory.
+    `source` of `shard_source` is written to done.json once the shard is complete.
+    """
+    # a stale shard stays unfinished until it is rewritten
+    if os.path.exists(pjoin(shard_dir, 'done.json')):
+        os.remove(pjoin(shard_dir, 'done.json'))
+    loader = torch.utils.data.DataLoader(dataset, batch_size=None, shuffle=False, num_workers=num_workers)
+    builder = MotionTokenStoreBuilder(shard_dir, nb_code)
+    code_counts = torch.zeros(nb_code + 2, dtype=torch.long, device=device)
+    buckets = {}
+
+    def flush(length):
+        motions, names, texts = zip(*buckets.pop(length))
+        with torch.no_grad():
+            target = net.encode(torch.stack(motions).to(device))
+        code_counts.add_(torch.bincount(target.flatten().long(), minlength=nb_code + 2))
+        target = target.cpu().numpy()
+        for name, code, text_data in zip(names, target, texts):
+            builder.add_motion(name, code[None], text_data)
+
+    for motion, name, text_data in loader:
+        bucket = buckets.setdefault(motion.shape[0], [])
+        bucket.append((motion, name, text_data))
+        if len(bucket) == batch_size:
+            flush(motion.shape[0])
+    for length in list(buckets):
+        flush(length)
+    builder.finalize()
+
+    # every motion ends with one end token
+    code_counts[nb_code] += len(dataset)
+    np.save(pjoin(shard_dir, 'code_counts.npy'), code_counts.cpu().numpy())
+    # written last, the shard is only skipped on resume once everything above is on disk
+    with open(pjoin(shard_dir, 'done.json'), 'w') as f:
+        json.dump(source, f)
+
+
+def merge_shards(shard_dirs, store_dir, prob_dir, nb_code):
+    # the shards are already packed, merging only concatenates their index and data files
+    builder = MotionTokenStoreBuilder(store_dir, nb_code)
+    code_counts = np.zeros(nb_code + 2, dtype=np.int64)
+    for shard_dir in tqdm(shard_dirs):
+        builder.merge_store_(shard_dir)
+        code_counts += np.load(pjoin(shard_dir, 'code_counts.npy'))
+    builder.finalize()
+
+    # calculate and save the probability distribution
+    code_probs = torch.from_numpy(code_counts).float() / code_counts.sum()
+    torch.save(code_probs, prob_dir)
+    return int(code_counts.sum())
+
 if __name__ == '__main__':
 
     ##### ---- Exp dirs ---- #####
@@ -107,46 +153,33 @@ if __name__ == '__main__':
         args.prob_dir = os.path.join(root_dir, f'{args.vq_name}' + '_prob.npy')
     
     # divider --------
-    if accelerator.is_main_process:
-
-        if not os.path.exists(args.vq_dir) or not os.path.exists(args.prob_dir):
-            logger.info(f"Start to get code from the {args.dataname}!")
-            train_loader_token, _, _ = dataset_tokenize.DATALoader(args.dataname, 1, unit_length=2**args.down_t, motion_type=args.motion_type, text_type=args.text_type, version=args.version)
-            os.makedirs(args.vq_dir, exist_ok = True)
-            
-            # initialize the code counts
-            code_counts = torch.zeros(args.nb_code + 2, dtype=torch.long)
-            total_tokens = 0
-            
-            # first loop to count the frequency of each code
-            for batch in tqdm(train_loader_token):
-                pose, name = batch
-                bs, seq = pose.shape[0], pose.shape[1]
-                pose = pose.to(comp_device).float() # bs, nb_joints, joints_dim, seq_len
-                
-                with torch.no_grad():
-                    target = net.encode(pose)
-                    target_with_end = torch.cat([target, torch.ones(target.shape[0], 1).to(target.device) * args.nb_code], dim=1)
-                    # count the frequency of each code
-                    unique_codes, counts = torch.unique(target_with_end, return_counts=True)
-                    for code, count in zip(unique_codes, counts):
-                        code_counts[code.long()] += count.item()
-                    total_tokens += target_with_end.numel()
-                    
-                    # save the code results
-                    target = target.cpu().numpy()
-                    output_path = pjoin(args.vq_dir, name[0] +'.npy')
-                    os.makedirs(os.path.dirname(output_path), exist_ok=True)
-                    np.save(output_path, target)
-            
-            # calculate the probability distribution
-            code_probs = code_counts.float() / total_tokens
-            
-            # save the probability distribution
-            torch.save(code_probs, args.prob_dir)
+    store_dir = args.vq_dir + '_store'
+    if MotionTokenStore.exists(store_dir) and os.path.exists(args.prob_dir):
+        if accelerator.is_main_process:
+            logger.info(f"The code has been saved in {store_dir} before!")
+    else:
+        logger.info(f"Start to get code from the {args.dataname}!")
+        dataset = dataset_tokenize.VQMotionDataset(args.dataname, unit_length=2**args.down_t, motion_type=args.motion_type, text_type=args.text_type, version=args.version)
+        name_list = dataset.name_list
+
+        # fixed size shards of the split, spread over the processes; finished shards are skipped
+        shard_root = args.vq_dir + '_shards'
+        shard_dirs = [pjoin(shard_root, f'shard_{k:05d}') for k in range((len(name_list) + args.codes_shard_size - 1) // args.codes_shard_size)]
+        for k in range(accelerator.process_index, len(shard_dirs), accelerator.num_processes):
+            shard_names = name_list[k * args.codes_shard_size:(k + 1) * args.codes_shard_size]
+            source = shard_source(shard_names, args.codes_shard_size, args.resume_pth)
+            if is_shard_done(shard_dirs[k], source):
+                logger.info(f"Skip {shard_dirs[k]}, it has been extracted before")
+                continue
+            shard_dataset = dataset_tokenize.MotionCodeDataset(dataset.motion_dir, dataset.text_dir, shard_names, dataset.mean, dataset.std, unit_length=2**args.down_t)
+            extract_shard(net, shard_dataset, shard_dirs[k], source, args.batch_size, args.nb_code, args.num_workers, comp_device)
+            logger.info(f"Process {accelerator.process_index} extracted {shard_dirs[k]}")
+
+        accelerator.wait_for_everyone()
+        if accelerator.is_main_process:
+            total_tokens = merge_shards(shard_dirs, store_dir, args.prob_dir, args.nb_code)
+            with open(pjoin(shard_root, 'manifest.json'), 'w') as f:
+                json.dump({'nb_motions': len(name_list), 'nb_tokens': total_tokens, 'shard_size': args.codes_shard_size,
+                           'shards': [os.path.basename(d) for d in shard_dirs]}, f, indent=4)
+            logger.info(f"Codes of {len(name_list)} motions saved to {store_dir}")
             logger.info(f"Code distribution saved to {args.prob_dir}")
-        else:
-            if accelerator.is_main_process:
-                logger.info(f"The code has been saved in {args.vq_dir} before!")
-    
-    merge_into_pickle(root_dir, pjoin(root_dir, "split/version1/t2m_60_300/all.txt"))            
@@ -0,0 +1,97 @@
+import os
+import torch
+import numpy as np
+
+from os.path import join as pjoin
+import json
+import options.option_transformer as option_trans
+import utils.utils_model as utils_model
+from dataset.text_feat_store import TextFeatureStore, TextFeatureStoreWriter, merge_text_feat_index
+from dataset.motion_token_store import MotionTokenStore
+from transformers import T5EncoderModel, T5Tokenizer
+from accelerate import Accelerator
+from tqdm import tqdm
+
+
+def get_unique_captions(store_dir):
+    # every caption the training datasets can draw, already stripped and non-empty in the store
+    return sorted(set(MotionTokenStore(store_dir).iter_captions()))
+
+
+if __name__ == '__main__':
+
+    ##### ---- Exp dirs ---- #####
+    args = option_trans.get_args_parser()
+    torch.manual_seed(args.seed)
+    if args.debug:
+        args.exp_name = 'debug'
+    args.out_dir = os.path.join(args.out_dir, f'{args.exp_name}')
+
+    os.makedirs(args.out_dir, exist_ok = True)
+
+    # accelerate
+    accelerator = Accelerator()
+    comp_device = accelerator.device
+
+    ##### ---- Logger ---- #####
+    logger = utils_model.get_logger(args.out_dir)
+    logger.info(json.dumps(vars(args), indent=4, sort_keys=True))
+
+    if args.dataname == 'motionmillion':
+        root_dir = "./dataset/MotionMillion"
+    elif args.dataname == 'kit':
+        root_dir = "./dataset/KIT-ML"
+    elif args.dataname == 't2m':
+        root_dir = "./dataset/HumanML3D"
+    if args.text_feat_dir is None:
+        args.text_feat_dir = pjoin(root_dir, f'{args.text_encode}_feats')
+
+    if TextFeatureStore.exists(args.text_feat_dir):
+        if accelerator.is_main_process:
+            logger.info(f"The text features have been saved in {args.text_feat_dir} before!")
+        exit()
+
+    ##### ---- Text encoder ---- #####
+    if args.text_encode == 'flan-t5-xl':
+        tokenizer = T5Tokenizer.from_pretrained('checkpoints/models--google--flan-t5-xl/snapshots/7d6315df2c2fb742f0f5b556879d730926ca9001', local_files_only=True)
+        text_encoder = T5EncoderModel.from_pretrained('checkpoints/models--google--flan-t5-xl/snapshots/7d6315df2c2fb742f0f5b556879d730926ca9001', local_files_only=True).to(device=comp_device)
+        args.clip_dim = 2048
+    elif args.text_encode == 'flan-t5-xxl':
+        tokenizer = T5Tokenizer.from_pretrained('checkpoints/models--google--flan-t5-xxl/snapshots/ae7c9136adc7555eeccc78cdd960dfd60fb346ce', local_files_only=True)
+        text_encoder = T5EncoderModel.from_pretrained('checkpoints/models--google--flan-t5-xxl/snapshots/ae7c9136adc7555eeccc78cdd960dfd60fb346ce', local_files_only=True).to(device=comp_device)
+        args.clip_dim = 4096
+    else:
+        raise ValueError(f'The text feature store holds per-token T5 features, not supported for: {args.text_encode}')
+    text_encoder.eval()
+    for p in text_encoder.parameters():
+        p.requires_grad = False
+
+    ##### ---- Encode ---- #####
+    # each process encodes a strided slice of the unique captions into its own shards
+    captions = get_unique_captions(pjoin(root_dir, f'{args.vq_name}_store'))[accelerator.process_index::accelerator.num_processes]
+    logger.info(f"Process {accelerator.process_index} encodes {len(captions)} captions into {args.text_feat_dir}")
+
+    # sort by token count so that a batch holds captions of similar length and pads little
+    lengths = [len(ids) for ids in tokenizer(captions, truncation=True).input_ids]
+    order = np.argsort(lengths, kind='stable')
+
+    prefix = f'rank{accelerator.process_index:03d}'
+    writer = TextFeatureStoreWriter(args.text_feat_dir, prefix, args.clip_dim, dtype=args.text_feat_dtype, shard_mb=args.text_feat_shard_mb)
+    for start in tqdm(range(0, len(order), args.batch_size), disable=not accelerator.is_main_process):
+        batch_captions = [captions[i] for i in order[start:start + args.batch_size]]
+        cap_inputs = tokenizer(batch_captions, padding=True, truncation=True, return_tensors="pt")
+        with torch.no_grad():
+            feat_clip_text = text_encoder(
+                input_ids=cap_inputs.input_ids.to(comp_device),
+                attention_mask=cap_inputs.attention_mask.to(comp_device), output_hidden_states=False
+            ).last_hidden_state
+        feat_clip_text = feat_clip_text.cpu()
+        for caption, feat, n in zip(batch_captions, feat_clip_text, cap_inputs.attention_mask.sum(dim=1).tolist()):
+            writer.add(caption, feat[:n])
+    writer.close()
+
+    accelerator.wait_for_everyone()
+    if accelerator.is_main_process:
+        prefixes = [f'rank{i:03d}' for i in range(accelerator.num_processes)]
+        merge_text_feat_index(args.text_feat_dir, prefixes, args.clip_dim, args.text_feat_dtype, args.text_encode)
+        logger.info(f"Text features of {len(TextFeatureStore(args.text_feat_dir))} captions saved to {args.text_feat_dir}")
@@ -4,7 +4,7 @@ import torch
 import numpy as np
 
 from torch.utils.tensorboard import SummaryWriter
-from torch.distributions import Categorical
+import torch.nn.functional as F
 import json
 import clip
 
@@ -18,6 +18,7 @@ from accelerate import Accelerator
 import torch
 from torch.optim.lr_scheduler import LambdaLR, CosineAnnealingLR
 from dataset import dataset_TM_train, dataset_TM_train_motionmillion
+from dataset.text_feat_store import TextFeatureStore
 
 # 自定义 warm-up + cosine decay scheduler
 class WarmupCosineDecayScheduler:
@@ -106,7 +107,7 @@ def cycle(iterable):
         for x in iterable:
             yield x
 
-def train_one_iter(feat_clip_text, m_tokens, m_tokens_len, y_mask, trans_encoder):
+def train_one_iter(feat_clip_text, m_tokens, m_tokens_len, y_mask, trans_encoder, compute_pred=False):
     
     m_tokens, m_tokens_len = m_tokens.to(comp_device), m_tokens_len.to(comp_device)
     bs = m_tokens.shape[0]
@@ -128,12 +129,11 @@ def train_one_iter(feat_clip_text, m_tokens, m_tokens_len, y_mask, trans_encoder
     r_indices = torch.randint_like(input_index, args.nb_code)
     a_indices = mask*input_index+(1-mask)*r_indices
 
-    cls_pred = trans_encoder(a_indices, feat_clip_text, y_mask)
-    
-    cls_pred = cls_pred.contiguous()
-    
+    # position i predicts token i+1, the last position has nothing to predict
+    target = F.pad(target[..., 1:].to(torch.int64), (0, 1), value=args.nb_code+1)
+    loss_cls, cls_pred_index, target = trans_encoder(a_indices, feat_clip_text, y_mask, targets=target, compute_pred=compute_pred, loss_chunk_size=args.loss_chunk_size)
 
-    return cls_pred, target
+    return loss_cls, cls_pred_index, target
 
 
 if __name__ == '__main__':
@@ -163,7 +163,14 @@ if __name__ == '__main__':
     from utils.word_vectorizer import WordVectorizer
 
     ##### ---- Network ---- #####
-    if args.text_encode == 'clip':
+    if args.text_feat_dir is not None:
+        # the dataset reads precomputed features, the text encoder does not need to be resident
+        if args.dataname != 'motionmillion':
+            raise ValueError(f'--text_feat_dir is only read by the motionmillion dataset, {args.dataname} encodes its captions with the text encoder')
+        clip_model = None
+        args.clip_dim = TextFeatureStore(args.text_feat_dir).dim
+        logger.info(f'Text features are read from {args.text_feat_dir}')
+    elif args.text_encode == 'clip':
         clip_model, clip_preprocess = clip.load("ViT-B/32", device=comp_device, jit=False)  # Must set jit=False for training
         clip.model.convert_weights(clip_model)
         clip_model.eval()
@@ -222,6 +229,11 @@ if __name__ == '__main__':
     #     config.norm_topk_prob = args.norm_topk_prob
 
     config.tie_weights = args.tie_weights
+    if args.factorized_head is not None:
+        # one embedding table and one output head per FSQ level instead of nb_code + 2 rows
+        assert args.quantizer == 'FSQ', 'the factorized head needs FSQ codes'
+        config.factorized_head = args.factorized_head
+        config.fsq_levels = net.vqvae.quantizer._levels.tolist()
     print(config)
     trans_encoder = LLaMAHF(config) # , args.use_qkNorm, args.use_moe)
 
@@ -236,7 +248,8 @@ if __name__ == '__main__':
     net.eval()
     net.to(comp_device)
 
-    nb_iter, avg_loss_cls, avg_acc = 0, 0., 0.
+    nb_iter = 0
+    metrics = utils_model.MetricAccumulator(comp_device)
      
     if args.resume_trans is not None:
         print ('loading transformer checkpoint from {}'.format(args.resume_trans))
@@ -275,8 +288,6 @@ if __name__ == '__main__':
     else:
         raise ValueError(f'Unknown learning rate scheduler: {args.lr_scheduler}')
 
-    right_num = 0
-    nb_sample_train = 0
     
     ##### ---- get code ---- #####
     if args.dataname == 'motionmillion':
@@ -293,10 +304,9 @@ if __name__ == '__main__':
         args.prob_dir = os.path.join("./dataset/HumanML3D", f'{args.vq_name}' + '_prob.npy')
 
     print("Start Training!")
-    loss_ce = torch.nn.CrossEntropyLoss(ignore_index=args.nb_code+1)
 
     if args.dataname == 'motionmillion':
-        train_loader = dataset_TM_train_motionmillion.DATALoader(args.dataname, args.batch_size, args.nb_code, args.vq_name, args.train_split, clip_model, args.text_encode, args.text_sum_way, comp_device, motion_type=args.motion_type, text_type=args.text_type, version=args.version, unit_length=2**args.down_t, debug=args.debug, num_workers=args.num_workers)
+        train_loader = dataset_TM_train_motionmillion.DATALoader(args.dataname, args.batch_size, args.nb_code, args.vq_name, args.train_split, clip_model, args.text_encode, args.text_sum_way, comp_device, motion_type=args.motion_type, text_type=args.text_type, version=args.version, unit_length=2**args.down_t, debug=args.debug, num_workers=args.num_workers, text_feat_dir=args.text_feat_dir)
     else:
         train_loader = dataset_TM_train.DATALoader(args.dataname, args.batch_size, args.nb_code, args.vq_name, 'train', clip_model, args.text_encode, args.text_sum_way, comp_device, motion_type=args.motion_type, text_type=args.text_type, version=args.version, unit_length=2**args.down_t, debug=args.debug)
 
@@ -328,25 +338,13 @@ if __name__ == '__main__':
                 y_mask = y_mask.unsqueeze(1)
                 feat_clip_text = feat_clip_text.unsqueeze(1)
                 
-            cls_pred, target = train_one_iter(feat_clip_text, m_tokens, m_tokens_len, y_mask, trans_encoder)
-            bs = target.shape[0]  
-
-            loss_cls = 0.0
-            
-            cls_pred = cls_pred[..., :-1, :].contiguous()
-            target = target[..., 1:].contiguous().to(torch.int64)
-
-            loss_cls = loss_ce(cls_pred.view(-1, cls_pred.shape[-1]), target.view(-1))
+            # the accuracy is an argmax statistic of the micro-batch right before a log line
+            log_acc = nb_iter % args.gradient_accumulation_steps == 0 and (nb_iter // args.gradient_accumulation_steps + 1) % args.print_iter == 0
+            loss_cls, cls_pred_index, target = train_one_iter(feat_clip_text, m_tokens, m_tokens_len, y_mask, trans_encoder, compute_pred=log_acc)
 
-            probs = torch.softmax(cls_pred.float(), dim=-1)
-            if args.if_maxtest:
-                _, cls_pred_index = torch.max(probs, dim=-1)
-            else:
-                dist = Categorical(probs)
-                cls_pred_index = dist.sample()
-            token_mask = (target != args.nb_code+1)
-            right_num += ((cls_pred_index == target) & token_mask).sum().item()
-            nb_sample_train += token_mask.sum().item()
+            # the loss only covers positions with a motion target, text prefix and padding are skipped
+            if log_acc:
+                metrics.update(right_num=(cls_pred_index == target).sum(), nb_sample=target.shape[0])
 
             optimizer.zero_grad()
             accelerator.backward(loss_cls)
@@ -359,7 +357,7 @@ if __name__ == '__main__':
                 else:
                     scheduler.step()
 
-        avg_loss_cls = avg_loss_cls + loss_cls.item()
+        metrics.update(loss_cls=loss_cls, nb_step=1)
         
         if accelerator.is_main_process:
             lr = optimizer.param_groups[0]['lr']
@@ -372,16 +370,15 @@ if __name__ == '__main__':
         
         actual_nb_iter = (nb_iter-1)//args.gradient_accumulation_steps + 1
         if actual_nb_iter % args.print_iter ==  0 :
+            # the only host-device synchronisation of the logging period, on every rank
+            reduced = metrics.reduce(accelerator)
             if accelerator.is_main_process: 
-                avg_loss_cls = avg_loss_cls / args.print_iter
-                avg_acc = right_num * 100 / nb_sample_train
+                avg_loss_cls = reduced['loss_cls'] / reduced['nb_step']
+                avg_acc = reduced['right_num'] * 100 / reduced['nb_sample']
                 writer.add_scalar('./Loss/train', avg_loss_cls, actual_nb_iter)
                 writer.add_scalar('./ACC/train', avg_acc, actual_nb_iter)
                 msg = f"Train. Iter {actual_nb_iter} : LR. {lr:.6f}, Loss. {avg_loss_cls:.5f}, ACC. {avg_acc:.4f}"
                 logger.info(msg)
-            avg_loss_cls = 0.
-            right_num = 0
-            nb_sample_train = 0
         
         accelerator.wait_for_everyone()
         if actual_nb_iter % args.save_iter == 0 and accelerator.is_main_process:
@@ -70,7 +70,8 @@ train_loader, train_mean, train_std = dataset_VQ.DATALoader(args.dataname,
                                         args.debug,
                                         window_size=args.window_size,
                                         unit_length=2**args.down_t,
-                                        num_workers=args.num_workers)
+                                        num_workers=args.num_workers,
+                                        packed_dir=args.packed_dir)
 
 val_loader, test_mean, test_std = dataset_TM_eval.MotionMillionFSQDATALoader(args.dataname, True,
                                         32,
@@ -122,7 +123,7 @@ train_loader_iter = cycle(train_loader)
 Loss = losses.ReConsLoss(args.recons_loss, args.nb_joints)
 
 ##### ------ warm-up ------- #####
-avg_recons, avg_perplexity, avg_commit, avg_activate = 0., 0., 0., 0.
+metrics = utils_model.MetricAccumulator(comp_device)
 
 if not args.resume_pth:
     for nb_iter in range(1, args.warm_up_iter):
@@ -161,24 +162,20 @@ if not args.resume_pth:
         accelerator.backward(loss)
         optimizer.step()
 
-        avg_recons += loss_motion.item()
-        avg_perplexity += perplexity.item()
-        avg_commit += loss_commit.item()
-        avg_activate += activate.item()
+        metrics.update(recons=loss_motion, perplexity=perplexity, commit=loss_commit, activate=activate)
 
         if nb_iter % args.print_iter ==  0 :
+            # averaged over the period and over all processes
+            reduced = metrics.reduce(accelerator)
             if accelerator.is_main_process:
-                avg_recons /= args.print_iter
-                avg_perplexity /= args.print_iter
-                avg_commit /= args.print_iter
-                avg_activate /= args.print_iter
+                avg_recons, avg_perplexity, avg_commit, avg_activate = [reduced[name] / (args.print_iter * accelerator.num_processes) for name in ['recons', 'perplexity', 'commit', 'activate']]
                 
                 logger.info(f"Warmup. Iter {nb_iter} :  lr {current_lr:.5f} \t Commit. {avg_commit:.5f} \t PPL. {avg_perplexity:.2f} \t Recons.  {avg_recons:.5f} \t Activate. {avg_activate:.2f}")
-            
-            avg_recons, avg_perplexity, avg_commit, avg_activate = 0., 0., 0., 0.
 
 ##### ---- Training ---- #####
-avg_recons, avg_perplexity, avg_commit, avg_activate = 0., 0., 0., 0.
+metrics = utils_model.MetricAccumulator(comp_device)
+# running code histogram of all processes, collected on the main process at each print
+code_usage_total = None
 
 accelerator.wait_for_everyone()
 best_mpjpe, writer, logger = eval_trans.evaluation_vqvae_motionmillion(args.out_dir, train_loader, val_loader, net, logger, writer, 0, best_mpjpe=1000, comp_device=comp_device, codebook_size=accelerator.unwrap_model(net).vqvae.quantizer.codebook_size, accelerator=accelerator)
@@ -214,17 +211,13 @@ for nb_iter in range(start_iter, args.total_iter + 1):
     optimizer.step()
     scheduler.step()
     
-    avg_recons += loss_motion.item()
-    avg_perplexity += perplexity.item()
-    avg_commit += loss_commit.item()
-    avg_activate += activate.item()
+    metrics.update(recons=loss_motion, perplexity=perplexity, commit=loss_commit, activate=activate)
 
     if nb_iter % args.print_iter ==  0 :
+        # averaged over the period and over all processes
+        reduced = metrics.reduce(accelerator)
         if accelerator.is_main_process:
-            avg_recons /= args.print_iter
-            avg_perplexity /= args.print_iter
-            avg_commit /= args.print_iter
-            avg_activate /= args.print_iter
+            avg_recons, avg_perplexity, avg_commit, avg_activate = [reduced[name] / (args.print_iter * accelerator.num_processes) for name in ['recons', 'perplexity', 'commit', 'activate']]
             
             writer.add_scalar('./Train/L1', avg_recons, nb_iter)
             writer.add_scalar('./Train/PPL', avg_perplexity, nb_iter)
@@ -232,8 +225,14 @@ for nb_iter in range(start_iter, args.total_iter + 1):
             writer.add_scalar('./Train/Activate', avg_activate, nb_iter)
             
             logger.info(f"Train. Iter {nb_iter} : \t Commit. {avg_commit:.5f} \t PPL. {avg_perplexity:.2f} \t Recons.  {avg_recons:.5f} \t Activate {avg_activate:.2f}")
-        
-        avg_recons, avg_perplexity, avg_commit, avg_activate = 0., 0., 0., 0.
+
+        if args.track_usage:
+            code_usage, usage_perplexity, usage_activate = accelerator.unwrap_model(net).vqvae.quantizer.usage(accelerator, reset=True)
+            if accelerator.is_main_process:
+                code_usage_total = code_usage.cpu() if code_usage_total is None else code_usage_total + code_usage.cpu()
+                writer.add_scalar('./Train/UsagePPL', usage_perplexity, nb_iter)
+                writer.add_scalar('./Train/UsageActivate', usage_activate, nb_iter)
+                logger.info(f"Code usage over the last {args.print_iter} iters : \t PPL. {usage_perplexity:.2f} \t Activate {usage_activate:.4f}")
     
     if nb_iter % args.eval_iter==0 :
         accelerator.wait_for_everyone()
@@ -245,6 +244,8 @@ for nb_iter in range(start_iter, args.total_iter + 1):
                     'optimizer' : optimizer.state_dict(),
                     'scheduler' : scheduler.state_dict(),
                     'nb_iter' : nb_iter}, os.path.join(args.out_dir, f'net_{nb_iter}.pth'))
+        if code_usage_total is not None:
+            torch.save(code_usage_total, os.path.join(args.out_dir, f'code_usage_{nb_iter}.pth'))
     if nb_iter % args.save_latest == 0 and accelerator.is_main_process:
         torch.save({'net' : net.state_dict(), 
                     'optimizer' : optimizer.state_dict(),
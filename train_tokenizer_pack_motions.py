@@ -0,0 +1,19 @@
+import os
+
+import options.option_vq as option_vq
+from dataset import dataset_VQ
+
+
+##### ---- Exp dirs ---- #####
+args = option_vq.get_args_parser()
+
+# the same split file and order as the training dataset
+dataset = dataset_VQ.VQMotionDataset(args.dataname, args.motion_type, args.text_type, args.version, 'train', False, window_size=args.window_size, unit_length=2**args.down_t)
+if args.packed_dir is None:
+    args.packed_dir = os.path.join(dataset.data_root, 'motion_packed', args.motion_type, args.version, 'train')
+
+if os.path.exists(os.path.join(args.packed_dir, 'meta.json')):
+    print(f"The motions have been packed in {args.packed_dir} before!")
+else:
+    dataset_VQ.pack_motions(dataset.motion_dir, dataset.id_list, args.packed_dir, dataset.split_file, shard_mb=args.pack_shard_mb, num_workers=args.num_workers)
+    print(f"{len(dataset)} motions packed into {args.packed_dir}")
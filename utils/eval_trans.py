@@ -7,7 +7,7 @@ from scipy import linalg
 
 import visualize.plot_3d_global as plot_3d
 from visualize.recover_visualize import visualize_smpl_85
-from utils.motion_process import recover_from_ric, recover_from_local_position, recover_from_local_rotation
+from utils.motion_process import recover_from_ric, recover_from_local_position, recover_from_local_rotation, recover_from_local_position_batch, recover_from_local_rotation_batch
 from tqdm import tqdm
 
 
@@ -16,11 +16,7 @@ def tensorborad_add_video_rot(writer, global_rot, nb_iter, tag, nb_vis=4, title_
 
 @torch.no_grad()
 def compute_perplexity(codebook_size, code_idx) :
-    # Calculate new centres
-    code_onehot = torch.zeros(codebook_size, code_idx.shape[0], device=code_idx.device)  # nb_code, N * L
-    code_onehot.scatter_(0, code_idx.view(1, code_idx.shape[0]), 1)
-
-    code_count = code_onehot.sum(dim=-1)  # codebook_size
+    code_count = torch.bincount(code_idx.view(-1), minlength=codebook_size).float()  # codebook_size
     prob = code_count / torch.sum(code_count)  
     perplexity = torch.exp(-torch.sum(prob * torch.log(prob + 1e-7)))
     activate = torch.sum(code_count > 0).float() / codebook_size
@@ -29,16 +25,24 @@ def compute_perplexity(codebook_size, code_idx) :
 @torch.no_grad()
 def compute_perplexity_cpu(codebook_size, code_idx) :
     code_idx = code_idx.cpu()
-    # Calculate new centres
-    code_onehot = torch.zeros(codebook_size, code_idx.shape[0], device=code_idx.device)  # nb_code, N * L
-    code_onehot.scatter_(0, code_idx.view(1, code_idx.shape[0]), 1)
-
-    code_count = code_onehot.sum(dim=-1)  # codebook_size
+    code_count = torch.bincount(code_idx.view(-1), minlength=codebook_size).float()  # codebook_size
     prob = code_count / torch.sum(code_count)  
     perplexity = torch.exp(-torch.sum(prob * torch.log(prob + 1e-7)))
     activate = torch.sum(code_count > 0).float() / codebook_size
     return perplexity, activate 
 
+@torch.no_grad()
+def compute_perplexity_from_counts(code_count) :
+    # same as compute_perplexity, from an already accumulated code histogram
+    prob = code_count.float() / code_count.sum().clamp(min=1)
+    perplexity = torch.exp(-torch.sum(prob * torch.log(prob + 1e-7)))
+    activate = torch.sum(code_count > 0).float() / code_count.shape[0]
+    return perplexity, activate
+
+def dataset_mean_std(dataset, device):
+    # normalization statistics of a motion dataset as float tensors, to (de-)normalize batches on the device
+    return torch.as_tensor(dataset.mean, dtype=torch.float32, device=device), torch.as_tensor(dataset.std, dtype=torch.float32, device=device)
+
 def normalize_to_eval_mean_std(data, train_mean, train_std, test_mean, test_std):
     data = data * train_std + train_mean
     data = (data - test_mean) / test_std
@@ -245,85 +249,72 @@ def evaluation_vqvae_motionmillion_1gpu(out_dir, train_loader, val_loader, net,
     name_list = []
     
     nb_sample = 0
-    mpjpe = 0
+    mpjpe = torch.tensor(0.0, device=comp_device)
     
     if cal_acceleration:
-        pred_mean_acceleration_seq = 0
-        pred_max_acceleration_seq = 0
-        gt_mean_acceleration_seq = 0
-        gt_max_acceleration_seq = 0
+        pred_mean_acceleration_seq = torch.tensor(0.0, device=comp_device)
+        pred_max_acceleration_seq = torch.tensor(0.0, device=comp_device)
+        gt_mean_acceleration_seq = torch.tensor(0.0, device=comp_device)
+        gt_max_acceleration_seq = torch.tensor(0.0, device=comp_device)
 
-    motion_indices = []
+    val_mean, val_std = dataset_mean_std(val_loader.dataset, comp_device)
+    train_mean, train_std = dataset_mean_std(train_loader.dataset, comp_device)
 
     for batch in tqdm(val_loader):
         
-        if len(batch) == 3:
-            motion, m_length, name = batch
-        else:
-            motion = batch
+        motion, m_length, name = batch
 
-        motion = motion.to(comp_device)
+        motion = motion.to(comp_device).float()
+        lengths = torch.as_tensor(m_length).to(comp_device)
+        m_length = lengths.tolist()
         bs, seq = motion.shape[0], motion.shape[1]
 
         num_joints = 21 if motion.shape[-1] == 251 else 22
-        
-        pred_pose_eval = torch.zeros((bs, seq, motion.shape[-1])).to(comp_device)
-        
-        for i in range(bs):
-            pose = val_loader.dataset.inv_transform(motion[i:i+1, :m_length[i], :].detach().cpu().numpy())
-            real_pose = pose
-            
-            pose_xyz = torch.from_numpy(recover_from_local_position(pose.squeeze(), num_joints)).float().to(comp_device).unsqueeze(0)
-            
-            pose_rot = torch.from_numpy(recover_from_local_rotation(pose.squeeze(), num_joints)).float().to(comp_device).unsqueeze(0)
-            
-            pose = train_loader.dataset.transform(pose)
-            
-            pred_pose, loss_commit, perplexity, activate, indices = net(torch.from_numpy(pose).to(comp_device))
-            motion_indices.append(indices)
-            
-            pred_denorm = train_loader.dataset.inv_transform(pred_pose.detach().cpu().numpy())
-            pred_xyz = torch.from_numpy(recover_from_local_position(pred_denorm.squeeze(), num_joints)).float().to(comp_device).unsqueeze(0)
-            
-            pred_rot = torch.from_numpy(recover_from_local_rotation(pred_denorm.squeeze(), num_joints)).float().to(comp_device).unsqueeze(0)
-            
-            mpjpe += torch.mean(calculate_mpjpe(pose_xyz[:, :m_length[i]].squeeze(), pred_xyz[:, :m_length[i]].squeeze())).cpu()
-            
-            
-            if cal_acceleration:
-                pred_mean_acc, pred_max_acc, gt_mean_acc, gt_max_acc = calculate_acceleration(pose_xyz[:, :m_length[i]].squeeze(), pred_xyz[:, :m_length[i]].squeeze())
-                pred_mean_acceleration_seq += torch.mean(pred_mean_acc).cpu()
-                pred_max_acceleration_seq += torch.mean(pred_max_acc).cpu()
-                gt_mean_acceleration_seq += torch.mean(gt_mean_acc).cpu()
-                gt_max_acceleration_seq += torch.mean(gt_max_acc).cpu()
-            
-            if savenpy:
-                np.save(os.path.join(out_dir, name[i].replace("/", "@")+'_gt_85rpr.npy'), pose_rot[0, :m_length[i]].cpu().numpy())
-                np.save(os.path.join(out_dir, name[i].replace("/", "@")+'_pred_85rpr.npy'), pred_rot[0, :m_length[i]].cpu().numpy())
-            
-            pred_pose = val_loader.dataset.transform(train_loader.dataset.inv_transform(pred_pose.detach().cpu().numpy()))
-            pred_pose_eval[i:i+1,:m_length[i],:] = torch.from_numpy(pred_pose).to(comp_device)
 
-            if draw:
-                draw_org.append(pose_rot)
-                draw_pred.append(pred_rot)
-                name_list.append(name[i].replace("/", "@"))
+        # the whole padded batch is reconstructed at once, padded frames are masked out of every metric
+        pose = motion * val_std + val_mean
+        pred_pose, frame_mask, _, _ = net.forward_batch((pose - train_mean) / train_std, lengths)
+        pred_denorm = pred_pose * train_std + train_mean
+
+        pose_xyz = recover_from_local_position_batch(pose, num_joints)
+        pred_xyz = recover_from_local_position_batch(pred_denorm, num_joints)
+        mpjpe += calculate_mpjpe_batch(pose_xyz, pred_xyz, frame_mask).sum()
+
+        if cal_acceleration:
+            pred_mean_acc, pred_max_acc, gt_mean_acc, gt_max_acc = calculate_acceleration_batch(pose_xyz, pred_xyz, frame_mask, max_reduction='mean')
+            pred_mean_acceleration_seq += pred_mean_acc.sum()
+            pred_max_acceleration_seq += pred_max_acc.sum()
+            gt_mean_acceleration_seq += gt_mean_acc.sum()
+            gt_max_acceleration_seq += gt_max_acc.sum()
+
+        if savenpy or draw:
+            # the smpl 85 rotations are only needed for saving and drawing
+            pose_rot_batch = recover_from_local_rotation_batch(pose, num_joints).cpu()
+            pred_rot_batch = recover_from_local_rotation_batch(pred_denorm, num_joints).cpu()
+            for i in range(bs):
+                pose_rot = pose_rot_batch[i:i+1, :m_length[i]]
+                pred_rot = pred_rot_batch[i:i+1, :m_length[i]]
+                if savenpy:
+                    np.save(os.path.join(out_dir, name[i].replace("/", "@")+'_gt_85rpr.npy'), pose_rot[0].numpy())
+                    np.save(os.path.join(out_dir, name[i].replace("/", "@")+'_pred_85rpr.npy'), pred_rot[0].numpy())
+                if draw:
+                    draw_org.append(pose_rot)
+                    draw_pred.append(pred_rot)
+                    name_list.append(name[i].replace("/", "@"))
         nb_sample += bs
 
-    mpjpe = mpjpe / nb_sample
+    mpjpe = (mpjpe / nb_sample).item()
     if cal_acceleration:
-        pred_mean_acceleration_seq = pred_mean_acceleration_seq / nb_sample
-        pred_max_acceleration_seq = pred_max_acceleration_seq / nb_sample
-        gt_mean_acceleration_seq = gt_mean_acceleration_seq / nb_sample
-        gt_max_acceleration_seq = gt_max_acceleration_seq / nb_sample
+        pred_mean_acceleration_seq = (pred_mean_acceleration_seq / nb_sample).item()
+        pred_max_acceleration_seq = (pred_max_acceleration_seq / nb_sample).item()
+        gt_mean_acceleration_seq = (gt_mean_acceleration_seq / nb_sample).item()
+        gt_max_acceleration_seq = (gt_max_acceleration_seq / nb_sample).item()
         print("pred_mean_acceleration_seq: ", pred_mean_acceleration_seq)
         print("pred_max_acceleration_seq: ", pred_max_acceleration_seq)
         print("gt_mean_acceleration_seq: ", gt_mean_acceleration_seq)
         print("gt_max_acceleration_seq: ", gt_max_acceleration_seq)
     print("mpjpe: ", mpjpe)
 
-    motion_indices = [motion_index.flatten() for motion_index in motion_indices]
-    
     msg = f"--> \t Eva. Iter {nb_iter} :, MPJPE. {mpjpe}"
     if cal_acceleration:
         msg += f", Pred_mean_acceleration_seq. {pred_mean_acceleration_seq:.3f}, Pred_max_acceleration_seq. {pred_max_acceleration_seq:.3f}, Gt_mean_acceleration_seq. {gt_mean_acceleration_seq:.3f}, Gt_max_acceleration_seq. {gt_max_acceleration_seq:.3f}"
@@ -363,6 +354,7 @@ def evaluation_vqvae_motionmillion_1gpu(out_dir, train_loader, val_loader, net,
 @torch.no_grad()        
 def evaluation_vqvae_motionmillion(out_dir, train_loader, val_loader, net, logger, writer, nb_iter, best_mpjpe, comp_device, codebook_size, draw = True, save = True, savenpy=False, accelerator=None, cal_acceleration=False): 
     net.eval()
+    model = accelerator.unwrap_model(net) if accelerator is not None else net
     
     mpjpe = torch.tensor(0.0, device=comp_device)
     if cal_acceleration:
@@ -372,55 +364,60 @@ def evaluation_vqvae_motionmillion(out_dir, train_loader, val_loader, net, logge
         gt_max_acceleration_seq = torch.tensor(0.0, device=comp_device)
         
     nb_sample = torch.tensor(0, device=comp_device)
+    code_count = torch.zeros(codebook_size, dtype=torch.long, device=comp_device)
 
-    motion_indices = []
+    val_mean, val_std = dataset_mean_std(val_loader.dataset, comp_device)
+    train_mean, train_std = dataset_mean_std(train_loader.dataset, comp_device)
     
-    for batch in tqdm(val_loader):
+    for batch in tqdm(val_loader, disable=accelerator is not None and not accelerator.is_main_process):
         motion, m_length, name = batch
         
-        motion = motion.to(comp_device)
+        motion = motion.to(comp_device).float()
+        lengths = torch.as_tensor(m_length).to(comp_device)
+        m_length = lengths.tolist()
 
         bs, seq = motion.shape[0], motion.shape[1]
 
         num_joints = 22
-        
-        pred_pose_eval = torch.zeros((bs, seq, motion.shape[-1])).to(comp_device)
 
-        for i in range(bs):
-            pose = val_loader.dataset.inv_transform(motion[i:i+1, :m_length[i], :].detach().cpu().numpy())
-            pose_xyz = torch.from_numpy(recover_from_local_position(pose.squeeze(), num_joints)).float().to(comp_device).unsqueeze(0)
+        # the whole padded batch is reconstructed at once, padded frames and codes are masked out of every metric
+        pose = motion * val_std + val_mean
+        pred_pose, frame_mask, indices, code_mask = model.forward_batch((pose - train_mean) / train_std, lengths)
+        code_count += torch.bincount(indices[code_mask].reshape(-1).to(torch.int64), minlength=codebook_size)
+        pred_denorm = pred_pose * train_std + train_mean
 
-            pose = train_loader.dataset.transform(pose)
-            
-            pred_pose, _, perplexity, activate, indices = net(torch.from_numpy(pose).to(comp_device))
-            motion_indices.append(indices.squeeze().cpu())
+        pose_xyz = recover_from_local_position_batch(pose, num_joints)
+        pred_xyz = recover_from_local_position_batch(pred_denorm, num_joints)
+        mpjpe += calculate_mpjpe_batch(pose_xyz, pred_xyz, frame_mask).sum()
 
-            pred_denorm = train_loader.dataset.inv_transform(pred_pose.detach().cpu().numpy())
-            pred_xyz = torch.from_numpy(recover_from_local_position(pred_denorm.squeeze(), num_joints)).float().to(comp_device).unsqueeze(0)
-            mpjpe += torch.mean(calculate_mpjpe(pose_xyz[:].squeeze(), pred_xyz[:].squeeze()))
-            
-            
-            if cal_acceleration:
-                pred_mean_acc, pred_max_acc, gt_mean_acc, gt_max_acc = calculate_acceleration(pose_xyz[:].squeeze(), pred_xyz[:].squeeze())
-                pred_mean_acceleration_seq += torch.mean(pred_mean_acc)
-                pred_max_acceleration_seq += torch.max(pred_max_acc)
-                gt_mean_acceleration_seq += torch.mean(gt_mean_acc)
-                gt_max_acceleration_seq += torch.max(gt_max_acc)
-            
-            if savenpy:
-                np.save(os.path.join(out_dir, name[i]+'_gt.npy'), pose_xyz[:, :m_length[i]].cpu().numpy())
-                np.save(os.path.join(out_dir, name[i]+'_pred.npy'), pred_xyz.detach().cpu().numpy())
-
-            pred_pose = val_loader.dataset.transform(train_loader.dataset.inv_transform(pred_pose.detach().cpu().numpy()))
-            pred_pose_eval[i:i+1,:m_length[i],:] = torch.from_numpy(pred_pose).to(comp_device)
+        if cal_acceleration:
+            pred_mean_acc, pred_max_acc, gt_mean_acc, gt_max_acc = calculate_acceleration_batch(pose_xyz, pred_xyz, frame_mask, max_reduction='max')
+            pred_mean_acceleration_seq += pred_mean_acc.sum()
+            pred_max_acceleration_seq += pred_max_acc.sum()
+            gt_mean_acceleration_seq += gt_mean_acc.sum()
+            gt_max_acceleration_seq += gt_max_acc.sum()
+        
+        if savenpy:
+            pose_np, pred_np = pose_xyz.cpu().numpy(), pred_xyz.cpu().numpy()
+            for i in range(bs):
+                np.save(os.path.join(out_dir, name[i]+'_gt.npy'), pose_np[i:i+1, :m_length[i]])
+                np.save(os.path.join(out_dir, name[i]+'_pred.npy'), pred_np[i:i+1, :m_length[i]])
             
         nb_sample = nb_sample + bs
+
+    # every process evaluates its own shard of the split, the sums and the code histogram cover all of them
+    if accelerator is not None:
+        mpjpe = accelerator.reduce(mpjpe, reduction="sum")
+        nb_sample = accelerator.reduce(nb_sample, reduction="sum")
+        code_count = accelerator.reduce(code_count, reduction="sum")
+        if cal_acceleration:
+            pred_mean_acceleration_seq = accelerator.reduce(pred_mean_acceleration_seq, reduction="sum")
+            pred_max_acceleration_seq = accelerator.reduce(pred_max_acceleration_seq, reduction="sum")
+            gt_mean_acceleration_seq = accelerator.reduce(gt_mean_acceleration_seq, reduction="sum")
+            gt_max_acceleration_seq = accelerator.reduce(gt_max_acceleration_seq, reduction="sum")
     
     if accelerator is None or accelerator.is_main_process:
-        motion_indices = [motion_index.flatten() for motion_index in motion_indices]
-        all_motion_indices = torch.cat(motion_indices)
-    
-        perplexity, activate = compute_perplexity(codebook_size, all_motion_indices.reshape(-1).to(torch.int64))
+        perplexity, activate = compute_perplexity_from_counts(code_count)
         mpjpe = mpjpe / nb_sample
         if cal_acceleration:
             pred_mean_acceleration_seq = pred_mean_acceleration_seq / nb_sample
@@ -704,24 +701,20 @@ def evaluation_transformer(out_dir, val_loader, net, trans, logger, writer, nb_i
 
 # use
 @torch.no_grad()        
-def evaluation_transformer_motionmillion(out_dir, val_loader, net, trans, logger, writer, nb_iter, best_fid, best_iter, best_div, best_top1, best_top2, best_top3, best_matching, clip_model, eval_wrapper, comp_device, text_encode, text_sum_way, draw = True, save = True, savegif=False, accelerator=None) : 
+def evaluation_transformer_motionmillion(out_dir, val_loader, net, trans, logger, writer, nb_iter, best_fid, best_iter, best_div, best_top1, best_top2, best_top3, best_matching, clip_model, eval_wrapper, comp_device, text_encode, text_sum_way, draw = True, save = True, savegif=False, accelerator=None, draft=None, nb_draft_tokens=4) : 
 
     trans.eval()
 
-    motion_annotation_list = []
-    motion_pred_list = []
-    R_precision_real = torch.tensor([0,0,0], device=comp_device)
-    R_precision = torch.tensor([0,0,0], device=comp_device)
-    matching_score_real = torch.tensor(0.0, device=comp_device)
-    matching_score_pred = torch.tensor(0.0, device=comp_device)
-
+    # the ground-truth side is computed once per split and evaluator checkpoint
+    eval_wrapper.load_gt_cache(val_loader.dataset, accelerator)
 
-    nb_sample = torch.tensor(0, device=comp_device)
+    metrics = EmbeddingMetrics(comp_device)
+    val_mean, val_std = dataset_mean_std(val_loader.dataset, comp_device)
     
     for i in range(1):
         global_cnt = 0
         
-        for batch in tqdm(val_loader):
+        for batch in tqdm(val_loader, disable=accelerator is not None and not accelerator.is_main_process):
             global_cnt += 1
             _, _, clip_text, _, pose, m_length, _, name = batch
             bs, seq = pose.shape[:2]
@@ -759,81 +752,52 @@ def evaluation_transformer_motionmillion(out_dir, val_loader, net, trans, logger
             elif text_sum_way == 'sum':
                 feat_clip_text = (feat_clip_text * y_mask.unsqueeze(-1)).sum(dim=1)
 
-            pred_pose_eval = torch.zeros((bs, seq, pose.shape[-1])).to(comp_device)
-            pred_len = torch.ones(bs).long()
+            if accelerator is not None:
+                index_motion_batch, nb_tokens = accelerator.unwrap_model(trans).sample_batch(feat_clip_text, y_mask, False, draft=draft, nb_draft_tokens=nb_draft_tokens)
+            else:
+                index_motion_batch, nb_tokens = trans.sample_batch(feat_clip_text, y_mask, False, draft=draft, nb_draft_tokens=nb_draft_tokens)
 
-            for k in range(bs):
-                
-                if accelerator is not None:
-                    index_motion = accelerator.unwrap_model(trans).sample(feat_clip_text[k:k+1], y_mask[k:k+1], False)
-                    pred_pose = accelerator.unwrap_model(net).forward_decoder(index_motion)
+            # a prompt that ends right away decodes the single code 1, as in LLaMAHF.sample
+            if index_motion_batch.shape[1] == 0:
+                index_motion_batch = torch.zeros((bs, 1), dtype=torch.long, device=comp_device)
+            index_motion_batch[nb_tokens == 0, 0] = 1
 
-                else:
-                    index_motion = trans.sample(feat_clip_text[k:k+1],y_mask[k:k+1], False)
-                    pred_pose = net.forward_decoder(index_motion)
-                
-                cur_len = pred_pose.shape[1]
+            if accelerator is not None:
+                pred_pose, frame_lengths, frame_mask = accelerator.unwrap_model(net).forward_decoder_batch(index_motion_batch, nb_tokens.clamp(min=1))
+            else:
+                pred_pose, frame_lengths, frame_mask = net.forward_decoder_batch(index_motion_batch, nb_tokens.clamp(min=1))
 
-                pred_len[k] = min(cur_len, seq)
-                pred_pose_eval[k:k+1, :cur_len] = pred_pose[:, :seq]
+            # padded to the longest generated motion only, as the evaluator takes variable length batches
+            pred_len = frame_lengths.clamp(max=seq).cpu()
+            pred_pose_eval = (pred_pose * frame_mask[..., None])[:, :seq]
 
-            et_pred, em_pred = eval_wrapper.get_co_embeddings(clip_text, torch.from_numpy(val_loader.dataset.inv_transform(pred_pose_eval.detach().cpu().numpy())).to(comp_device), pred_len)
+            et, em = eval_wrapper.get_gt_embeddings(name, clip_text)
+            em_pred = eval_wrapper.get_motion_embeddings(pred_pose_eval * val_std + val_mean, pred_len)
+            et_pred = et
 
             
             if i == 0:
-                pose = pose.to(comp_device).float()
-                
-                et, em = eval_wrapper.get_co_embeddings(clip_text, torch.from_numpy(val_loader.dataset.inv_transform(pose.detach().cpu().numpy())).to(comp_device), m_length)
-
-                motion_annotation_list.append(em.cpu())
-                motion_pred_list.append(em_pred.cpu())
-
-                if accelerator is None or accelerator.is_main_process:
-                    temp_R, temp_match = calculate_R_precision(et.cpu().numpy(), em.cpu().numpy(), top_k=3, sum_all=True)
-                    R_precision_real += torch.tensor(temp_R, device=comp_device)
-                    matching_score_real += torch.tensor(temp_match, device=comp_device)
-                    temp_R, temp_match = calculate_R_precision(et_pred.cpu().numpy(), em_pred.cpu().numpy(), top_k=3, sum_all=True)
-                    R_precision += torch.tensor(temp_R, device=comp_device)
-                    matching_score_pred += torch.tensor(temp_match, device=comp_device)
+                metrics.update('real', et, em)
+                metrics.update('pred', et_pred, em_pred)
 
-                    nb_sample += et.shape[0]
-                    
-    if accelerator is not None:
-        accelerator.wait_for_everyone()
-
-        motion_annotation_list = accelerator.gather(torch.cat(motion_annotation_list, dim=0))
-        motion_pred_list = accelerator.gather(torch.cat(motion_pred_list, dim=0))
-        # reduce
-        R_precision_real = accelerator.reduce(R_precision_real, reduction="sum")
-        R_precision = accelerator.reduce(R_precision, reduction="sum")
-        matching_score_real = accelerator.reduce(matching_score_real, reduction="sum")
-        matching_score_pred = accelerator.reduce(matching_score_pred, reduction="sum")
-        print(nb_sample)
-        nb_sample = accelerator.reduce(nb_sample, reduction="sum")
-        print(nb_sample)
-    else:
-        motion_annotation_list = torch.cat(motion_annotation_list, dim=0)
-        motion_pred_list = torch.cat(motion_pred_list, dim=0)
+    # only the running sums of every process are merged, no embedding leaves its device
+    results = metrics.reduce(accelerator)
 
     if accelerator is None or accelerator.is_main_process:
-        print(len(motion_annotation_list)) # 23 ----> 48
-        motion_annotation_np = motion_annotation_list.cpu().numpy()
-        print(motion_annotation_np.shape) # 1472 / 1536 ---> 1530
-        print(nb_sample)
-        motion_pred_np = motion_pred_list.cpu().numpy()
-        gt_mu, gt_cov  = calculate_activation_statistics(motion_annotation_np)
-        mu, cov= calculate_activation_statistics(motion_pred_np)
+        real, pred = results['real'], results['pred']
+        print(pred['count'])
+        gt_mu, gt_cov  = eval_wrapper.get_gt_statistics()
 
-        diversity_real = 0.0
-        diversity = 0.0
+        diversity_real = real['diversity']
+        diversity = pred['diversity']
 
-        R_precision_real = R_precision_real / nb_sample
-        R_precision = R_precision / nb_sample
+        R_precision_real = real['R_precision']
+        R_precision = pred['R_precision']
 
-        matching_score_real = matching_score_real / nb_sample
-        matching_score_pred = matching_score_pred / nb_sample
+        matching_score_real = real['matching_score']
+        matching_score_pred = pred['matching_score']
 
-        fid = calculate_frechet_distance(gt_mu, gt_cov, mu, cov)
+        fid = calculate_frechet_distance(gt_mu, gt_cov, pred['mu'], pred['cov'])
 
         msg = f"--> \t Eva. Iter {nb_iter} :, FID. {fid:.4f}, Diversity Real. {diversity_real:.4f}, Diversity. {diversity:.4f}, R_precision_real. {R_precision_real}, R_precision. {R_precision}, matching_score_real. {matching_score_real}, matching_score_pred. {matching_score_pred}"
         logger.info(msg)
@@ -1269,6 +1233,72 @@ def calculate_frechet_distance(mu1, sigma1, mu2, sigma2, eps=1e-6):
     return (diff.dot(diff) + np.trace(sigma1)
             + np.trace(sigma2) - 2 * tr_covmean)
 
+class EmbeddingMetrics:
+    """Streaming FID statistics, R-precision, matching score and diversity of (text, motion) embeddings.
+
+    Every `update` folds a batch into running sums on the device (float64), memory does not grow
+    with the split. R-precision and matching score are computed within each batch, as
+    calculate_R_precision does, with `topk` on the distance matrix; diversity is the mean distance
+    between each motion and its neighbour in the (shuffled) batch. `reduce` sums the states of all
+    accelerate processes and must be called on every rank.
+    """
+    def __init__(self, device, top_k=3):
+        self.device = device
+        self.top_k = top_k
+        self.states = {}
+
+    @torch.no_grad()
+    def update(self, name, text_emb, motion_emb):
+        text_emb, motion_emb = text_emb.to(self.device, torch.float64), motion_emb.to(self.device, torch.float64)
+        bs, dim = motion_emb.shape
+        if name not in self.states:
+            self.states[name] = {
+                'count': torch.zeros((), dtype=torch.float64, device=self.device),
+                'sum': torch.zeros(dim, dtype=torch.float64, device=self.device),
+                'outer': torch.zeros((dim, dim), dtype=torch.float64, device=self.device),
+                'R_precision': torch.zeros(self.top_k, dtype=torch.float64, device=self.device),
+                'matching_score': torch.zeros((), dtype=torch.float64, device=self.device),
+                'diversity': torch.zeros((), dtype=torch.float64, device=self.device),
+            }
+        state = self.states[name]
+
+        dist = torch.cdist(text_emb, motion_emb)
+        top_k = dist.topk(min(self.top_k, bs), dim=1, largest=False).indices
+        # a row matches at most once, so the running count of matches is the top-1..k hit
+        hits = (top_k == torch.arange(bs, device=self.device)[:, None]).cumsum(dim=1).sum(dim=0)
+        state['R_precision'][:hits.shape[0]] += hits
+        state['matching_score'] += dist.diagonal().sum()
+        state['diversity'] += (motion_emb - motion_emb.roll(1, dims=0)).norm(dim=1).sum()
+        state['count'] += bs
+        state['sum'] += motion_emb.sum(dim=0)
+        state['outer'] += motion_emb.T @ motion_emb
+
+    def reduce(self, accelerator=None):
+        """Returns {name: {'count', 'R_precision', 'matching_score', 'diversity', 'mu', 'cov'}} over all processes."""
+        results = {}
+        for name in sorted(self.states):
+            state = self.states[name]
+            keys = sorted(state)
+            flat = torch.cat([state[key].reshape(-1) for key in keys])
+            if accelerator is not None:
+                flat = accelerator.reduce(flat, reduction="sum")
+            state = dict(zip(keys, flat.split([state[key].numel() for key in keys])))
+            dim = state['sum'].numel()
+            count = state['count'].item()
+            mu = state['sum'] / count
+            cov = (state['outer'].view(dim, dim) - count * torch.outer(mu, mu)) / max(count - 1, 1)
+            results[name] = {
+                'count': int(count),
+                'R_precision': (state['R_precision'] / count).float().cpu(),
+                'matching_score': (state['matching_score'] / count).float().cpu().reshape(()),
+                'diversity': (state['diversity'] / count).item(),
+                'mu': mu.cpu().numpy(),
+                'cov': cov.cpu().numpy(),
+            }
+        self.states = {}
+        return results
+
+
 def calculate_mpjpe(gt_joints, pred_joints):
     """
     gt_joints: num_poses x num_joints(22) x 3
@@ -1315,6 +1345,45 @@ def calculate_acceleration(gt_joints, pred_joints):
 
     return pred_mean_acceleration_seq, pred_max_acceleration_seq, gt_mean_acceleration_seq, gt_max_acceleration_seq
 
+def calculate_mpjpe_batch(gt_joints, pred_joints, mask):
+    """
+    gt_joints: bs x num_poses x num_joints(22) x 3
+    pred_joints: bs x num_poses x num_joints(22) x 3
+    mask: bs x num_poses, valid frames
+    returns the mpjpe of every sequence averaged over its valid frames, as calculate_mpjpe(...).mean()
+    """
+    assert gt_joints.shape == pred_joints.shape, f"GT shape: {gt_joints.shape}, pred shape: {pred_joints.shape}"
+    gt_joints = gt_joints - gt_joints[:, :, [0]]
+    pred_joints = pred_joints - pred_joints[:, :, [0]]
+
+    mpjpe = torch.linalg.norm(pred_joints - gt_joints, dim=-1).mean(-1) # bs x num_poses
+    mask = mask.to(mpjpe.dtype)
+    return (mpjpe * mask).sum(-1) / mask.sum(-1).clamp(min=1)
+
+def calculate_acceleration_batch(gt_joints, pred_joints, mask, max_reduction='mean'):
+    """
+    Batched calculate_acceleration over the valid frames of padded sequences (bs x num_poses x num_joints x 3),
+    every returned value is per sequence (bs,): the mean over frames of the per-frame mean and max
+    joint acceleration, the max one being reduced over frames with `max_reduction` ('mean' or 'max').
+    """
+    assert gt_joints.shape == pred_joints.shape, f"GT shape: {gt_joints.shape}, pred shape: {pred_joints.shape}"
+    # an acceleration at frame t needs frames t, t+1, t+2
+    mask = mask[:, 2:]
+    weight = mask.to(gt_joints.dtype)
+    outputs = []
+    for joints in (pred_joints, gt_joints):
+        joints = joints - joints[:, :, [0]]
+        velocity = joints[:, 1:] - joints[:, :-1]
+        acceleration = torch.linalg.norm(velocity[:, 1:] - velocity[:, :-1], dim=-1) # bs x num_poses-2 x num_joints
+        mean_acceleration = (acceleration.mean(-1) * weight).sum(-1) / weight.sum(-1).clamp(min=1)
+        max_acceleration = acceleration.max(-1)[0]
+        if max_reduction == 'max':
+            max_acceleration = max_acceleration.masked_fill(~mask, 0).max(-1)[0]
+        else:
+            max_acceleration = (max_acceleration * weight).sum(-1) / weight.sum(-1).clamp(min=1)
+        outputs += [mean_acceleration, max_acceleration]
+    return tuple(outputs)
+
 def calculate_activation_statistics(activations):
 
     mu = np.mean(activations, axis=0)
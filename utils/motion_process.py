@@ -4,12 +4,82 @@ from utils.face_z_align_util import rotation_6d_to_matrix, matrix_to_axis_angle
 import numpy as np
 
 
+# The 272-dim representation: root xz velocity without heading (2), heading change between
+# frames in 6d (6), local joint positions without heading (3*njoint), joint velocities (3*njoint)
+# and local joint rotations in 6d (6*njoint). The *_batch functions recover it on (bs, nfrm, 272)
+# tensors on any device; the numpy functions are the single sequence entry points built on them.
+
+def accumulate_rotations_scan(relative_rotations):
+    # (..., nfrm, 3, 3): R_t = R_rel_t @ R_{t-1} as a prefix product in log2(nfrm) batched matmuls
+    # instead of one step per frame
+    R_total = relative_rotations
+    step = 1
+    while step < R_total.shape[-3]:
+        R_total = torch.cat([R_total[..., :step, :, :], R_total[..., step:, :, :] @ R_total[..., :-step, :, :]], dim=-3)
+        step *= 2
+    return R_total
+
+
+def recover_root_heading_translation(final_x):
+    # inverse global heading (bs, nfrm, 3, 3) and root translation on the ground (bs, nfrm, 3)
+    velocities_root_xy_no_heading = final_x[..., :2]
+    global_heading_diff_rot = final_x[..., 2:8]
+
+    global_heading_rot = accumulate_rotations_scan(rotation_6d_to_matrix(global_heading_diff_rot))
+    inv_global_heading_rot = global_heading_rot.transpose(-1, -2)
+
+    # the velocity of frame t is expressed in the heading of frame t-1
+    velocities_root_xyz_no_heading = torch.stack([velocities_root_xy_no_heading[..., 0],
+                                                  torch.zeros_like(velocities_root_xy_no_heading[..., 0]),
+                                                  velocities_root_xy_no_heading[..., 1]], dim=-1)
+    velocities_root_xyz_no_heading = torch.cat([velocities_root_xyz_no_heading[:, :1],
+                                                (inv_global_heading_rot[:, :-1] @ velocities_root_xyz_no_heading[:, 1:, :, None]).squeeze(-1)], dim=1)
+    root_translation = torch.cumsum(velocities_root_xyz_no_heading, dim=1)
+    return inv_global_heading_rot, root_translation
+
+
+def mask_frames(x, lengths):
+    # zeros the frames past `lengths` of (bs, nfrm, ...), every recovered frame only depends on the
+    # frames before it so right padding never leaks into the valid ones
+    if lengths is None:
+        return x
+    mask = torch.arange(x.shape[1], device=x.device)[None] < torch.as_tensor(lengths, device=x.device)[:, None]
+    return x * mask.view(mask.shape + (1,) * (x.dim() - 2)).to(x.dtype)
+
+
+def recover_from_local_position_batch(final_x, njoint, lengths=None):
+    # global joint positions (bs, nfrm, njoint, 3)
+    bs, nfrm, _ = final_x.shape
+    positions_no_heading = final_x[..., 8:8+3*njoint].reshape(bs, nfrm, njoint, 3)
+    inv_global_heading_rot, root_translation = recover_root_heading_translation(final_x)
+
+    positions_with_heading = (inv_global_heading_rot[:, :, None] @ positions_no_heading[..., None]).squeeze(-1)
+    positions_with_heading[..., 0] += root_translation[..., 0:1]
+    positions_with_heading[..., 2] += root_translation[..., 2:]
+    return mask_frames(positions_with_heading, lengths)
+
+
+def rotations_matrix_to_smpl85_batch(rotations_matrix, translation):
+    bs, nfrm = rotations_matrix.shape[:2]
+    axis_angle = matrix_to_axis_angle(rotations_matrix).reshape(bs, nfrm, -1)
+    return torch.cat([axis_angle, axis_angle.new_zeros(bs, nfrm, 6), translation, axis_angle.new_zeros(bs, nfrm, 10)], dim=-1)
+
+
+# add hip height to translation when recoverring from rotation
+def recover_from_local_rotation_batch(final_x, njoint, lengths=None):
+    # smpl 85 (bs, nfrm, 85): local joint rotations in axis angle with the heading put back on the root, and the root translation
+    bs, nfrm, _ = final_x.shape
+    rotations_matrix = rotation_6d_to_matrix(final_x[..., 8+6*njoint:8+12*njoint].reshape(bs, nfrm, njoint, 6))
+    height = final_x[..., 8+1]
+    inv_global_heading_rot, root_translation = recover_root_heading_translation(final_x)
+
+    rotations_matrix = torch.cat([(inv_global_heading_rot @ rotations_matrix[:, :, 0])[:, :, None], rotations_matrix[:, :, 1:]], dim=2)
+    root_translation = torch.stack([root_translation[..., 0], height, root_translation[..., 2]], dim=-1)
+    return mask_frames(rotations_matrix_to_smpl85_batch(rotations_matrix, root_translation), lengths)
+
+
 def accumulate_rotations(relative_rotations):
-    R_total = [relative_rotations[0]]
-    for R_rel in relative_rotations[1:]:
-        R_total.append(np.matmul(R_rel, R_total[-1]))
-    
-    return np.array(R_total)
+    return accumulate_rotations_scan(torch.from_numpy(relative_rotations)).numpy()
 
 
 def rotations_matrix_to_smpl85(rotations_matrix, translation):
@@ -20,24 +90,40 @@ def rotations_matrix_to_smpl85(rotations_matrix, translation):
 
 
 def recover_from_local_position(final_x, njoint):
-    # take positions_no_heading: local position on xz ori, no heading
-    # velocities_root_xy_no_heading: to recover translation
-    # global_heading_diff_rot: to recover root rotation
+    # (nfrm, 272) numpy -> (nfrm, njoint, 3), computed in float64 like the original numpy code
+    final_x = torch.from_numpy(np.asarray(final_x, dtype=np.float64))
+    return recover_from_local_position_batch(final_x[None], njoint)[0].numpy()
+
+
+def recover_from_local_rotation(final_x, njoint):
+    # (nfrm, 272) numpy -> smpl 85 (nfrm, 85)
+    final_x = torch.from_numpy(np.asarray(final_x, dtype=np.float64))
+    return recover_from_local_rotation_batch(final_x[None], njoint)[0].numpy()
+
+
+# the original per-frame numpy implementations, kept as the reference the batched code is tested against
+
+def accumulate_rotations_loop(relative_rotations):
+    R_total = [relative_rotations[0]]
+    for R_rel in relative_rotations[1:]:
+        R_total.append(np.matmul(R_rel, R_total[-1]))
     
+    return np.array(R_total)
+
+
+def recover_from_local_position_loop(final_x, njoint):
     nfrm, _ = final_x.shape
     positions_no_heading = final_x[:,8:8+3*njoint].reshape(nfrm, -1, 3) # frames, njoints * 3
     velocities_root_xy_no_heading = final_x[:,:2] # frames, 2
     global_heading_diff_rot = final_x[:,2:8] # frames, 6
 
     # recover global heading
-    global_heading_rot = accumulate_rotations(rotation_6d_to_matrix(torch.from_numpy(global_heading_diff_rot)).numpy())
+    global_heading_rot = accumulate_rotations_loop(rotation_6d_to_matrix(torch.from_numpy(global_heading_diff_rot)).numpy())
     inv_global_heading_rot = np.transpose(global_heading_rot, (0, 2, 1))
     # add global heading to position
     positions_with_heading = np.matmul(np.repeat(inv_global_heading_rot[:, None,:, :], njoint, axis=1), positions_no_heading[...,None]).squeeze(-1)
 
     # recover root translation
-    # add heading to velocities_root_xy_no_heading
-
     velocities_root_xyz_no_heading = np.zeros((velocities_root_xy_no_heading.shape[0], 3))
     velocities_root_xyz_no_heading[:, 0] = velocities_root_xy_no_heading[:, 0]
     velocities_root_xyz_no_heading[:, 2] = velocities_root_xy_no_heading[:, 1]
@@ -45,7 +131,6 @@ def recover_from_local_position(final_x, njoint):
 
     root_translation = np.cumsum(velocities_root_xyz_no_heading, axis=0)
 
-
     # add root translation
     positions_with_heading[:, :, 0] += root_translation[:, 0:1]
     positions_with_heading[:, :, 2] += root_translation[:, 2:]
@@ -53,8 +138,7 @@ def recover_from_local_position(final_x, njoint):
     return positions_with_heading
 
 
-# add hip height to translation when recoverring from rotation
-def recover_from_local_rotation(final_x, njoint):
+def recover_from_local_rotation_loop(final_x, njoint):
     nfrm, _ = final_x.shape
     rotations_matrix = rotation_6d_to_matrix(torch.from_numpy(final_x[:,8+6*njoint:8+12*njoint]).reshape(nfrm, -1, 6)).numpy()
     global_heading_diff_rot = final_x[:,2:8]
@@ -62,7 +146,7 @@ def recover_from_local_rotation(final_x, njoint):
     positions_no_heading = final_x[:, 8:8+3*njoint].reshape(nfrm, -1, 3)
     height = positions_no_heading[:, 0, 1]
 
-    global_heading_rot = accumulate_rotations(rotation_6d_to_matrix(torch.from_numpy(global_heading_diff_rot)).numpy())
+    global_heading_rot = accumulate_rotations_loop(rotation_6d_to_matrix(torch.from_numpy(global_heading_diff_rot)).numpy())
     inv_global_heading_rot = np.transpose(global_heading_rot, (0, 2, 1))
     # recover root rotation
     rotations_matrix[:,0,...] = np.matmul(inv_global_heading_rot, rotations_matrix[:,0,...])
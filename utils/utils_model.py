@@ -29,6 +29,34 @@ def get_logger(out_dir):
     logger.addHandler(strm_hdlr)
     return logger
 
+class MetricAccumulator:
+    """Running sums of training metrics, kept as device tensors.
+
+    `update` never waits for the device; `reduce` sums over all accelerate processes and
+    returns python floats, so it is only meant to be called at logging cadence (on every rank).
+    """
+    def __init__(self, device):
+        self.device = device
+        self.sums = {}
+
+    def update(self, **metrics):
+        # python numbers stay on the host, tensors are summed where they live
+        for name, value in metrics.items():
+            if torch.is_tensor(value):
+                value = value.detach().float()
+            self.sums[name] = self.sums.get(name, 0.) + value
+
+    def reduce(self, accelerator=None):
+        names = sorted(self.sums)
+        if len(names) == 0:
+            return {}
+        values = torch.stack([torch.as_tensor(self.sums[name], dtype=torch.float32, device=self.device).reshape(()) for name in names])
+        if accelerator is not None:
+            values = accelerator.reduce(values, reduction="sum")
+        self.sums = {}
+        return dict(zip(names, values.tolist()))
+
+
 ## Optimizer
 def initial_optim(decay_option, lr, weight_decay, net, optimizer, eps) : 
     